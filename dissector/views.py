@@ -46,7 +46,8 @@ from dissector.models import (ImageComparison, ImageComparisonRecipe,
                                VersionComparison, VersionComparisonDifference,
                                VersionComparisonFileDiff)
 from layerindex.models import (Branch, LayerItem, LayerBranch, ClassicRecipe,
-                              Source, Patch, Update)
+                              Source, Patch, Update, RecipeInherit,
+                              truncate_charfield_value)
 from layerindex.views import (ClassicRecipeSearchView, ClassicRecipeDetailView,
                               ClassicRecipeLinkWrapper)
 
@@ -172,6 +173,7 @@ class ImageCompareView(FormView):
                         if os.path.isdir(entrypath):
                             shutil.move(entrypath, comppatchdir)
 
+                    depsync = recipeparse.RecipeDependencySync()
                     for pn, jsrecipe in jsdata['recipes'].items():
                         recipe = ImageComparisonRecipe()
                         recipe.comparison = comparison
@@ -208,10 +210,15 @@ class ImageCompareView(FormView):
                         utils.validate_fields(recipe)
                         recipe.save()
 
+                        # bulk_create() doesn't call save(), so truncate here
+                        inheritfield = RecipeInherit._meta.get_field('name')
+                        inherits = set([truncate_charfield_value(RecipeInherit, inheritfield, inherit, recipe) for inherit in recipe.inherits.split()])
+                        RecipeInherit.objects.bulk_create([RecipeInherit(recipe=recipe, name=inherit) for inherit in inherits])
+
                         # Take care of dependencies
                         depends = jsrecipe.get('DEPENDS', '')
                         packageconfig_opts = jsrecipe.get('packageconfig_opts', {})
-                        recipeparse.handle_recipe_depends(recipe, depends, packageconfig_opts, logger)
+                        recipeparse.handle_recipe_depends(recipe, depends, packageconfig_opts, logger, depsync)
 
                         for jsurl in jsrecipe.get('source_urls', []):
                             source = Source()
@@ -234,6 +241,9 @@ class ImageCompareView(FormView):
                             utils.validate_fields(recipe)
                             patch.save()
 
+                    # Once for the whole import (see Branch.generation)
+                    branch.bump_generation()
+
         except ValidationError as e:
             return HttpResponse('ValidationError: %s' % e)
         finally:
@@ -324,6 +334,7 @@ class ImageCompareRecipeSelectView(ClassicRecipeSearchView):
 
         if form.is_valid():
             form.save()
+            recipe.layerbranch.branch.bump_generation()
             messages.success(request, 'Changes to image comparison recipe %s saved successfully.' % recipe.pn)
             return HttpResponseRedirect(reverse('image_comparison_recipe', args=(recipe.id,)))
         else:
@@ -360,6 +371,7 @@ class ImageCompareRecipeSelectDetailView(ClassicRecipeDetailView):
         form = ImageComparisonRecipeForm(request.POST, prefix='selectrecipedialog', instance=recipe)
         if form.is_valid():
             form.save()
+            recipe.layerbranch.branch.bump_generation()
             messages.success(request, 'Changes to image comparison recipe %s saved successfully.' % recipe.pn)
             return HttpResponseRedirect(reverse('image_comparison_recipe', args=(recipe.id,)))
         else:
@@ -278,6 +278,83 @@ RABBIT_BACKEND = 'rpc://layersrabbit/'
 # Used for fetching repo
 PARALLEL_JOBS = "4"
 
+# Maximum number of repositories to fetch from the same host at once
+# (0 = no limit other than PARALLEL_JOBS)
+FETCH_HOST_JOBS = 2
+
+# Number of times to retry a failed fetch (with an increasing delay)
+FETCH_RETRIES = 2
+
+# Check remote branch heads with "git ls-remote" and skip fetching
+# repositories where none of the branches we care about have changed
+FETCH_PRECHECK = True
+
+# Number of layers to update with each long-lived update_layer.py worker
+# process before it is restarted (0 = start a new process for every layer)
+UPDATE_WORKER_LAYERS = 0
+
+# Restart an update_layer.py worker process once its memory usage exceeds
+# this many megabytes (0 = no limit)
+UPDATE_WORKER_MAX_RSS = 0
+
+# Kill an update_layer.py worker process (failing the layer it was
+# updating) if a single layer takes longer than this many seconds
+# (0 = no limit)
+UPDATE_WORKER_TIMEOUT = 3600
+
+# Number of processes to use when parsing recipes within a layer during
+# update (1 = parse within the update process itself)
+RECIPE_PARSE_JOBS = 1
+
+# Cache values parsed from recipes (in LAYER_FETCH_DIR) so that recipes
+# which haven't changed don't need to be parsed again on reload
+RECIPE_PARSE_CACHE = True
+
+# Check out repositories into a separate git worktree for each branch
+# (under LAYER_FETCH_DIR/worktrees) rather than switching the single
+# checkout in LAYER_FETCH_DIR between branches
+LAYER_WORKTREES = False
+
+# Share git objects between repositories in LAYER_FETCH_DIR (via a bare
+# repository in LAYER_FETCH_DIR/shared-objects.git, which must not be
+# deleted once repositories have been cloned using it)
+LAYER_SHARED_OBJECTS = False
+
+# Clone repositories without file contents (fetched on demand when
+# checking out - requires git 2.19 or later on both ends)
+LAYER_PARTIAL_CLONE = False
+
+# Celery queue to send layer updates to when update.py is run with
+# --distributed (start workers with "-Q layerindex_update" on each machine
+# with a LAYER_FETCH_DIR that should take part)
+UPDATE_QUEUE = 'layerindex_update'
+
+# How long (in seconds) a worker should wait for the lock on its own
+# LAYER_FETCH_DIR before giving up on a layer update
+UPDATE_QUEUE_LOCK_TIMEOUT = 3600
+
+# Use the database's full-text index (created by migration 0046) when
+# searching recipe summaries and descriptions instead of substring matching.
+# Note that this matches the start of words only, so for example searching
+# for "ssl" will only find "openssl" in a description if nothing matches at
+# the start of a word (it will always be found in recipe names); set this to
+# False for the old behaviour
+RECIPE_FULLTEXT_SEARCH = True
+
+# Words that are never matched by the full-text index in addition to those
+# the database server reports (only needed with MySQL MyISAM tables, whose
+# built-in stopword list can't be read from the server)
+RECIPE_FULLTEXT_STOPWORDS = []
+
+# How long (in seconds) search box suggestions may be cached for, both
+# on the server and by the browser
+AUTOCOMPLETE_CACHE_TIMEOUT = 300
+
+# Maximum time (in seconds) to cache search results, statistics and other
+# expensive query results for. Cached results are discarded as soon as the
+# branch they relate to changes, so this just limits the space they use.
+QUERY_CACHE_TIMEOUT = 86400
+
 # Install flite & sox and set these to enable audio for CAPTCHA challenges (for accessibility)
 #CAPTCHA_FLITE_PATH = "/usr/bin/flite"
 #CAPTCHA_SOX_PATH = "/usr/bin/sox"
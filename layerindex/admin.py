@@ -132,6 +132,9 @@ class ClassicRecipeAdmin(admin.ModelAdmin):
         return False
     def has_delete_permission(self, request, obj=None):
         return False
+    def save_model(self, request, obj, form, change):
+        super(ClassicRecipeAdmin, self).save_model(request, obj, form, change)
+        obj.layerbranch.branch.bump_generation()
 
 class MachineAdmin(admin.ModelAdmin):
     search_fields = ['name']
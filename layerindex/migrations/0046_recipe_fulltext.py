@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Full-text index over recipe name, summary and description, used by
+# utils.recipe_fulltext_filter(). How this is done depends on the database
+# backend, so we can't use RunSQL directly.
+
+MYSQL_FORWARD = [
+    'CREATE FULLTEXT INDEX layerindex_recipe_fulltext ON layerindex_recipe (pn, summary, description)',
+]
+MYSQL_REVERSE = [
+    'DROP INDEX layerindex_recipe_fulltext ON layerindex_recipe',
+]
+
+POSTGRESQL_FORWARD = [
+    "CREATE INDEX layerindex_recipe_fulltext ON layerindex_recipe USING gin (to_tsvector('simple', pn || ' ' || summary || ' ' || description))",
+]
+POSTGRESQL_REVERSE = [
+    'DROP INDEX layerindex_recipe_fulltext',
+]
+
+# SQLite's FTS5 can't index an existing table directly, so we have a
+# separate "external content" table kept up-to-date by triggers
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE layerindex_recipe_fts USING fts5(pn, summary, description, content='layerindex_recipe', content_rowid='id')",
+    """CREATE TRIGGER layerindex_recipe_fts_ai AFTER INSERT ON layerindex_recipe BEGIN
+         INSERT INTO layerindex_recipe_fts(rowid, pn, summary, description) VALUES (new.id, new.pn, new.summary, new.description);
+       END""",
+    """CREATE TRIGGER layerindex_recipe_fts_ad AFTER DELETE ON layerindex_recipe BEGIN
+         INSERT INTO layerindex_recipe_fts(layerindex_recipe_fts, rowid, pn, summary, description) VALUES ('delete', old.id, old.pn, old.summary, old.description);
+       END""",
+    """CREATE TRIGGER layerindex_recipe_fts_au AFTER UPDATE ON layerindex_recipe BEGIN
+         INSERT INTO layerindex_recipe_fts(layerindex_recipe_fts, rowid, pn, summary, description) VALUES ('delete', old.id, old.pn, old.summary, old.description);
+         INSERT INTO layerindex_recipe_fts(rowid, pn, summary, description) VALUES (new.id, new.pn, new.summary, new.description);
+       END""",
+    "INSERT INTO layerindex_recipe_fts(layerindex_recipe_fts) VALUES ('rebuild')",
+]
+SQLITE_REVERSE = [
+    'DROP TRIGGER IF EXISTS layerindex_recipe_fts_ai',
+    'DROP TRIGGER IF EXISTS layerindex_recipe_fts_ad',
+    'DROP TRIGGER IF EXISTS layerindex_recipe_fts_au',
+    'DROP TABLE IF EXISTS layerindex_recipe_fts',
+]
+
+
+def run_statements(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def create_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        run_statements(schema_editor, MYSQL_FORWARD)
+    elif vendor == 'postgresql':
+        run_statements(schema_editor, POSTGRESQL_FORWARD)
+    elif vendor == 'sqlite':
+        from django.db import DatabaseError
+        try:
+            run_statements(schema_editor, SQLITE_FORWARD)
+        except DatabaseError:
+            # SQLite was built without FTS5 - searches will just be slower
+            run_statements(schema_editor, SQLITE_REVERSE)
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        run_statements(schema_editor, MYSQL_REVERSE)
+    elif vendor == 'postgresql':
+        run_statements(schema_editor, POSTGRESQL_REVERSE)
+    elif vendor == 'sqlite':
+        run_statements(schema_editor, SQLITE_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0045_layerupdate_timings'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, reverse_code=drop_fulltext_index),
+    ]
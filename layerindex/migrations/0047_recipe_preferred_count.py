@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.22 on 2019-08-21 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def calculate_preferred_counts(apps, schema_editor):
+    """Set the initial value of preferred_count (see Recipe.update_preferred_counts())"""
+    Branch = apps.get_model('layerindex', 'Branch')
+    Recipe = apps.get_model('layerindex', 'Recipe')
+    for branch in Branch.objects.all():
+        recipes = {}
+        for row in Recipe.objects.filter(layerbranch__branch=branch).values_list('id', 'pn', 'layerbranch_id', 'layerbranch__layer__layer_type', 'layerbranch__layer__index_preference'):
+            recipes.setdefault(row[1], []).append(row)
+        counts = {}
+        for pn, rows in recipes.items():
+            for recipe_id, _, layerbranch_id, _, preference in rows:
+                count = len([1 for row in rows if row[2] != layerbranch_id and row[3] in ('S', 'A') and row[4] > preference])
+                if count:
+                    counts.setdefault(count, []).append(recipe_id)
+        for count, ids in counts.items():
+            for i in range(0, len(ids), 500):
+                Recipe.objects.filter(id__in=ids[i:i + 500]).update(preferred_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0046_recipe_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='preferred_count',
+            field=models.IntegerField(default=0, editable=False, help_text='Number of recipes with the same name in more preferred software/base layers on the same branch'),
+        ),
+        migrations.RunPython(calculate_preferred_counts, reverse_code=migrations.RunPython.noop),
+    ]
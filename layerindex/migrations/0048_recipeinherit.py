@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.22 on 2019-08-23 11:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_recipe_inherits(apps, schema_editor):
+    Recipe = apps.get_model('layerindex', 'Recipe')
+    RecipeInherit = apps.get_model('layerindex', 'RecipeInherit')
+    inherits = []
+    for recipe_id, recipe_inherits in Recipe.objects.exclude(inherits='').values_list('id', 'inherits').iterator():
+        # bulk_create() doesn't truncate over-long values as save() would
+        for name in set([name[:100] for name in recipe_inherits.split()]):
+            inherits.append(RecipeInherit(recipe_id=recipe_id, name=name))
+        if len(inherits) >= 500:
+            RecipeInherit.objects.bulk_create(inherits)
+            inherits = []
+    RecipeInherit.objects.bulk_create(inherits)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0047_recipe_preferred_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeInherit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=100)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.Recipe')),
+            ],
+        ),
+        migrations.RunPython(populate_recipe_inherits, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.22 on 2019-08-29 16:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0049_name_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='branch',
+            name='generation',
+            field=models.IntegerField(default=0, editable=False, help_text='Incremented whenever data on the branch changes (used to invalidate cached results)'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.22 on 2019-09-02 10:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_duplicate_items(apps, schema_editor):
+    """Calculate the initial duplicates report (see DuplicateItem.update_branch())"""
+    Branch = apps.get_model('layerindex', 'Branch')
+    DuplicateItem = apps.get_model('layerindex', 'DuplicateItem')
+    itemmodels = [
+        ('R', apps.get_model('layerindex', 'Recipe'), 'pn'),
+        ('C', apps.get_model('layerindex', 'BBClass'), 'name'),
+        ('I', apps.get_model('layerindex', 'IncFile'), 'path'),
+    ]
+    for branch in Branch.objects.all():
+        items = []
+        for item_type, model, field in itemmodels:
+            init_qs = model.objects.filter(layerbranch__branch=branch)
+            dupes = init_qs.values(field).annotate(models.Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1).values(field)
+            for object_id, name, layerbranch_id in init_qs.filter(**{'%s__in' % field: dupes}).values_list('id', field, 'layerbranch_id'):
+                items.append(DuplicateItem(branch=branch, layerbranch_id=layerbranch_id, item_type=item_type, name=name, object_id=object_id))
+        DuplicateItem.objects.bulk_create(items, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0050_branch_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_type', models.CharField(choices=[('R', 'Recipe'), ('C', 'Class'), ('I', 'Include file')], max_length=1)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('object_id', models.IntegerField()),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.Branch')),
+                ('layerbranch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='layerindex.LayerBranch')),
+            ],
+        ),
+        migrations.RunPython(populate_duplicate_items, reverse_code=migrations.RunPython.noop),
+    ]
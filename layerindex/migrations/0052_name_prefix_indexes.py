@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Indexes for the case-insensitive prefix matches done by
+# autocomplete_view(). On MySQL the plain indexes added in 0049 already
+# serve these (the default collation is case-insensitive, so Django can use
+# a plain LIKE), but on PostgreSQL __istartswith becomes
+# UPPER(col) LIKE UPPER(...), which needs an index on the expression with
+# the pattern operator class to be usable. On SQLite the query is a scan
+# either way (Django's LIKE ... ESCAPE defeats SQLite's LIKE optimisation),
+# which is acceptable for development setups.
+
+PREFIX_INDEXES = [
+    ('layerindex_recipe', 'pn'),
+    ('layerindex_layeritem', 'name'),
+    ('layerindex_machine', 'name'),
+    ('layerindex_distro', 'name'),
+    ('layerindex_bbclass', 'name'),
+]
+
+POSTGRESQL_FORWARD = [
+    'CREATE INDEX %s_%s_upper_like ON %s (UPPER(%s) varchar_pattern_ops)' % (table, column, table, column)
+    for table, column in PREFIX_INDEXES
+]
+POSTGRESQL_REVERSE = [
+    'DROP INDEX IF EXISTS %s_%s_upper_like' % (table, column)
+    for table, column in PREFIX_INDEXES
+]
+
+
+def run_statements(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+def create_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        run_statements(schema_editor, POSTGRESQL_FORWARD)
+
+def drop_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        run_statements(schema_editor, POSTGRESQL_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0051_duplicateitem'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_indexes, reverse_code=drop_prefix_indexes),
+    ]
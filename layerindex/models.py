@@ -4,18 +4,19 @@
 #
 # Licensed under the MIT license, see COPYING.MIT for details
 
-from django.db import models
+from django.db import models, transaction
 from datetime import datetime
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.core.validators import URLValidator
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from collections import namedtuple
 import os.path
 import re
 import posixpath
 import codecs
+import json
 
 from . import utils
 
@@ -23,6 +24,18 @@ from . import utils
 logger = utils.logger_create('LayerIndexModels')
 
 
+def truncate_charfield_value(model, field, value, obj):
+    """
+    Truncate a value to fit the specified field (if it's a CharField),
+    with a warning mentioning obj. Used for anything that writes to the
+    database without going through save() (e.g. bulk_create() or update()),
+    which skips truncate_charfield_values().
+    """
+    if value and isinstance(field, models.CharField) and len(value) > field.max_length:
+        logger.warning('%s.%s: %s: length %s exceeds maximum (%s), truncating' % (model.__name__, field.name, str(obj), len(value), field.max_length))
+        return value[:field.max_length]
+    return value
+
 @receiver(pre_save)
 def truncate_charfield_values(sender, instance, *args, **kwargs):
     # Instead of leaving this up to the database, check and handle it
@@ -33,8 +46,7 @@ def truncate_charfield_values(sender, instance, *args, **kwargs):
         if isinstance(field, models.CharField):
             value = getattr(instance, field.name)
             if value and len(value) > field.max_length:
-                logger.warning('%s.%s: %s: length %s exceeds maximum (%s), truncating' % (instance.__class__.__name__, field.name, str(instance), len(value), field.max_length))
-                setattr(instance, field.name, value[:field.max_length])
+                setattr(instance, field.name, truncate_charfield_value(instance.__class__, field, value, instance))
 
 
 class PythonEnvironment(models.Model):
@@ -78,6 +90,7 @@ class Branch(models.Model):
     hidden = models.BooleanField('Hidden', default=False, help_text='Hide from normal selections')
 
     updated = models.DateTimeField(auto_now=True, blank=True, null=True)
+    generation = models.IntegerField(default=0, editable=False, help_text='Incremented whenever data on the branch changes (used to invalidate cached results)')
 
     class Meta:
         verbose_name_plural = "Branches"
@@ -86,6 +99,19 @@ class Branch(models.Model):
     def is_image_comparison(self):
         return self.imagecomparison_from_set.exists()
 
+    def bump_generation(self):
+        Branch.objects.filter(id=self.id).update(generation=models.F('generation') + 1)
+
+    def update_derived_data(self):
+        """
+        Recalculate the data derived from all of the recipes on the branch
+        together (see Recipe.update_preferred_counts() and
+        DuplicateItem.update_branch()). Needs to be called once after
+        recipes have been added or removed, by whatever added them.
+        """
+        Recipe.update_preferred_counts(self)
+        DuplicateItem.update_branch(self)
+
     def __str__(self):
         if self.comparison and self.short_description:
             return self.short_description
@@ -194,10 +220,30 @@ class LayerItem(models.Model):
     def get_absolute_url(self):
         return reverse('layer_item', args=('master',self.name));
 
+    def update_preferred_counts(self):
+        for branch in Branch.objects.filter(layerbranch__layer=self).distinct():
+            Recipe.update_preferred_counts(branch)
+
     def __str__(self):
         return self.name
 
 
+@receiver(pre_save, sender=LayerItem)
+def layeritem_check_preference(sender, instance, *args, **kwargs):
+    # Note whether the recipe preferred counts will need to be recalculated
+    instance._preference_changed = False
+    if instance.pk:
+        old = LayerItem.objects.filter(pk=instance.pk).values('index_preference', 'layer_type').first()
+        if old and (old['index_preference'] != instance.index_preference or old['layer_type'] != instance.layer_type):
+            instance._preference_changed = True
+
+@receiver(post_save, sender=LayerItem)
+def layeritem_update_preference(sender, instance, *args, **kwargs):
+    if getattr(instance, '_preference_changed', False):
+        instance.update_preferred_counts()
+        instance._preference_changed = False
+
+
 class LayerRecipeExtraURL(models.Model):
     layer = models.ForeignKey(LayerItem)
     name = models.CharField(max_length=50, help_text='Name to display for link')
@@ -373,6 +419,19 @@ class LayerBranch(models.Model):
         else:
             return deplist[1:]
 
+@receiver(post_save, sender=LayerBranch)
+@receiver(post_delete, sender=LayerBranch)
+def layerbranch_changed(sender, instance, *args, **kwargs):
+    Branch.objects.filter(id=instance.branch_id).update(generation=models.F('generation') + 1)
+
+@receiver(post_save, sender=LayerItem)
+@receiver(pre_delete, sender=LayerItem)
+def layeritem_changed(sender, instance, *args, **kwargs):
+    # Layer fields (e.g. status) affect results cached for each branch the
+    # layer is on. For deletion this has to happen beforehand, since the
+    # layer branches are gone by the time post_delete is sent.
+    Branch.objects.filter(layerbranch__layer=instance).update(generation=models.F('generation') + 1)
+
 class LayerMaintainer(models.Model):
     MAINTAINER_STATUS_CHOICES = (
         ('A', 'Active'),
@@ -412,6 +471,19 @@ class LayerNote(models.Model):
 
 
 class LayerUpdate(models.Model):
+    # Phases of a layer update that we record timings for, in order
+    TIMING_PHASES = [
+        ('fetch', 'Fetch'),
+        ('checkout', 'Checkout'),
+        ('init_parser', 'Parser startup'),
+        ('layerconf', 'layer.conf parse'),
+        ('scan', 'Tree scan'),
+        ('parse', 'Recipe parse'),
+        ('patches', 'Patch collection'),
+        ('db', 'Database writes'),
+        ('total', 'Total'),
+        ]
+
     layer = models.ForeignKey(LayerItem)
     branch = models.ForeignKey(Branch)
     update = models.ForeignKey(Update)
@@ -423,6 +495,7 @@ class LayerUpdate(models.Model):
     vcs_after_rev = models.CharField('Revision after', max_length=80, blank=True)
     log = models.TextField(blank=True)
     retcode = models.IntegerField(default=0)
+    timings = models.TextField(blank=True, help_text='Time taken by each phase of the update (JSON)')
 
     def layerbranch_exists(self):
         """Helper function for linking"""
@@ -442,6 +515,24 @@ class LayerUpdate(models.Model):
                 return layerbranch.commit_url(self.vcs_after_rev)
         return None
 
+    def get_timings(self):
+        """Get the recorded timings as a list of (phase description, seconds)"""
+        if not self.timings:
+            return []
+        try:
+            timings = json.loads(self.timings)
+        except ValueError:
+            return []
+        return [(desc, timings[phase]) for phase, desc in self.TIMING_PHASES if phase in timings]
+
+    def get_recipes_parsed(self):
+        if self.timings:
+            try:
+                return json.loads(self.timings).get('recipes_parsed', None)
+            except ValueError:
+                pass
+        return None
+
     def save(self):
         warnings = 0
         errors = 0
@@ -462,7 +553,7 @@ class Recipe(models.Model):
     layerbranch = models.ForeignKey(LayerBranch)
     filename = models.CharField(max_length=255)
     filepath = models.CharField(max_length=255, blank=True)
-    pn = models.CharField(max_length=100, blank=True)
+    pn = models.CharField(max_length=100, blank=True, db_index=True)
     pv = models.CharField(max_length=100, blank=True)
     summary = models.CharField(max_length=200, blank=True)
     description = models.TextField(blank=True)
@@ -476,6 +567,29 @@ class Recipe(models.Model):
     updated = models.DateTimeField(auto_now=True)
     blacklisted = models.CharField(max_length=255, blank=True)
     configopts = models.CharField(max_length=4096, blank=True)
+    preferred_count = models.IntegerField(default=0, editable=False, help_text='Number of recipes with the same name in more preferred software/base layers on the same branch')
+
+    @staticmethod
+    def update_preferred_counts(branch):
+        """
+        Recalculate preferred_count for all recipes on the specified branch.
+        Needs to be called whenever recipes are added or removed, or the
+        index_preference or type of a layer changes.
+        """
+        recipes = {}
+        for row in Recipe.objects.filter(layerbranch__branch=branch).values_list('id', 'pn', 'layerbranch_id', 'layerbranch__layer__layer_type', 'layerbranch__layer__index_preference', 'preferred_count'):
+            recipes.setdefault(row[1], []).append(row)
+        changed = {}
+        for pn, rows in recipes.items():
+            for recipe_id, _, layerbranch_id, _, preference, oldcount in rows:
+                count = len([1 for row in rows if row[2] != layerbranch_id and row[3] in ('S', 'A') and row[4] > preference])
+                if count != oldcount:
+                    changed.setdefault(count, []).append(recipe_id)
+        for count, ids in changed.items():
+            for i in range(0, len(ids), 500):
+                Recipe.objects.filter(id__in=ids[i:i + 500]).update(preferred_count=count)
+        if changed:
+            branch.bump_generation()
 
     def vcs_web_url(self):
         url = self.layerbranch.file_url(os.path.join(self.filepath, self.filename))
@@ -643,6 +757,13 @@ class DynamicBuildDep(models.Model):
     def __str__(self):
         return self.name
 
+class RecipeInherit(models.Model):
+    recipe = models.ForeignKey(Recipe)
+    name = models.CharField(max_length=100, db_index=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.recipe.pn, self.name)
+
 class RecipeFileDependency(models.Model):
     recipe = models.ForeignKey(Recipe)
     layerbranch = models.ForeignKey(LayerBranch, related_name='+')
@@ -733,7 +854,7 @@ class ComparisonRecipeUpdate(models.Model):
 
 class Machine(models.Model):
     layerbranch = models.ForeignKey(LayerBranch)
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     description = models.CharField(max_length=255)
 
     updated = models.DateTimeField(auto_now=True)
@@ -747,7 +868,7 @@ class Machine(models.Model):
 
 class Distro(models.Model):
     layerbranch = models.ForeignKey(LayerBranch)
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     description = models.CharField(max_length=255)
 
     updated = models.DateTimeField(auto_now=True)
@@ -788,7 +909,7 @@ class BBAppend(models.Model):
 
 class BBClass(models.Model):
     layerbranch = models.ForeignKey(LayerBranch)
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
 
     class Meta:
         verbose_name = "Class"
@@ -814,6 +935,71 @@ class IncFile(models.Model):
         return '%s (%s)' % (self.path, self.layerbranch.layer.name)
 
 
+class DuplicateItem(models.Model):
+    """
+    A recipe, class or include file that has the same name as one in
+    another layer on the same branch. These are recalculated for a whole
+    branch by update_branch() after each update, so that the duplicates
+    page doesn't have to search the entire branch every time.
+    """
+    ITEM_TYPE_CHOICES = (
+        ('R', 'Recipe'),
+        ('C', 'Class'),
+        ('I', 'Include file'),
+    )
+    branch = models.ForeignKey(Branch)
+    layerbranch = models.ForeignKey(LayerBranch, related_name='+')
+    item_type = models.CharField(max_length=1, choices=ITEM_TYPE_CHOICES)
+    name = models.CharField(max_length=255, db_index=True)
+    object_id = models.IntegerField()
+
+    @staticmethod
+    def update_branch(branch):
+        """
+        Recalculate the duplicates on the specified branch, adding and
+        removing only those items that have changed (and only bumping
+        the branch generation if there were any)
+        """
+        with transaction.atomic():
+            items = {}
+            for item_type, model, field in [('R', Recipe, 'pn'), ('C', BBClass, 'name'), ('I', IncFile, 'path')]:
+                init_qs = model.objects.filter(layerbranch__branch=branch)
+                dupes = init_qs.values(field).annotate(models.Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1).values(field)
+                for object_id, name, layerbranch_id in init_qs.filter(**{'%s__in' % field: dupes}).values_list('id', field, 'layerbranch_id'):
+                    items[(item_type, object_id)] = (name, layerbranch_id)
+            delete_ids = []
+            for item_id, item_type, object_id, name, layerbranch_id in DuplicateItem.objects.filter(branch=branch).values_list('id', 'item_type', 'object_id', 'name', 'layerbranch_id'):
+                if items.get((item_type, object_id), None) == (name, layerbranch_id):
+                    # Unchanged
+                    del items[(item_type, object_id)]
+                else:
+                    delete_ids.append(item_id)
+            for i in range(0, len(delete_ids), 500):
+                DuplicateItem.objects.filter(id__in=delete_ids[i:i + 500]).delete()
+            DuplicateItem.objects.bulk_create([DuplicateItem(branch=branch, layerbranch_id=layerbranch_id, item_type=item_type, name=name, object_id=object_id)
+                                               for (item_type, object_id), (name, layerbranch_id) in items.items()], batch_size=500)
+            if delete_ids or items:
+                branch.bump_generation()
+
+    @staticmethod
+    def get_items(branch, item_type, layer_ids=None):
+        """
+        Get the object ids of the duplicates of the specified type on the
+        branch, considering only the specified layers if any (as a
+        queryset suitable for use as a subquery)
+        """
+        init_qs = DuplicateItem.objects.filter(branch=branch, item_type=item_type)
+        if layer_ids:
+            # Only some of the items may still be duplicates within these layers
+            init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
+            dupes = init_qs.values('name').annotate(models.Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1).values('name')
+            init_qs = init_qs.filter(name__in=dupes)
+        return init_qs.values('object_id')
+
+    def __str__(self):
+        return '%s: %s (%s)' % (self.get_item_type_display(), self.name, self.layerbranch_id)
+
+
 class RecipeChangeset(models.Model):
     user = models.ForeignKey(User)
     name = models.CharField(max_length=255)
@@ -37,7 +37,7 @@ def init_parser(settings, branch, bitbakepath, enable_tracking=False, nocheckout
     os.environ['BB_ENV_EXTRAWHITE'] = 'DISABLE_SANITY_CHECKS'
     os.environ['DISABLE_SANITY_CHECKS'] = '1'
 
-    fetchdir = settings.LAYER_FETCH_DIR
+    fetchdir = utils.get_worktree_base(settings, branch.name)
 
     if not classic:
         # Ensure we have OE-Core set up to get some base configuration
@@ -97,14 +97,13 @@ def init_parser(settings, branch, bitbakepath, enable_tracking=False, nocheckout
 
     return (tinfoil, tempdir)
 
-def setup_layer(config_data, fetchdir, layerdir, layer, layerbranch, logger):
-    # Parse layer.conf files for this layer and its dependencies
-    # This is necessary not just because BBPATH needs to be set in order
-    # for include/require/inherit to work outside of the current directory
-    # or across layers, but also because custom variable values might be
-    # set in layer.conf.
-    config_data_copy = bb.data.createCopy(config_data)
-    utils.parse_layer_conf(layerdir, config_data_copy)
+def get_layer_dirs(fetchdir, layerdir, layer, layerbranch, logger, nocheckout=True):
+    # Get the list of layer directories whose layer.conf files need to be
+    # parsed for this layer - the layer itself followed by its dependencies.
+    # Unless nocheckout is True, the dependencies are checked out on the
+    # appropriate branch first (the layer itself is assumed to be already).
+    layerdirs = [layerdir]
+    checkedout = [os.path.join(fetchdir, layer.get_fetch_dir())]
     for dep in layerbranch.dependencies_set.all():
         depurldir = dep.dependency.get_fetch_dir()
         deprepodir = os.path.join(fetchdir, depurldir)
@@ -115,11 +114,40 @@ def setup_layer(config_data, fetchdir, layerdir, layer, layerbranch, logger):
             else:
                 logger.warning('Recommends %s of layer %s does not have branch record for branch %s - ignoring' % (dep.dependency.name, layer.name, layerbranch.branch.name))
                 continue
+        # The dependency may not have been checked out for this branch yet
+        # (or at all, if we're using a worktree per branch)
+        utils.ensure_worktree(deprepodir, logger=logger)
+        if not nocheckout and deprepodir not in checkedout:
+            utils.checkout_layer_branch(deplayerbranch, deprepodir, logger=logger)
+            checkedout.append(deprepodir)
         deplayerdir = os.path.join(deprepodir, deplayerbranch.vcs_subdir)
-        utils.parse_layer_conf(deplayerdir, config_data_copy)
+        if not utils.is_layer_valid(deplayerdir):
+            if dep.required:
+                raise RecipeParseError('conf/layer.conf not found for dependency %s of layer %s in %s' % (dep.dependency.name, layer.name, deplayerdir))
+            else:
+                logger.warning('conf/layer.conf not found for recommends %s of layer %s in %s - ignoring' % (dep.dependency.name, layer.name, deplayerdir))
+                continue
+        layerdirs.append(deplayerdir)
+    return layerdirs
+
+def setup_layer_dirs(config_data, layerdirs):
+    # Parse layer.conf files for a layer and its dependencies
+    # This is necessary not just because BBPATH needs to be set in order
+    # for include/require/inherit to work outside of the current directory
+    # or across layers, but also because custom variable values might be
+    # set in layer.conf.
+    config_data_copy = bb.data.createCopy(config_data)
+    for layerdir in layerdirs:
+        if not utils.is_layer_valid(layerdir):
+            raise RecipeParseError('conf/layer.conf not found in %s' % layerdir)
+        utils.parse_layer_conf(layerdir, config_data_copy)
     config_data_copy.delVar('LAYERDIR')
     return config_data_copy
 
+def setup_layer(config_data, fetchdir, layerdir, layer, layerbranch, logger):
+    layerdirs = get_layer_dirs(fetchdir, layerdir, layer, layerbranch, logger)
+    return setup_layer_dirs(config_data, layerdirs)
+
 machine_conf_re = re.compile(r'conf/machine/([^/.]*).conf$')
 distro_conf_re = re.compile(r'conf/distro/([^/.]*).conf$')
 bbclass_re = re.compile(r'classes/([^/.]*).bbclass$')
@@ -156,54 +184,172 @@ def detect_file_type(path, subdir_start):
 
     return (None, None, None)
 
+def get_tree_files(commit, subdir=''):
+    """
+    Get the paths (relative to the root of the repository) of all files in
+    the specified commit, optionally only those under subdir. This reads
+    the git tree objects directly, so the result does not depend on what
+    is currently checked out.
+    """
+    tree = commit.tree
+    if subdir:
+        try:
+            tree = tree / subdir.rstrip('/')
+        except KeyError:
+            return []
+    return [item.path for item in tree.traverse() if item.type == 'blob']
+
+def read_tree_file(commit, path):
+    """
+    Read the contents of a file in the specified commit (regardless of
+    what is currently checked out)
+    """
+    return (commit.tree / path).data_stream.read().decode('utf-8', errors='replace')
+
+def get_sublayer_dirs(paths, subdir_start):
+    """
+    Get the directories within a layer (given the paths of the files within
+    it) that are themselves layers, i.e. contain conf/layer.conf
+    """
+    sublayer_dirs = []
+    for path in paths:
+        if path.endswith('/conf/layer.conf'):
+            dirpath = path[:-len('conf/layer.conf')]
+            if dirpath != subdir_start and dirpath.startswith(subdir_start):
+                sublayer_dirs.append(dirpath)
+    return sublayer_dirs
 
-def handle_recipe_depends(recipe, depends, packageconfig_opts, logger):
-    from layerindex.models import StaticBuildDep, PackageConfig, DynamicBuildDep
-
-    # Handle static build dependencies for this recipe
-    staticdeps = list(recipe.staticbuilddep_set.values_list('name', flat=True))
-    for dep in depends.split():
-        static_build_dependency, created = StaticBuildDep.objects.get_or_create(name=dep)
-        if created:
-            static_build_dependency.save()
-        static_build_dependency.recipes.add(recipe)
-        if dep in staticdeps:
-            staticdeps.remove(dep)
-    for dep in staticdeps:
-        StaticBuildDep.objects.get(name=dep).recipes.remove(recipe)
-
-    # Handle the PACKAGECONFIG variables for this recipe
-    dynamicdeps = list(recipe.dynamicbuilddep_set.values_list('name', flat=True))
-    PackageConfig.objects.filter(recipe=recipe).delete()
-    for key, value in packageconfig_opts.items():
-        if key == "doc":
+def scan_layer(repodir, subdir, commit=None):
+    """
+    Find and classify the files in a layer, skipping any layers within it.
+    If commit is specified the file list is read from git rather than from
+    the working tree (though note that the files still need to be checked
+    out in order for bitbake to parse them). Returns a tuple of
+    a list of (typename, filepath, filename, path) for each file of a
+    recognised type and a list of sublayer directories; all paths are
+    relative to repodir.
+    """
+    if subdir:
+        subdir_start = os.path.normpath(subdir) + os.sep
+    else:
+        subdir_start = ''
+    if commit:
+        paths = get_tree_files(commit, subdir)
+    else:
+        paths = []
+        for root, dirs, files in os.walk(os.path.join(repodir, subdir)):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for f in files:
+                paths.append(os.path.relpath(os.path.join(root, f), repodir))
+
+    sublayer_dirs = get_sublayer_dirs(paths, subdir_start)
+    layer_files = []
+    for path in paths:
+        skip = False
+        for sublayer_dir in sublayer_dirs:
+            if path.startswith(sublayer_dir):
+                skip = True
+                break
+        if skip:
             continue
-        package_config = PackageConfig()
-        package_config.feature = key
-        package_config.recipe = recipe
-        package_config_vals = value.split(",")
-        try:
-            package_config.build_deps = package_config_vals[2]
-        except IndexError:
-            pass
-        try:
-            package_config.with_option = package_config_vals[0]
-        except IndexError:
-            pass
-        try:
-            package_config.without_option = package_config_vals[1]
-        except IndexError:
-            pass
-        package_config.save()
-        # Handle the dynamic dependencies for the PACKAGECONFIG variable
-        if package_config.build_deps:
-            for dep in package_config.build_deps.split():
-                dynamic_build_dependency, created = DynamicBuildDep.objects.get_or_create(name=dep)
-                if created:
-                    dynamic_build_dependency.save()
-                dynamic_build_dependency.package_configs.add(package_config)
-                dynamic_build_dependency.recipes.add(recipe)
-                if dep in dynamicdeps:
-                    dynamicdeps.remove(dep)
-    for dep in dynamicdeps:
-        DynamicBuildDep.objects.get(name=dep).recipes.remove(recipe)
+        (typename, filepath, filename) = detect_file_type(path, subdir_start)
+        if typename:
+            layer_files.append((typename, filepath, filename, path))
+    return (layer_files, sublayer_dirs)
+
+
+class RecipeDependencySync:
+    """
+    Brings the static/dynamic build dependencies and PACKAGECONFIG records
+    of recipes into line with their parsed values. Dependency names are
+    looked up once and remembered, and the many-to-many relations are
+    updated with bulk operations on the through tables, touching only the
+    rows that have actually changed.
+
+    The names looked up are remembered for the rest of the process (e.g.
+    across all of the layers a worker updates), but only once the
+    transaction they were looked up in has been committed, since the ids
+    aren't valid if it gets rolled back. Until then each instance has its
+    own copy, so an instance should only be used for a single batch of
+    updates.
+    """
+    # Ids of committed names for each model, shared by all instances
+    committed_ids = {}
+
+    def __init__(self):
+        self.static_ids = {}
+        self.dynamic_ids = {}
+
+    def _get_ids(self, model, cache, names):
+        from django.db import transaction
+        committed = RecipeDependencySync.committed_ids.setdefault(model.__name__, {})
+        missing = [name for name in names if name not in cache and name not in committed]
+        if missing:
+            found = {}
+            # Names aren't unique, so if there are duplicates use the oldest
+            for name, depid in model.objects.filter(name__in=missing).order_by('-id').values_list('name', 'id'):
+                found[name] = depid
+            for name in missing:
+                if name not in found:
+                    found[name] = model.objects.create(name=name).id
+            cache.update(found)
+            transaction.on_commit(lambda: committed.update(found))
+        return set([cache[name] if name in cache else committed[name] for name in names])
+
+    def _sync_links(self, through, fromfield, fromid, tofield, toids):
+        existing = set(through.objects.filter(**{fromfield: fromid}).values_list(tofield, flat=True))
+        removed = existing - toids
+        if removed:
+            through.objects.filter(**{fromfield: fromid, '%s__in' % tofield: removed}).delete()
+        added = toids - existing
+        if added:
+            through.objects.bulk_create([through(**{fromfield: fromid, tofield: toid}) for toid in added])
+
+    def sync(self, recipe, depends, packageconfig_opts):
+        from layerindex.models import StaticBuildDep, PackageConfig, DynamicBuildDep
+
+        # Handle static build dependencies for this recipe
+        staticdep_ids = self._get_ids(StaticBuildDep, self.static_ids, set(depends.split()))
+        self._sync_links(StaticBuildDep.recipes.through, 'recipe_id', recipe.id, 'staticbuilddep_id', staticdep_ids)
+
+        # Handle the PACKAGECONFIG variables for this recipe
+        package_configs = {}
+        for package_config in PackageConfig.objects.filter(recipe=recipe).order_by('id'):
+            if package_config.feature in package_configs or package_config.feature not in packageconfig_opts or package_config.feature == 'doc':
+                package_config.delete()
+            else:
+                package_configs[package_config.feature] = package_config
+        dynamicdep_ids = set()
+        for key, value in packageconfig_opts.items():
+            if key == "doc":
+                continue
+            package_config_vals = value.split(",")
+            fields = {'with_option': '', 'without_option': '', 'build_deps': ''}
+            for i, field in enumerate(['with_option', 'without_option', 'build_deps']):
+                if i < len(package_config_vals):
+                    fields[field] = package_config_vals[i]
+            package_config = package_configs.get(key, None)
+            if package_config is None:
+                package_config = PackageConfig(recipe=recipe, feature=key, **fields)
+                package_config.save()
+            elif any([getattr(package_config, field) != fieldvalue for field, fieldvalue in fields.items()]):
+                for field, fieldvalue in fields.items():
+                    setattr(package_config, field, fieldvalue)
+                package_config.save()
+            # Handle the dynamic dependencies for the PACKAGECONFIG variable
+            config_dep_ids = self._get_ids(DynamicBuildDep, self.dynamic_ids, set(package_config.build_deps.split()))
+            self._sync_links(DynamicBuildDep.package_configs.through, 'packageconfig_id', package_config.id, 'dynamicbuilddep_id', config_dep_ids)
+            dynamicdep_ids.update(config_dep_ids)
+        self._sync_links(DynamicBuildDep.recipes.through, 'recipe_id', recipe.id, 'dynamicbuilddep_id', dynamicdep_ids)
+
+
+def handle_recipe_depends(recipe, depends, packageconfig_opts, logger, depsync=None):
+    """
+    Update the build dependencies and PACKAGECONFIG records for a recipe. If
+    a number of recipes are being updated, pass in a RecipeDependencySync
+    so that dependency lookups are shared between them.
+    """
+    if depsync is None:
+        depsync = RecipeDependencySync()
+    depsync.sync(recipe, depends, packageconfig_opts)
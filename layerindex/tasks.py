@@ -73,6 +73,69 @@ def run_update_command(self, branch_name, update_command):
     return {'retcode': retcode, 'output': erroutput}
 
 
+@tasks.task
+def update_layer(layerupdate_id, update_command, fetch_repos, branch_name, checkout_layers):
+    """
+    Update a single layer on behalf of update.py running in distributed
+    mode. The repositories the update needs are fetched into this worker's
+    own LAYER_FETCH_DIR first, and the layers in checkout_layers are then
+    checked out on the branch as update.py would have done.
+    """
+    utils.setup_django()
+    from layerindex.models import LayerItem, LayerUpdate
+    fetchdir = settings.LAYER_FETCH_DIR
+    if not os.path.exists(fetchdir):
+        os.makedirs(fetchdir)
+    # Only one update at a time per fetch directory
+    lockfn = os.path.join(fetchdir, "layerindex.lock")
+    lockfile = utils.lock_file(lockfn, getattr(settings, 'UPDATE_QUEUE_LOCK_TIMEOUT', 3600))
+    if not lockfile:
+        return {'retcode': 1, 'output': 'ERROR: Layer index lock timeout expired\n'}
+    output = ''
+    retcode = 0
+    try:
+        fetchstart = time.time()
+        for vcs_url, urldir in fetch_repos:
+            repodir = os.path.join(fetchdir, urldir)
+            try:
+                if not os.path.exists(repodir):
+                    utils.clone_repo(vcs_url, urldir, fetchdir, printerr=False)
+                else:
+                    utils.runcmd(['git', 'fetch', '-p'], repodir, printerr=False)
+            except subprocess.CalledProcessError as e:
+                output += 'WARNING: fetch of %s failed: %s\n' % (vcs_url, e.output)
+        output += utils.format_timings({'fetch': time.time() - fetchstart}) + '\n'
+        checkoutdir = utils.get_worktree_base(settings, branch_name)
+        for layer in LayerItem.objects.filter(name__in=checkout_layers):
+            layerbranch = layer.get_layerbranch(branch_name)
+            if not layerbranch:
+                continue
+            repodir = os.path.join(checkoutdir, layer.get_fetch_dir())
+            try:
+                utils.ensure_worktree(repodir)
+                utils.checkout_layer_branch(layerbranch, repodir)
+            except subprocess.CalledProcessError as e:
+                output += 'WARNING: checkout of %s failed: %s\n' % (layer.name, e.output)
+        try:
+            output += utils.runcmd(update_command, os.path.dirname(__file__), shell=True, printerr=False)
+        except subprocess.CalledProcessError as e:
+            output += e.output
+            retcode = e.returncode
+    finally:
+        utils.unlock_file(lockfile)
+
+    if layerupdate_id:
+        layerupdate = LayerUpdate.objects.get(id=layerupdate_id)
+        layerupdate.finished = datetime.now()
+        layerupdate.log = utils.extract_timings(output)[0]
+        layerupdate.retcode = retcode
+        layerbranch = layerupdate.layer.get_layerbranch(layerupdate.branch.name)
+        if layerbranch:
+            layerupdate.vcs_after_rev = layerbranch.vcs_last_rev
+        layerupdate.save()
+    return {'retcode': retcode, 'output': output}
+
+
 @tasks.task
 def generate_version_comparison(vercmp_id):
     from distutils.version import LooseVersion
@@ -195,6 +195,8 @@ def main():
             layerbranch.vcs_last_fetch = datetime.now()
             layerbranch.save()
 
+            layerbranch.branch.update_derived_data()
+
             if options.dryrun:
                 raise DryRunRollbackException()
     except DryRunRollbackException:
@@ -302,7 +302,7 @@ def main():
             out = None
             try:
                 if not os.path.exists(repodir):
-                    out = utils.runcmd(['git', 'clone', layer.vcs_url, urldir], fetchdir, logger=logger)
+                    out = utils.clone_repo(layer.vcs_url, urldir, fetchdir, logger=logger)
                 else:
                     out = utils.runcmd(['git', 'fetch'], repodir, logger=logger)
             except Exception as e:
@@ -469,6 +469,10 @@ def main():
                 logger.error('No layers added.')
                 sys.exit(1);
 
+            # This won't have added any recipes, but the new layer's
+            # type and preference could still affect the existing ones
+            master_branch.update_derived_data()
+
             if options.dryrun:
                 raise DryRunRollbackException()
     except DryRunRollbackException:
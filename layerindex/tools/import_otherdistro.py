@@ -28,6 +28,7 @@ sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), 'lib
 
 import utils
 import recipeparse
+from updatewriter import RecipeRowWriter
 
 logger = utils.logger_create('LayerIndexOtherDistro')
 
@@ -374,10 +375,10 @@ def update_recipe_file(path, recipe, repodir, raiseexceptions=False):
         recipe.sha256sum = utils.sha256_file(path)
         recipe.save()
 
-        saved_patches = []
+        patchwriter = RecipeRowWriter(Patch, recipe, ('path',), ('src_path', 'apply_order', 'applied', 'striplevel', 'sha256sum'))
         for index, patchfn in patches:
             patchpath = os.path.join(os.path.relpath(os.path.dirname(path), repodir), patchfn)
-            patch, _ = Patch.objects.get_or_create(recipe=recipe, path=patchpath)
+            patch = Patch(recipe=recipe, path=patchpath)
             if autopatch is not None:
                 patch.striplevel = int(autopatch)
             elif index in applypatches:
@@ -401,25 +402,27 @@ def update_recipe_file(path, recipe, repodir, raiseexceptions=False):
                 patch.sha256sum = utils.sha256_file(os.path.join(os.path.dirname(path), patchfn))
             except FileNotFoundError:
                 patch.sha256sum = ''
-            patch.save()
-            saved_patches.append(patch.id)
-        recipe.patch_set.exclude(id__in=saved_patches).delete()
-
-        existing_ids = list(recipe.source_set.values_list('id', flat=True))
+            patchwriter.set(path=patch.path,
+                            src_path=patch.src_path,
+                            apply_order=patch.apply_order,
+                            applied=patch.applied,
+                            striplevel=patch.striplevel,
+                            sha256sum=patch.sha256sum)
+        patchwriter.delete_unseen()
+        patchwriter.flush()
+
+        # Only changed sources are written, and deletions are done in chunks
+        # (some spec files have a lot of sources!)
+        sourcewriter = RecipeRowWriter(Source, recipe, ('url',), ('sha256sum',))
         for src in sources:
-            srcobj, _ = Source.objects.get_or_create(recipe=recipe, url=src)
+            sha256sum = ''
             if not '://' in src:
                 sourcepath = os.path.join(os.path.dirname(path), src)
                 if os.path.exists(sourcepath):
-                    srcobj.sha256sum = utils.sha256_file(sourcepath)
-                else:
-                    srcobj.sha256sum = ''
-            srcobj.save()
-            if srcobj.id in existing_ids:
-                existing_ids.remove(srcobj.id)
-        # Need to delete like this because some spec files have a lot of sources!
-        for idv in existing_ids:
-            Source.objects.filter(id=idv).delete()
+                    sha256sum = utils.sha256_file(sourcepath)
+            sourcewriter.set(url=src, sha256sum=sha256sum)
+        sourcewriter.delete_unseen()
+        sourcewriter.flush()
     except DatabaseError:
         raise
     except KeyboardInterrupt:
@@ -974,6 +977,10 @@ def main():
 
     ret = args.func(args)
 
+    if not ret and not getattr(args, 'dry_run', True):
+        # Recipes may have been added or removed
+        utils.get_branch(args.branch).update_derived_data()
+
     return ret
 
 if __name__ == "__main__":
@@ -318,6 +318,9 @@ def main():
                     rupdate.link_updated = True
                     rupdate.save()
 
+            # Once for the whole update (see Branch.generation)
+            layerbranch.branch.bump_generation()
+
             if args.dry_run:
                 raise DryRunRollbackException()
     except DryRunRollbackException:
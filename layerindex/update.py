@@ -13,13 +13,17 @@ import os
 import optparse
 import codecs
 import logging
-import subprocess
+import json
+import tempfile
 from datetime import datetime, timedelta
 from distutils.version import LooseVersion
 import utils
 import operator
 import re
-import multiprocessing
+from updatecache import LayerConfCache
+from updateworker import UpdateWorkerPool
+from updatefetch import FetchPlanner
+from updatequeue import BrokerLock, LayerUpdateQueue
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -35,12 +39,14 @@ except ImportError:
 
 
 def prepare_update_layer_command(options, branch, layer, initial=False):
-    """Prepare the update_layer.py command line"""
+    """Prepare the update_layer.py command line (layer can be None for worker mode)"""
     if branch.update_environment:
         cmdprefix = branch.update_environment.get_command()
     else:
         cmdprefix = 'python3'
-    cmd = '%s update_layer.py -l %s -b %s' % (cmdprefix, layer.name, branch.name)
+    cmd = '%s update_layer.py -b %s' % (cmdprefix, branch.name)
+    if layer:
+        cmd += ' -l %s' % layer.name
     if options.reload:
         cmd += ' --reload'
     if options.fullreload:
@@ -59,6 +65,9 @@ def prepare_update_layer_command(options, branch, layer, initial=False):
         cmd += ' --keep-temp'
     if options.stop_on_error:
         cmd += ' --stop-on-error'
+    if options.profile and not initial:
+        cmd += ' --profile'
+    cmd += ' --no-derived-data'
     return cmd
 
 def update_actual_branch(layerquery, fetchdir, branch, options, update_bitbake, bitbakepath):
@@ -99,18 +108,6 @@ def update_actual_branch(layerquery, fetchdir, branch, options, update_bitbake,
         for s in to_save:
             s.save()
 
-def fetch_repo(vcs_url, repodir, urldir, fetchdir, layer_name):
-    logger.info("Fetching remote repository %s" % vcs_url)
-    try:
-        if not os.path.exists(repodir):
-            utils.runcmd(['git', 'clone', vcs_url, urldir], fetchdir, logger=logger, printerr=False)
-        else:
-            utils.runcmd(['git', 'fetch', '-p'], repodir, logger=logger, printerr=False)
-        return (vcs_url, None)
-    except subprocess.CalledProcessError as e:
-        logger.error("Fetch of layer %s failed: %s" % (layer_name, e.output))
-        return (vcs_url, e.output)
-
 def print_subdir_error(newbranch, layername, vcs_subdir, branchdesc):
     # This will error out if the directory is completely invalid or had never existed at this point
     # If it previously existed but has since been deleted, you will get the revision where it was
@@ -120,12 +117,26 @@ def print_subdir_error(newbranch, layername, vcs_subdir, branchdesc):
     elif vcs_subdir:
         logger.error("Subdirectory for layer %s does not exist on branch %s - if this is legitimate, the layer branch record should be deleted" % (layername, branchdesc))
 
-def extract_value(valuename, output):
-    res = re.search("^%s = \"(.*)\"" % valuename, output, re.M)
-    if res:
-        return res.group(1) or ''
-    else:
-        return ''
+def run_update_layer_command(cmd):
+    """
+    Run an update_layer.py command line, returning the return code, the
+    output and the result that it wrote out (a dict - see
+    LayerUpdateResult.to_dict() - or None if it didn't get that far)
+    """
+    fd, resultfn = tempfile.mkstemp(prefix='layerupdate-', suffix='.json')
+    os.close(fd)
+    try:
+        cmd += ' --result-file %s' % resultfn
+        logger.debug('Running layer update command: %s' % cmd)
+        ret, output = utils.run_command_interruptible(cmd)
+        result = None
+        with open(resultfn, 'r') as f:
+            data = f.read()
+        if data:
+            result = json.loads(data)
+        return ret, output, result
+    finally:
+        os.remove(resultfn)
 
 def main():
     if LooseVersion(git.__version__) < '0.3.1':
@@ -176,6 +187,12 @@ def main():
     parser.add_option("", "--keep-temp",
             help = "Preserve temporary directory at the end instead of deleting it",
             action="store_true")
+    parser.add_option("", "--profile",
+            help = "Profile each layer update, writing the data to files in TASK_LOG_DIR",
+            action="store_true")
+    parser.add_option("", "--distributed",
+            help = "Send layer updates to Celery workers instead of running them locally (see UPDATE_QUEUE in settings.py)",
+            action="store_true", dest="distributed")
 
     options, args = parser.parse_args(sys.argv)
     if len(args) > 1:
@@ -186,6 +203,8 @@ def main():
     utils.setup_django()
     import settings
     from layerindex.models import Branch, LayerItem, Update, LayerUpdate, LayerBranch
+    from django.db import transaction
+    from django.db.models import Q
 
     logger.setLevel(options.loglevel)
 
@@ -239,10 +258,10 @@ def main():
     if not os.path.exists(fetchdir):
         os.makedirs(fetchdir)
 
-    allrepos = {}
-    fetchedresult = []
     fetchedrepos = []
     failedrepos = {}
+    # Time taken to fetch each repository, by repodir
+    fetch_timings = {}
 
     # We don't want git to prompt for any passwords (e.g. when accessing renamed/hidden github repos)
     os.environ['SSH_ASKPASS'] = ''
@@ -262,11 +281,33 @@ def main():
     if not options.dryrun:
         update.save()
     try:
+        brokerlock = None
+        if options.distributed:
+            # The lock file only works within this machine
+            brokerlock = BrokerLock(settings.RABBIT_BROKER, 'layerindex.update.lock', logger)
+            if not brokerlock.acquire(options.timeout):
+                logger.error("Layer index broker lock timeout expired")
+                sys.exit(1)
+        # We give up layerindex.lock while workers on this machine are updating
+        # layers in distributed mode, so hold this one for the whole run to
+        # ensure only one update runs at a time
+        updatelockfn = os.path.join(fetchdir, "layerindex-update.lock")
+        updatelockfile = utils.lock_file(updatelockfn, options.timeout, logger)
+        if not updatelockfile:
+            logger.error("Layer index update lock timeout expired")
+            if brokerlock:
+                brokerlock.release()
+            sys.exit(1)
         lockfn = os.path.join(fetchdir, "layerindex.lock")
         lockfile = utils.lock_file(lockfn, options.timeout, logger)
         if not lockfile:
             logger.error("Layer index lock timeout expired")
+            utils.unlock_file(updatelockfile)
+            if brokerlock:
+                brokerlock.release()
             sys.exit(1)
+        worker_pool = None
+        update_queue = None
         try:
             bitbakepath = os.path.join(fetchdir, 'bitbake')
 
@@ -278,28 +319,41 @@ def main():
                 else:
                     layerquery_fetch = list(layerquery) + list(layerquery_core)
                 # Fetch latest metadata from repositories
+                fetchplanner = FetchPlanner(int(settings.PARALLEL_JOBS),
+                                            host_jobs=int(getattr(settings, 'FETCH_HOST_JOBS', 0)),
+                                            retries=int(getattr(settings, 'FETCH_RETRIES', 0)),
+                                            precheck=getattr(settings, 'FETCH_PRECHECK', True))
+                branchobjs = Branch.objects.filter(name__in=branches)
                 for layer in layerquery_fetch:
                     # Handle multiple layers in a single repo
                     urldir = layer.get_fetch_dir()
                     repodir = os.path.join(fetchdir, urldir)
-                    if layer.vcs_url not in allrepos:
-                        allrepos[layer.vcs_url] = (repodir, urldir, fetchdir, layer.name)
+                    # Only changes to branches we're interested in should trigger a fetch
+                    fetchbranches = set(branches)
+                    for layerbranch in layer.layerbranch_set.filter(branch__in=branchobjs):
+                        if layerbranch.actual_branch:
+                            fetchbranches.add(layerbranch.actual_branch)
+                    if options.actual_branch:
+                        fetchbranches.add(options.actual_branch)
+                    fetchplanner.add(layer.vcs_url, repodir, urldir, fetchdir, layer.name, fetchbranches)
                 # Add bitbake
-                allrepos[settings.BITBAKE_REPO_URL] = (bitbakepath, "bitbake", fetchdir, "bitbake")
+                fetchbranches = set(['master'])
+                for branchobj in Branch.objects.filter(Q(name__in=branches) | Q(name='master')):
+                    if branchobj.bitbake_branch and not re.match('[0-9a-f]{40}', branchobj.bitbake_branch):
+                        fetchbranches.add(branchobj.bitbake_branch)
+                if options.actual_branch:
+                    fetchbranches.add(options.actual_branch)
+                fetchplanner.add(settings.BITBAKE_REPO_URL, bitbakepath, "bitbake", fetchdir, "bitbake", fetchbranches)
                 # Parallel fetching
-                pool = multiprocessing.Pool(int(settings.PARALLEL_JOBS))
-                for url in allrepos:
-                    fetchedresult.append(pool.apply_async(fetch_repo, \
-                        (url, allrepos[url][0], allrepos[url][1], allrepos[url][2], allrepos[url][3],)))
-                pool.close()
-                pool.join()
-
-                for url in fetchedresult[:]:
-                    # The format is (url, error), the error is None when succeed.
-                    if url.get()[1]:
-                        failedrepos[url.get()[0]] = url.get()[1]
+                fetchedresult = fetchplanner.run()
+                fetch_timings = fetchplanner.timings
+
+                for url, error in fetchedresult.items():
+                    # The error is None when succeed.
+                    if error:
+                        failedrepos[url] = error
                     else:
-                        fetchedrepos.append(url.get()[0])
+                        fetchedrepos.append(url)
 
                 if not (fetchedrepos or update_bitbake):
                     logger.error("No repositories could be fetched, exiting")
@@ -320,8 +374,25 @@ def main():
             # unreliable due to leaking memory (we're using bitbake internals in a manner in which
             # they never get used during normal operation).
             failed_layers = {}
+            layerconf_cache = LayerConfCache(fetchdir, logger=logger)
+            worker_layers = int(getattr(settings, 'UPDATE_WORKER_LAYERS', 0))
+            if worker_layers > 0:
+                # Amortise bitbake startup across several layers per process
+                worker_max_rss = int(getattr(settings, 'UPDATE_WORKER_MAX_RSS', 0)) * 1024 * 1024
+                worker_pool = UpdateWorkerPool(lambda branchobj: prepare_update_layer_command(options, branchobj, None),
+                                               worker_layers, worker_max_rss, logger,
+                                               timeout=int(getattr(settings, 'UPDATE_WORKER_TIMEOUT', 3600)))
+            if options.distributed:
+                update_queue = LayerUpdateQueue(getattr(settings, 'UPDATE_QUEUE', 'layerindex_update'), logger)
             for branch in branches:
+                if worker_pool:
+                    # We're about to check out layers and bitbake, which any
+                    # worker still running would not notice
+                    worker_pool.shutdown()
                 failed_layers[branch] = []
+                # Collections provided by each layer and those it depends upon
+                layer_collections = {}
+                layer_depcols = {}
                 # If layer_A depends(or recommends) on layer_B, add layer_B before layer_A
                 deps_dict_all = {}
                 layerquery_sorted = []
@@ -402,9 +473,10 @@ def main():
                         continue
                     else:
                         # Check out appropriate branch
+                        checkoutdir = os.path.join(utils.get_worktree_base(settings, branch), urldir)
                         if not options.nocheckout:
-                            utils.checkout_layer_branch(layerbranch, repodir, logger=logger)
-                        layerdir = os.path.join(repodir, layerbranch.vcs_subdir)
+                            utils.checkout_layer_branch(layerbranch, checkoutdir, logger=logger)
+                        layerdir = os.path.join(checkoutdir, layerbranch.vcs_subdir)
                         if layerbranch.vcs_subdir and not os.path.exists(layerdir):
                             print_subdir_error(newbranch, layer.name, layerbranch.vcs_subdir, branchdesc)
                             continue
@@ -413,36 +485,53 @@ def main():
                             logger.error("conf/layer.conf not found for layer %s - is subdirectory set correctly?" % layer.name)
                             continue
 
-                    cmd = prepare_update_layer_command(options, branchobj, layer, initial=True)
-                    logger.debug('Running layer update command: %s' % cmd)
-                    ret, output = utils.run_command_interruptible(cmd)
-                    logger.debug('output: %s' % output)
-                    if ret == 254:
-                        # Interrupted by user, break out of loop
-                        logger.info('Update interrupted, exiting')
-                        sys.exit(254)
-                    elif ret != 0:
-                        output = output.rstrip()
-                        # Save a layerupdate here or we won't see this output
-                        layerupdate = LayerUpdate()
-                        layerupdate.update = update
-                        layerupdate.layer = layer
-                        layerupdate.branch = branchobj
-                        layerupdate.started = datetime.now()
-                        layerupdate.log = output
-                        layerupdate.retcode = ret
-                        if not options.dryrun:
-                            layerupdate.save()
-                        continue
+                    # Avoid starting up bitbake just to read layer.conf if it hasn't changed
+                    layerconf_key = LayerConfCache.get_key(topcommit, layerbranch)
+                    layerconf_values = None
+                    if layerconf_key:
+                        layerconf_values = layerconf_cache.get(layerconf_key)
+                    if layerconf_values:
+                        logger.debug('Using cached layer.conf values for layer %s' % layer.name)
+                    else:
+                        # NOTE: this deliberately doesn't use worker_pool - we check out
+                        # a different bitbake revision below, which a long-lived worker
+                        # would not notice
+                        cmd = prepare_update_layer_command(options, branchobj, layer, initial=True)
+                        ret, output, result = run_update_layer_command(cmd)
+                        logger.debug('output: %s' % output)
+                        if ret == 254:
+                            # Interrupted by user, break out of loop
+                            logger.info('Update interrupted, exiting')
+                            sys.exit(254)
+                        elif ret != 0:
+                            output = output.rstrip()
+                            # Save a layerupdate here or we won't see this output
+                            layerupdate = LayerUpdate()
+                            layerupdate.update = update
+                            layerupdate.layer = layer
+                            layerupdate.branch = branchobj
+                            layerupdate.started = datetime.now()
+                            layerupdate.log = output
+                            layerupdate.retcode = ret
+                            if not options.dryrun:
+                                layerupdate.save()
+                            continue
 
-                    col = extract_value('BBFILE_COLLECTIONS', output)
-                    if not col:
-                        logger.error('Unable to find BBFILE_COLLECTIONS value in initial output')
-                        # Assume (perhaps naively) that it's an error specific to the layer
-                        continue
-                    ver = extract_value('LAYERVERSION', output)
-                    deps = extract_value('LAYERDEPENDS', output)
-                    recs = extract_value('LAYERRECOMMENDS', output)
+                        layerconf = result['layerconf'] if result else {}
+                        layerconf_values = {}
+                        for valuename in LayerConfCache.values:
+                            layerconf_values[valuename] = layerconf.get(valuename) or ''
+                        if not layerconf_values['BBFILE_COLLECTIONS']:
+                            logger.error('Unable to find BBFILE_COLLECTIONS value in initial result')
+                            # Assume (perhaps naively) that it's an error specific to the layer
+                            continue
+                        if layerconf_key:
+                            layerconf_cache.set(layerconf_key, layerconf_values)
+
+                    col = layerconf_values['BBFILE_COLLECTIONS']
+                    ver = layerconf_values['LAYERVERSION']
+                    deps = layerconf_values['LAYERDEPENDS']
+                    recs = layerconf_values['LAYERRECOMMENDS']
 
                     if not options.nocheckout:
                         # We need to check this out because we're using stuff from bb.utils
@@ -452,6 +541,8 @@ def main():
 
                     deps_dict = utils.explode_dep_versions2(bitbakepath, deps)
                     recs_dict = utils.explode_dep_versions2(bitbakepath, recs)
+                    layer_collections[layer] = col
+                    layer_depcols[layer] = set(deps_dict.keys()) | set(recs_dict.keys())
                     if not (deps_dict or recs_dict):
                         # No depends, add it firstly
                         layerquery_sorted.append(layer)
@@ -514,6 +605,37 @@ def main():
                         logger.warning("Known collections on branch %s: %s" % (branch, collections))
                         break
 
+                def finish_layer_update(layer, layerupdate, ret, output, timings=None):
+                    layerupdate.finished = datetime.now()
+
+                    # We need to get layerbranch here because it might not have existed until
+                    # layer_update.py created it, but it still may not create one (e.g. if subdir
+                    # didn't exist) so we still need to check
+                    layerbranch = layer.get_layerbranch(branch)
+                    if layerbranch:
+                        layerupdate.vcs_after_rev = layerbranch.vcs_last_rev
+                    if timings is None:
+                        output, timings = utils.extract_timings(output)
+                    repodir = os.path.join(fetchdir, layer.get_fetch_dir())
+                    if repodir in fetch_timings and 'fetch' not in timings:
+                        timings['fetch'] = round(fetch_timings[repodir], 3)
+                    if timings:
+                        layerupdate.timings = json.dumps(dict([(k, round(v, 3)) for k, v in timings.items()]), sort_keys=True)
+                    layerupdate.log = output
+                    layerupdate.retcode = ret
+                    if not options.dryrun:
+                        layerupdate.save()
+
+                    if ret == 254:
+                        # Interrupted by user, break out of loop
+                        logger.info('Update interrupted, exiting')
+                        sys.exit(254)
+                    if options.stop_on_error and ret != 0:
+                        logger.info('Layer update failed with --stop-on-error, stopping')
+                        sys.exit(1)
+
+                queued_layers = []
+                core_layer = utils.get_layer(settings.CORE_LAYER_NAME)
                 for layer in layerquery_sorted:
                     layerupdate = LayerUpdate()
                     layerupdate.update = update
@@ -536,29 +658,73 @@ def main():
                     layerupdate.started = datetime.now()
                     if not options.dryrun:
                         layerupdate.save()
-                    cmd = prepare_update_layer_command(options, branchobj, layer)
-                    logger.debug('Running layer update command: %s' % cmd)
-                    ret, output = utils.run_command_interruptible(cmd)
-                    layerupdate.finished = datetime.now()
-
-                    # We need to get layerbranch here because it might not have existed until
-                    # layer_update.py created it, but it still may not create one (e.g. if subdir
-                    # didn't exist) so we still need to check
-                    layerbranch = layer.get_layerbranch(branch)
-                    if layerbranch:
-                        layerupdate.vcs_after_rev = layerbranch.vcs_last_rev
-                    layerupdate.log = output
-                    layerupdate.retcode = ret
-                    if not options.dryrun:
-                        layerupdate.save()
+                    if update_queue:
+                        # Layers within this batch that need to be updated first
+                        deps = [deplayer for deplayer in queued_layers if layer_collections.get(deplayer, None) in layer_depcols.get(layer, ())]
+                        fetch_layers = [layer, core_layer] + deps
+                        if layerbranch:
+                            fetch_layers += [lb.layer for lb in layerbranch.get_recursive_dependencies(required=False)]
+                        fetch_repos = [(settings.BITBAKE_REPO_URL, 'bitbake')]
+                        checkout_layers = []
+                        for fetch_layer in fetch_layers:
+                            if fetch_layer:
+                                fetch_repo = (fetch_layer.vcs_url, fetch_layer.get_fetch_dir())
+                                if fetch_repo not in fetch_repos:
+                                    fetch_repos.append(fetch_repo)
+                                if not options.nocheckout and fetch_layer.name not in checkout_layers:
+                                    checkout_layers.append(fetch_layer.name)
+                        cmd = prepare_update_layer_command(options, branchobj, layer)
+                        update_queue.add(layer, layerupdate, cmd, fetch_repos, deps, branch, checkout_layers)
+                        queued_layers.append(layer)
+                        continue
+                    elif worker_pool:
+                        logger.debug('Updating layer %s using worker' % layer.name)
+                        result = worker_pool.run_layer(branchobj, layer)
+                        finish_layer_update(layer, layerupdate, result['retcode'], result['output'], dict(result.get('timings', {})))
+                    else:
+                        cmd = prepare_update_layer_command(options, branchobj, layer)
+                        ret, output, result = run_update_layer_command(cmd)
+                        finish_layer_update(layer, layerupdate, ret, output, dict(result['timings']) if result else {})
+
+                if update_queue and queued_layers:
+                    logger.info('Sending %d layer updates for branch %s to workers' % (len(queued_layers), branch))
+                    # Workers on this machine need the lock file
+                    utils.unlock_file(lockfile)
+                    lockfile = None
+                    try:
+                        update_queue.run(finish_layer_update)
+                    finally:
+                        lockfile = utils.lock_file(lockfn, options.timeout, logger)
+                    failed = [lu.layer.name for lu in LayerUpdate.objects.filter(update=update, branch=branchobj).exclude(retcode=0)]
+                    if failed:
+                        logger.warning('Layer updates failed for branch %s: %s' % (branch, ', '.join(failed)))
+
+                if not options.dryrun:
+                    # Recipes may have been added or removed, so recalculate
+                    # which ones are shadowed by recipes in preferred layers,
+                    # the duplicates report etc. (we told update_layer.py not
+                    # to, so that it's only done once here)
+                    try:
+                        with transaction.atomic():
+                            branchobj.update_derived_data()
+                    except Exception:
+                        import traceback
+                        logger.error('Failed to update derived data for branch %s:\n%s' % (branch, traceback.format_exc().rstrip()))
+                        failed_layers[branch].append('Failed to update derived data (preferred recipe counts, duplicates)')
+
+                if not lockfile:
+                    # We still update the above since it only involves the database
+                    remaining = branches[branches.index(branch) + 1:]
+                    if remaining:
+                        logger.error("Layer index lock timeout expired after updating branch %s, not updating branches: %s" % (branch, ', '.join(remaining)))
+                    else:
+                        logger.error("Layer index lock timeout expired after updating branch %s" % branch)
+                    sys.exit(1)
 
-                    if ret == 254:
-                        # Interrupted by user, break out of loop
-                        logger.info('Update interrupted, exiting')
-                        sys.exit(254)
-                    if options.stop_on_error and ret != 0:
-                        logger.info('Layer update failed with --stop-on-error, stopping')
-                        sys.exit(1)
+                if worker_pool:
+                    # The next branch needs a different bitbake checkout
+                    worker_pool.shutdown()
+            layerconf_cache.save()
             if failed_layers:
                 for branch, err_msg_list in failed_layers.items():
                     if err_msg_list:
@@ -566,7 +732,13 @@ def main():
                         logger.error("Issues found on branch %s:\n    %s" % (branch, "\n    ".join(err_msg_list)))
                         print()
         finally:
-            utils.unlock_file(lockfile)
+            if worker_pool:
+                worker_pool.shutdown()
+            if lockfile:
+                utils.unlock_file(lockfile)
+            utils.unlock_file(updatelockfile)
+            if brokerlock:
+                brokerlock.release()
 
     except KeyboardInterrupt:
         logger.info('Update interrupted, exiting')
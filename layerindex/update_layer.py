@@ -12,6 +12,7 @@ import sys
 import os
 import optparse
 import logging
+import json
 from datetime import datetime
 import re
 import tempfile
@@ -19,9 +20,15 @@ import shutil
 import errno
 from distutils.version import LooseVersion
 import itertools
+import time
+import contextlib
+import multiprocessing
+import multiprocessing.util
 import utils
 import recipeparse
 import layerconfparse
+from updatecache import RecipeParseCache
+from updatewriter import LayerBranchRowWriter, RecipeRowWriter, RecipeFileDependencyWriter, chunks
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -36,10 +43,88 @@ except ImportError:
     sys.exit(1)
 
 
+# Below this number of recipes it's not worth the cost of starting up
+# tinfoil in parse worker processes
+PARALLEL_PARSE_MIN_RECIPES = 20
+
+
 class DryRunRollbackException(Exception):
     pass
 
 
+class UpdateTimer:
+    """
+    Records how long each phase of a layer update takes. Time spent in a
+    phase nested within another is only counted against the inner phase.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.stack = []
+
+    def add(self, name, value):
+        self.timings[name] = self.timings.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        self.stack.append(0)
+        try:
+            yield
+        finally:
+            nested = self.stack.pop()
+            elapsed = time.time() - start
+            self.add(name, elapsed - nested)
+            if self.stack:
+                self.stack[-1] += elapsed
+
+timer = UpdateTimer()
+
+
+class LayerUpdateResult:
+    """
+    The outcome of updating a single layer (see run_update_layer()).
+    retcode has the same meaning as the exit code of this script.
+    """
+    def __init__(self, layername, branchname):
+        self.layer = layername
+        self.branch = branchname
+        self.retcode = 0
+        # Values read from conf/layer.conf (BBFILE_COLLECTIONS, LAYERVERSION etc.)
+        self.layerconf = {}
+        self.vcs_rev = None
+        self.recipes_added = 0
+        self.recipes_updated = 0
+        self.recipes_deleted = 0
+        self.recipe_errors = 0
+        self.timings = {}
+        # Only set if output was captured
+        self.output = None
+        self.errors = 0
+        self.warnings = 0
+
+    @property
+    def collection(self):
+        return self.layerconf.get('BBFILE_COLLECTIONS', None)
+
+    @property
+    def version(self):
+        return self.layerconf.get('LAYERVERSION', None)
+
+    @property
+    def depends(self):
+        return self.layerconf.get('LAYERDEPENDS', None)
+
+    @property
+    def recommends(self):
+        return self.layerconf.get('LAYERRECOMMENDS', None)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
 def check_machine_conf(path, subdir_start):
     subpath = path[len(subdir_start):]
     res = conf_re.match(subpath)
@@ -56,129 +141,162 @@ def split_recipe_fn(path):
         pv = "1.0"
     return (pn, pv)
 
-def collect_patch(recipe, patchfn, index, layerdir_start, stop_on_error):
+def collect_patches(recipe, patches, layerdir_start, stop_on_error):
     from django.db import DatabaseError
     from layerindex.models import Patch
 
-    patchrec = Patch()
-    patchrec.recipe = recipe
-    patchrec.path = os.path.relpath(patchfn, layerdir_start)
-    patchrec.src_path = os.path.relpath(patchrec.path, recipe.filepath)
-    patchrec.apply_order = index
-    try:
-        patchrec.read_status_from_file(patchfn, logger)
-        patchrec.save()
-    except DatabaseError:
-        raise
-    except Exception as e:
-        if stop_on_error:
+    patchwriter = RecipeRowWriter(Patch, recipe, ('path',), ('src_path', 'apply_order', 'status', 'status_extra', 'sha256sum'))
+    for index, patchfn in patches:
+        patchrec = Patch()
+        patchrec.recipe = recipe
+        patchrec.path = os.path.relpath(patchfn, layerdir_start)
+        patchrec.src_path = os.path.relpath(patchrec.path, recipe.filepath)
+        patchrec.apply_order = index
+        try:
+            patchrec.sha256sum = utils.sha256_file(patchfn)
+            existing = patchwriter.get(path=patchrec.path)
+            if existing and existing['sha256sum'] == patchrec.sha256sum:
+                # Patch hasn't changed, so neither has its status
+                patchrec.status = existing['status']
+                patchrec.status_extra = existing['status_extra']
+            else:
+                patchrec.read_status_from_file(patchfn, logger)
+        except DatabaseError:
             raise
+        except Exception as e:
+            if stop_on_error:
+                raise
+            else:
+                logger.error("Unable to read patch %s: %s", patchfn, str(e))
+        patchwriter.set(path=patchrec.path,
+                        src_path=patchrec.src_path,
+                        apply_order=patchrec.apply_order,
+                        status=patchrec.status,
+                        status_extra=patchrec.status_extra,
+                        sha256sum=patchrec.sha256sum)
+    patchwriter.delete_unseen()
+    patchwriter.flush()
+
+def extract_recipe_values(tinfoil, data, fn, layerdir_start, repodir, skip_patches=False):
+    """
+    Parse a recipe and return the values we need from it. Only plain
+    values are returned so that this can be done in a separate process.
+    """
+    if hasattr(tinfoil, 'parse_recipe_file'):
+        envdata = tinfoil.parse_recipe_file(fn, appends=False, config_data=data)
+    else:
+        envdata = bb.cache.Cache.loadDataFull(fn, [], data)
+    envdata.setVar('SRCPV', 'X')
+    values = {}
+    values['pn'] = envdata.getVar("PN", True)
+    values['pv'] = envdata.getVar("PV", True)
+    values['summary'] = envdata.getVar("SUMMARY", True)
+    values['description'] = envdata.getVar("DESCRIPTION", True)
+    values['section'] = envdata.getVar("SECTION", True)
+    values['license'] = envdata.getVar("LICENSE", True)
+    values['homepage'] = envdata.getVar("HOMEPAGE", True)
+    values['bugtracker'] = envdata.getVar("BUGTRACKER", True) or ""
+    values['provides'] = envdata.getVar("PROVIDES", True) or ""
+    values['bbclassextend'] = envdata.getVar("BBCLASSEXTEND", True) or ""
+    # Handle recipe inherits for this recipe
+    gr = set(data.getVar("__inherit_cache", True) or [])
+    lr = set(envdata.getVar("__inherit_cache", True) or [])
+    values['inherits'] = ' '.join(sorted({os.path.splitext(os.path.basename(r))[0] for r in lr if r not in gr}))
+    values['blacklisted'] = envdata.getVarFlag('PNBLACKLIST', values['pn'], True) or ""
+    for confvar in ['EXTRA_OEMESON', 'EXTRA_OECMAKE', 'EXTRA_OESCONS', 'EXTRA_OECONF']:
+        values['configopts'] = envdata.getVar(confvar, True) or ""
+        if values['configopts']:
+            break
+    else:
+        values['configopts'] = ''
+
+    values['src_uri'] = (envdata.getVar('SRC_URI', True) or '').split()
+    values['depends'] = envdata.getVar('DEPENDS', True) or ''
+    values['packageconfig'] = dict(envdata.getVarFlags('PACKAGECONFIG') or {})
+
+    # Patches - None means leave any existing patch records alone
+    values['patches'] = None
+    if not skip_patches:
+        try:
+            import oe.recipeutils
+        except ImportError:
+            logger.warn('Failed to find lib/oe/recipeutils.py in layers - patches will not be imported')
         else:
-            logger.error("Unable to read patch %s: %s", patchfn, str(e))
-            patchrec.save()
-
-def collect_patches(recipe, envdata, layerdir_start, stop_on_error):
-    from layerindex.models import Patch
-
-    try:
-        import oe.recipeutils
-    except ImportError:
-        logger.warn('Failed to find lib/oe/recipeutils.py in layers - patches will not be imported')
-        return
-
-    Patch.objects.filter(recipe=recipe).delete()
-    patches = oe.recipeutils.get_recipe_patches(envdata)
-    for i, patch in enumerate(patches):
-        if not patch.startswith(layerdir_start):
-            # Likely a remote patch, skip it
-            continue
-        collect_patch(recipe, patch, i, layerdir_start, stop_on_error)
-
-def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, stop_on_error, skip_patches=False):
+            patches = []
+            for i, patch in enumerate(oe.recipeutils.get_recipe_patches(envdata)):
+                if not patch.startswith(layerdir_start):
+                    # Likely a remote patch, skip it
+                    continue
+                patches.append((i, patch))
+            values['patches'] = patches
+
+    # Get file dependencies within this layer
+    deps = envdata.getVar('__depends', True)
+    filedeps = []
+    for depstr, date in deps:
+        if depstr.startswith(layerdir_start) and not depstr.endswith('/conf/layer.conf'):
+            filedeps.append(os.path.relpath(depstr, repodir))
+    values['filedeps'] = filedeps
+    # All files that went into parsing the recipe (needed by the parse cache)
+    values['depfiles'] = [depstr for depstr, date in deps]
+    return values
+
+def apply_recipe_values(recipe, values, layerdir_start, stop_on_error, filedeps_writer=None, depsync=None):
+    from layerindex.models import Source, RecipeInherit
+
+    for field in ['pn', 'pv', 'summary', 'description', 'section', 'license',
+                  'homepage', 'bugtracker', 'provides', 'bbclassextend',
+                  'inherits', 'blacklisted', 'configopts']:
+        setattr(recipe, field, values[field])
+    recipe.save()
+
+    # Handle sources
+    sourcewriter = RecipeRowWriter(Source, recipe, ('url',))
+    for url in values['src_uri']:
+        if not url.startswith('file://'):
+            sourcewriter.set(url=url.split(';')[0])
+    sourcewriter.delete_unseen()
+    sourcewriter.flush()
+
+    # Handle inherits (also stored in recipe.inherits, but this is what we search on)
+    inheritwriter = RecipeRowWriter(RecipeInherit, recipe, ('name',))
+    for inherit in values['inherits'].split():
+        inheritwriter.set(name=inherit)
+    inheritwriter.delete_unseen()
+    inheritwriter.flush()
+
+    recipeparse.handle_recipe_depends(recipe, values['depends'], values['packageconfig'], logger, depsync)
+
+    if values['patches'] is not None:
+        # Handle patches
+        with timer.phase('patches'):
+            collect_patches(recipe, values['patches'], layerdir_start, stop_on_error)
+
+    if filedeps_writer:
+        filedeps_writer.set(recipe, values['filedeps'])
+    else:
+        filedeps_writer = RecipeFileDependencyWriter(recipe.layerbranch)
+        filedeps_writer.set(recipe, values['filedeps'])
+        filedeps_writer.flush()
+
+def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, stop_on_error, skip_patches=False, values=None, filedeps_writer=None, depsync=None):
+    """
+    Update a recipe record from the recipe file. If values is specified
+    then it is used instead of parsing the recipe (it may also be an
+    exception raised while parsing the recipe elsewhere). If filedeps_writer
+    is specified, the recipe's file dependencies are left for the caller
+    to write out; depsync is an optional RecipeDependencySync to share.
+    """
     from django.db import DatabaseError
 
     fn = str(os.path.join(path, recipe.filename))
-    from layerindex.models import PackageConfig, StaticBuildDep, DynamicBuildDep, Source, Patch
     try:
         logger.debug('Updating recipe %s' % fn)
-        if hasattr(tinfoil, 'parse_recipe_file'):
-            envdata = tinfoil.parse_recipe_file(fn, appends=False, config_data=data)
-        else:
-            envdata = bb.cache.Cache.loadDataFull(fn, [], data)
-        envdata.setVar('SRCPV', 'X')
-        recipe.pn = envdata.getVar("PN", True)
-        recipe.pv = envdata.getVar("PV", True)
-        recipe.summary = envdata.getVar("SUMMARY", True)
-        recipe.description = envdata.getVar("DESCRIPTION", True)
-        recipe.section = envdata.getVar("SECTION", True)
-        recipe.license = envdata.getVar("LICENSE", True)
-        recipe.homepage = envdata.getVar("HOMEPAGE", True)
-        recipe.bugtracker = envdata.getVar("BUGTRACKER", True) or ""
-        recipe.provides = envdata.getVar("PROVIDES", True) or ""
-        recipe.bbclassextend = envdata.getVar("BBCLASSEXTEND", True) or ""
-        # Handle recipe inherits for this recipe
-        gr = set(data.getVar("__inherit_cache", True) or [])
-        lr = set(envdata.getVar("__inherit_cache", True) or [])
-        recipe.inherits = ' '.join(sorted({os.path.splitext(os.path.basename(r))[0] for r in lr if r not in gr}))
-        recipe.blacklisted = envdata.getVarFlag('PNBLACKLIST', recipe.pn, True) or ""
-        for confvar in ['EXTRA_OEMESON', 'EXTRA_OECMAKE', 'EXTRA_OESCONS', 'EXTRA_OECONF']:
-            recipe.configopts = envdata.getVar(confvar, True) or ""
-            if recipe.configopts:
-                break
-        else:
-            recipe.configopts = ''
-        recipe.save()
-
-        # Handle sources
-        old_urls = list(recipe.source_set.values_list('url', flat=True))
-        for url in (envdata.getVar('SRC_URI', True) or '').split():
-            if not url.startswith('file://'):
-                url = url.split(';')[0]
-                if url in old_urls:
-                    old_urls.remove(url)
-                else:
-                    src = Source(recipe=recipe, url=url)
-                    src.save()
-        for url in old_urls:
-            recipe.source_set.filter(url=url).delete()
-
-        recipeparse.handle_recipe_depends(recipe, envdata.getVar('DEPENDS', True) or '', envdata.getVarFlags('PACKAGECONFIG'), logger)
-
-        if not skip_patches:
-            # Handle patches
-            collect_patches(recipe, envdata, layerdir_start, stop_on_error)
-
-        # Get file dependencies within this layer
-        deps = envdata.getVar('__depends', True)
-        filedeps = []
-        for depstr, date in deps:
-            found = False
-            if depstr.startswith(layerdir_start) and not depstr.endswith('/conf/layer.conf'):
-                filedeps.append(os.path.relpath(depstr, repodir))
-        from layerindex.models import RecipeFileDependency
-
-        recipedeps_delete = []
-
-        recipedeps = RecipeFileDependency.objects.filter(recipe=recipe)
-
-        for values in recipedeps.values('path'):
-            if 'path' in values:
-                recipedeps_delete.append(values['path'])
-
-        for filedep in filedeps:
-            if filedep in recipedeps_delete:
-                recipedeps_delete.remove(filedep)
-                continue
-            # New item, add it...
-            recipedep = RecipeFileDependency()
-            recipedep.layerbranch = recipe.layerbranch
-            recipedep.recipe = recipe
-            recipedep.path = filedep
-            recipedep.save()
-
-        for filedep in recipedeps_delete:
-            recipedeps.filter(path=filedep).delete()
-
+        if values is None:
+            values = extract_recipe_values(tinfoil, data, fn, layerdir_start, repodir, skip_patches)
+        elif isinstance(values, Exception):
+            raise values
+        apply_recipe_values(recipe, values, layerdir_start, stop_on_error, filedeps_writer, depsync)
     except KeyboardInterrupt:
         raise
     except DatabaseError:
@@ -190,34 +308,166 @@ def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, sto
             if not recipe.pn:
                 recipe.pn = recipe.filename[:-3].split('_')[0]
             logger.error("Unable to read %s: %s", fn, str(e))
+            return False
+    return True
+
+# State for recipe parsing worker processes (see parse_recipes())
+_parse_worker = None
 
-def update_machine_conf_file(path, machine):
+def _parse_worker_init(branchname, bitbakepath, layerdirs, layerdir_start, repodir, skip_patches, loglevel):
+    global _parse_worker
+    logger.setLevel(loglevel)
+    try:
+        utils.setup_django()
+        import settings
+        branch = utils.get_branch(branchname)
+        # We never want to check anything out here, the parent process has already done that
+        layerparser = LayerParser(settings, branch, bitbakepath, optparse.Values({'nocheckout': True, 'keep_temp': False}))
+        multiprocessing.util.Finalize(None, layerparser.shutdown, exitpriority=10)
+        tinfoil = layerparser.get_tinfoil()
+        utils.setup_core_layer_sys_path(settings, branchname)
+        config_data = recipeparse.setup_layer_dirs(tinfoil.config_data, layerdirs)
+        _parse_worker = (tinfoil, config_data, layerdir_start, repodir, skip_patches)
+    except Exception as e:
+        # If we raise an exception here the pool will just keep starting
+        # new workers, so instead return nothing and let the parent
+        # parse the recipes itself
+        logger.warning('Failed to set up recipe parsing worker: %s' % str(e))
+        _parse_worker = None
+
+def _parse_worker_parse(fn):
+    if not _parse_worker:
+        return (fn, None, None)
+    (tinfoil, config_data, layerdir_start, repodir, skip_patches) = _parse_worker
+    try:
+        return (fn, extract_recipe_values(tinfoil, config_data, fn, layerdir_start, repodir, skip_patches), None)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        # bitbake's exceptions don't necessarily survive pickling, so just pass back the message
+        return (fn, None, str(e))
+
+def parse_recipes(fns, branch, bitbakepath, layerdirs, layerdir_start, repodir, skip_patches, jobs):
+    """
+    Parse the specified recipe files using a pool of worker processes,
+    each with its own tinfoil instance. Returns a dict of extracted values
+    (or an exception if parsing failed) by filename; any recipe missing
+    from the result should be parsed by the caller.
+    """
+    results = {}
+    # Use spawn rather than fork - the bitbake state in this process
+    # (including the bitbake server connection, if any) must not be shared
+    ctx = multiprocessing.get_context('spawn')
+    initargs = (branch.name, bitbakepath, layerdirs, layerdir_start, repodir, skip_patches, logger.getEffectiveLevel())
+    with ctx.Pool(jobs, initializer=_parse_worker_init, initargs=initargs) as pool:
+        for fn, values, error in pool.imap_unordered(_parse_worker_parse, fns, chunksize=4):
+            if error:
+                results[fn] = recipeparse.RecipeParseError(error)
+            elif values:
+                results[fn] = values
+        pool.close()
+        pool.join()
+    return results
+
+def update_recipe_files(tinfoil, data, recipe_updates, branch, bitbakepath, layerdirs, layerdir_start, repodir, options, skip_patches, jobs, parsecache=None):
+    """
+    Update recipe records from a list of (path, recipe, save) tuples,
+    parsing the recipes in parallel if there are enough of them. If a
+    parse cache is specified then recipes whose values are in the cache
+    and up-to-date are not parsed at all. Returns the number of recipes
+    that could not be read.
+    """
+    fns = [str(os.path.join(path, recipe.filename)) for path, recipe, _ in recipe_updates]
+    results = {}
+    if parsecache and not options.fullreload:
+        for fn in fns:
+            values = parsecache.get_values(fn)
+            if values:
+                results[fn] = values
+        logger.debug('%d of %d recipes found in parse cache' % (len(results), len(fns)))
+    parse_fns = [fn for fn in fns if fn not in results]
+    # All of the recipes are in the same layer branch
+    if recipe_updates:
+        filedeps_writer = RecipeFileDependencyWriter(recipe_updates[0][1].layerbranch)
+    else:
+        filedeps_writer = None
+    depsync = recipeparse.RecipeDependencySync()
+    timer.add('recipes_parsed', len(parse_fns))
+    errors = 0
+    if jobs > 1 and len(parse_fns) >= PARALLEL_PARSE_MIN_RECIPES:
+        logger.debug('Parsing %d recipes using %d processes' % (len(parse_fns), jobs))
+        with timer.phase('parse'):
+            results.update(parse_recipes(parse_fns, branch, bitbakepath, layerdirs, layerdir_start, repodir, skip_patches, jobs))
+    for (path, recipe, save), fn in zip(recipe_updates, fns):
+        values = results.get(fn, None)
+        if values is None:
+            try:
+                with timer.phase('parse'):
+                    values = extract_recipe_values(tinfoil, data, fn, layerdir_start, repodir, skip_patches)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                # update_recipe_file() will handle this
+                values = e
+        if parsecache and isinstance(values, dict):
+            parsecache.set_values(fn, values)
+        with timer.phase('db'):
+            if not update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, values, filedeps_writer, depsync):
+                errors += 1
+            if save:
+                recipe.save()
+    if filedeps_writer:
+        with timer.phase('db'):
+            filedeps_writer.flush()
+    return errors
+
+def get_file_dependency_index(layerbranch):
+    """
+    Get a dict mapping the path of each file that recipes in the specified
+    layer branch depend upon to the set of ids of those recipes
+    """
+    from layerindex.models import RecipeFileDependency
+    index = {}
+    for path, recipe_id in RecipeFileDependency.objects.filter(layerbranch=layerbranch).values_list('path', 'recipe_id').iterator():
+        index.setdefault(path, set()).add(recipe_id)
+    return index
+
+def update_machine_conf_file(path, machine, contents=None):
     logger.debug('Updating machine %s' % path)
     desc = ""
-    with open(path, 'r') as f:
-        for line in f:
-            if line.startswith('#@NAME:'):
-                desc = line[7:].strip()
-            if line.startswith('#@DESCRIPTION:'):
-                desc = line[14:].strip()
-                desc = re.sub(r'Machine configuration for( running)*( an)*( the)*', '', desc)
-                break
+    if contents is None:
+        with open(path, 'r') as f:
+            contents = f.read()
+    for line in contents.splitlines():
+        if line.startswith('#@NAME:'):
+            desc = line[7:].strip()
+        if line.startswith('#@DESCRIPTION:'):
+            desc = line[14:].strip()
+            desc = re.sub(r'Machine configuration for( running)*( an)*( the)*', '', desc)
+            break
     machine.description = desc
 
-def update_distro_conf_file(path, distro, d):
+def read_blob(blob):
+    return blob.data_stream.read().decode('utf-8', errors='replace')
+
+def update_distro_conf_file(path, distro, d, contents=None):
     logger.debug('Updating distro %s' % path)
     desc = ""
-    with open(path, 'r') as f:
-        for line in f:
-            if line.startswith('#@NAME:'):
-                desc = line[7:].strip()
-            if line.startswith('#@DESCRIPTION:'):
-                desc = line[14:].strip()
-                desc = re.sub(r'Distribution configuration for( running)*( an)*( the)*', '', desc)
-                break
+    if contents is None:
+        with open(path, 'r') as f:
+            contents = f.read()
+    for line in contents.splitlines():
+        if line.startswith('#@NAME:'):
+            desc = line[7:].strip()
+        if line.startswith('#@DESCRIPTION:'):
+            desc = line[14:].strip()
+            desc = re.sub(r'Distribution configuration for( running)*( an)*( the)*', '', desc)
+            break
 
     distro_name = ''
     try:
+        # NOTE: bitbake can only parse the file (and anything it includes)
+        # from the working tree
         d = utils.parse_conf(path, d)
         distro_name = d.getVar('DISTRO_NAME', True)
     except Exception as e:
@@ -228,12 +478,49 @@ def update_distro_conf_file(path, distro, d):
     else:
         distro.description = desc
 
-def main():
-    if LooseVersion(git.__version__) < '0.3.1':
-        logger.error("Version of GitPython is too old, please install GitPython (python-git) 0.3.1 or later in order to use this script")
-        sys.exit(1)
+class LayerParser:
+    """
+    Sets up tinfoil on demand for a branch, so that the same instance can be
+    reused if more than one layer is updated by the same process
+    """
+    def __init__(self, settings, branch, bitbakepath, options):
+        self.settings = settings
+        self.branch = branch
+        self.bitbakepath = bitbakepath
+        self.options = options
+        self.tinfoil = None
+        self.tempdir = None
+
+    def get_tinfoil(self):
+        if self.tinfoil:
+            return self.tinfoil
+        (self.tinfoil, self.tempdir) = recipeparse.init_parser(self.settings, self.branch, self.bitbakepath, nocheckout=self.options.nocheckout, logger=logger)
+        logger.debug('Using temp directory %s' % self.tempdir)
+        # Clear the default value of SUMMARY so that we can use DESCRIPTION instead if it hasn't been set
+        self.tinfoil.config_data.setVar('SUMMARY', '')
+        # Clear the default value of DESCRIPTION so that we can see where it's not set
+        self.tinfoil.config_data.setVar('DESCRIPTION', '')
+        # Clear the default value of HOMEPAGE ('unknown')
+        self.tinfoil.config_data.setVar('HOMEPAGE', '')
+        # Set a blank value for LICENSE so that it doesn't cause the parser to die (e.g. with meta-ti -
+        # why won't they just fix that?!)
+        self.tinfoil.config_data.setVar('LICENSE', '')
+        return self.tinfoil
+
+    def shutdown(self):
+        if self.tinfoil and (LooseVersion(bb.__version__) > LooseVersion("1.27")):
+            self.tinfoil.shutdown()
+        self.tinfoil = None
+        if self.tempdir:
+            if self.options.keep_temp:
+                logger.debug('Preserving temp directory %s' % self.tempdir)
+            else:
+                logger.debug('Deleting temp directory')
+                utils.rmtree_force(self.tempdir)
+            self.tempdir = None
 
 
+def get_option_parser():
     parser = optparse.OptionParser(
         usage = """
     %prog [options]""")
@@ -271,7 +558,42 @@ def main():
     parser.add_option("", "--keep-temp",
             help = "Preserve temporary directory at the end instead of deleting it",
             action="store_true")
+    parser.add_option("", "--profile",
+            help = "Profile the update, writing the data to a file in TASK_LOG_DIR",
+            action="store_true")
+    parser.add_option("", "--no-derived-data",
+            help = "Don't recalculate data derived from all recipes on the branch afterwards (used by update.py, which does this once per branch)",
+            action="store_true", dest="no_derived_data")
+    parser.add_option("", "--worker",
+            help = "Run as a worker process, updating layers requested over the specified pair of file descriptors (used by update.py)",
+            action="store", dest="worker")
+    parser.add_option("", "--result-file",
+            help = "Write the result (layer.conf values, timings etc.) to the specified file as JSON instead of printing it (used by update.py)",
+            action="store", dest="result_file")
+    return parser
+
+def get_update_options(**kwargs):
+    """
+    Get an options object for calling run_update_layer() from Python,
+    with the same defaults as on the command line
+    """
+    options = get_option_parser().get_default_values()
+    for key, value in kwargs.items():
+        if not hasattr(options, key):
+            raise ValueError('Invalid option %s' % key)
+        setattr(options, key, value)
+    if options.fullreload:
+        options.reload = True
+    return options
+
+
+def main():
+    if LooseVersion(git.__version__) < '0.3.1':
+        logger.error("Version of GitPython is too old, please install GitPython (python-git) 0.3.1 or later in order to use this script")
+        sys.exit(1)
+
 
+    parser = get_option_parser()
     options, args = parser.parse_args(sys.argv)
     if len(args) > 1:
         logger.error('unexpected argument "%s"' % args[1])
@@ -283,8 +605,6 @@ def main():
 
     utils.setup_django()
     import settings
-    from layerindex.models import LayerItem, LayerBranch, Recipe, RecipeFileDependency, Machine, Distro, BBAppend, BBClass, IncFile
-    from django.db import transaction
 
     logger.setLevel(options.loglevel)
 
@@ -298,11 +618,113 @@ def main():
         logger.error("Please set LAYER_FETCH_DIR in settings.py")
         sys.exit(1)
 
-    bitbakepath = os.path.join(fetchdir, 'bitbake')
+    bitbakepath = os.path.join(utils.get_worktree_base(settings, branch.name), 'bitbake')
+    utils.ensure_worktree(bitbakepath, logger=logger)
+
+    if options.worker:
+        run_worker(options, settings, branch, fetchdir, bitbakepath)
+        sys.exit(0)
+
+    if not options.layer:
+        logger.error("Please specify a layer to update")
+        sys.exit(1)
+
+    layerparser = LayerParser(settings, branch, bitbakepath, options)
+    try:
+        result = run_update_layer(options, settings, branch, fetchdir, bitbakepath, options.layer, layerparser)
+    finally:
+        layerparser.shutdown()
+    if result.retcode == 0 and not (options.initial or options.dryrun or options.no_derived_data):
+        branch.update_derived_data()
+    if options.result_file:
+        with open(options.result_file, 'w') as f:
+            json.dump(result.to_dict(), f)
+    else:
+        if options.initial and result.retcode == 0:
+            # Use print() rather than logger.info() since "-q" makes it print nothing.
+            for i in ["BBFILE_COLLECTIONS", "LAYERVERSION", "LAYERDEPENDS", "LAYERRECOMMENDS"]:
+                print('%s = "%s"' % (i, result.layerconf.get(i, '')))
+        # Picked up by update.py when the update is run via the update queue
+        print(utils.format_timings(result.timings))
+    sys.exit(result.retcode)
+
+
+def run_update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, capture=False):
+    """
+    Update a layer, returning a LayerUpdateResult. This is the entry point
+    for updating layers from Python code - use get_update_options() to
+    get a suitable options object (note that options.branch must match
+    branch) and a LayerParser to set up and hold the tinfoil instance,
+    which can be reused for further layers on the same branch. If capture
+    is True then everything written to stdout/stderr in the process is
+    captured and returned in the result. Once all of the layers on the
+    branch have been updated, call branch.update_derived_data().
+    """
+    result = LayerUpdateResult(layername, branch.name)
+    timer.reset()
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    starttime = time.time()
+    output = None
+    try:
+        if capture:
+            with utils.capture_output() as output:
+                result.retcode = _call_update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, result)
+        else:
+            result.retcode = _call_update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, result)
+    finally:
+        timer.add('total', time.time() - starttime)
+        if profiler:
+            profiler.disable()
+            if not os.path.exists(settings.TASK_LOG_DIR):
+                os.makedirs(settings.TASK_LOG_DIR)
+            profilefn = os.path.join(settings.TASK_LOG_DIR, 'profile_%s_%s_%s.pstats' % (layername, branch.name, datetime.now().strftime('%Y%m%d%H%M%S')))
+            profiler.dump_stats(profilefn)
+            logger.info('Profile data written to %s' % profilefn)
+    result.timings = dict(timer.timings)
+    if output:
+        result.output = output.read()
+        for line in result.output.splitlines():
+            if line.startswith('WARNING:'):
+                result.warnings += 1
+            elif line.startswith('ERROR:'):
+                result.errors += 1
+    return result
+
+def _call_update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, result):
+    """Call update_layer() and convert any exit into a return code"""
+    try:
+        update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, result)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        elif e.code:
+            return 1
+    return 0
+
+
+def update_layer(options, settings, branch, fetchdir, bitbakepath, layername, layerparser, result):
+    """
+    Update the specified layer on the specified branch, filling in result
+    (a LayerUpdateResult) as we go. Note that this calls sys.exit() on
+    error, as it did when it was only ever called from the command line -
+    use run_update_layer() instead of calling this directly.
+    """
+    from layerindex.models import LayerItem, LayerBranch, Recipe, Machine, Distro, BBAppend, BBClass, IncFile
+    from django.db import transaction
 
-    layer = utils.get_layer(options.layer)
+    layer = utils.get_layer(layername)
+    if not layer:
+        logger.error("Specified layer %s is not valid" % layername)
+        sys.exit(1)
     urldir = layer.get_fetch_dir()
-    repodir = os.path.join(fetchdir, urldir)
+    # Where the repository gets checked out (may be a separate worktree per branch)
+    checkoutdir = utils.get_worktree_base(settings, branch.name)
+    repodir = os.path.join(checkoutdir, urldir)
+    utils.ensure_worktree(repodir, logger=logger)
 
     layerbranch = layer.get_layerbranch(options.branch)
 
@@ -322,8 +744,6 @@ def main():
     if options.nocheckout:
         topcommit = repo.commit('HEAD')
 
-    tinfoil = None
-    tempdir = None
     try:
         with transaction.atomic():
             newbranch = False
@@ -355,44 +775,30 @@ def main():
             layerdir_start = os.path.normpath(layerdir) + os.sep
 
             layerrecipes = Recipe.objects.filter(layerbranch=layerbranch)
-            layermachines = Machine.objects.filter(layerbranch=layerbranch)
-            layerdistros = Distro.objects.filter(layerbranch=layerbranch)
-            layerappends = BBAppend.objects.filter(layerbranch=layerbranch)
-            layerclasses = BBClass.objects.filter(layerbranch=layerbranch)
-            layerincfiles = IncFile.objects.filter(layerbranch=layerbranch)
             if layerbranch.vcs_last_rev != topcommit.hexsha or options.reload or options.initial:
                 # Check out appropriate branch
                 if not options.nocheckout:
-                    utils.checkout_layer_branch(layerbranch, repodir, logger=logger)
+                    with timer.phase('checkout'):
+                        utils.checkout_layer_branch(layerbranch, repodir, logger=logger)
 
                 logger.info("Collecting data for layer %s on branch %s" % (layer.name, branchdesc))
                 try:
-                    (tinfoil, tempdir) = recipeparse.init_parser(settings, branch, bitbakepath, nocheckout=options.nocheckout, logger=logger)
+                    with timer.phase('init_parser'):
+                        tinfoil = layerparser.get_tinfoil()
                 except recipeparse.RecipeParseError as e:
                     logger.error(str(e))
                     sys.exit(1)
-                logger.debug('Using temp directory %s' % tempdir)
-                # Clear the default value of SUMMARY so that we can use DESCRIPTION instead if it hasn't been set
-                tinfoil.config_data.setVar('SUMMARY', '')
-                # Clear the default value of DESCRIPTION so that we can see where it's not set
-                tinfoil.config_data.setVar('DESCRIPTION', '')
-                # Clear the default value of HOMEPAGE ('unknown')
-                tinfoil.config_data.setVar('HOMEPAGE', '')
-                # Set a blank value for LICENSE so that it doesn't cause the parser to die (e.g. with meta-ti -
-                # why won't they just fix that?!)
-                tinfoil.config_data.setVar('LICENSE', '')
-
-                layerconfparser = layerconfparse.LayerConfParse(logger=logger, tinfoil=tinfoil)
-                layer_config_data = layerconfparser.parse_layer(layerdir)
+
+                with timer.phase('layerconf'):
+                    layerconfparser = layerconfparse.LayerConfParse(logger=logger, tinfoil=tinfoil)
+                    layer_config_data = layerconfparser.parse_layer(layerdir)
                 if not layer_config_data:
                     logger.info("Skipping update of layer %s for branch %s - conf/layer.conf may have parse issues" % (layer.name, branchdesc))
-                    layerconfparser.shutdown()
                     sys.exit(1)
                 utils.set_layerbranch_collection_version(layerbranch, layer_config_data, logger=logger)
+                for i in ["BBFILE_COLLECTIONS", "LAYERVERSION", "LAYERDEPENDS", "LAYERRECOMMENDS"]:
+                    result.layerconf[i] = utils.get_layer_var(layer_config_data, i, logger)
                 if options.initial:
-                    # Use print() rather than logger.info() since "-q" makes it print nothing.
-                    for i in ["BBFILE_COLLECTIONS", "LAYERVERSION", "LAYERDEPENDS", "LAYERRECOMMENDS"]:
-                        print('%s = "%s"' % (i, utils.get_layer_var(layer_config_data, i, logger)))
                     sys.exit(0)
 
                 # Set up for recording patch info
@@ -409,7 +815,8 @@ def main():
                 layerbranch.save()
 
                 try:
-                    config_data_copy = recipeparse.setup_layer(tinfoil.config_data, fetchdir, layerdir, layer, layerbranch, logger)
+                    layerdirs = recipeparse.get_layer_dirs(checkoutdir, layerdir, layer, layerbranch, logger, nocheckout=options.nocheckout)
+                    config_data_copy = recipeparse.setup_layer_dirs(tinfoil.config_data, layerdirs)
                 except recipeparse.RecipeParseError as e:
                     logger.error(str(e))
                     sys.exit(1)
@@ -428,13 +835,30 @@ def main():
                 # recipe page it remains valid)
                 layerrecipes_delete = []
                 layerrecipes_add = []
-
-                # Check if any paths should be ignored because there are layers within this layer
-                removedirs = []
-                for root, dirs, files in os.walk(layerdir):
-                    for diritem in dirs:
-                        if os.path.exists(os.path.join(root, diritem, 'conf', 'layer.conf')):
-                            removedirs.append(os.path.join(root, diritem) + os.sep)
+                # Recipes to be parsed, as (path, recipe, save) - we parse
+                # them all at once later so that it can be done in parallel
+                recipe_updates = []
+
+                # Find and classify the files in the layer - this also tells us
+                # if any paths should be ignored because there are layers within
+                # this layer. Unless we're working with whatever happens to be
+                # in the working tree, we can read this straight from git (the
+                # working tree is still needed for bitbake to parse recipes,
+                # distro configuration and layer.conf files).
+                if options.nocheckout:
+                    scancommit = None
+                else:
+                    scancommit = topcommit
+                with timer.phase('scan'):
+                    (layer_files, removedirs) = recipeparse.scan_layer(repodir, layerbranch.vcs_subdir, scancommit)
+
+                # Changes to the other items in the layer are made in memory
+                # and written out together at the end
+                layermachines = LayerBranchRowWriter(Machine, layerbranch, ('name',), ('description',))
+                layerdistros = LayerBranchRowWriter(Distro, layerbranch, ('name',), ('description',))
+                layerappends = LayerBranchRowWriter(BBAppend, layerbranch, ('filepath', 'filename'))
+                layerclasses = LayerBranchRowWriter(BBClass, layerbranch, ('name',))
+                layerincfiles = LayerBranchRowWriter(IncFile, layerbranch, ('path',))
 
                 if diff:
                     # Apply git changes to existing recipe list
@@ -445,7 +869,9 @@ def main():
                         subdir_start = ""
 
                     updatedrecipes = set()
+                    # Recipes that need reparsing because a file they depend on changed
                     dirtyrecipes = set()
+                    filedep_index = get_file_dependency_index(layerbranch)
                     other_deletes = []
                     other_adds = []
                     for diffitem in diff.iter_change_type('R'):
@@ -481,62 +907,44 @@ def main():
                                     recipe.filepath = newfilepath
                                     recipe.filename = newfilename
                                     recipe.save()
-                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, newfilepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                    recipe_updates.append((os.path.join(layerdir, newfilepath), recipe, False))
                                     updatedrecipes.add(os.path.join(oldfilepath, oldfilename))
                                     updatedrecipes.add(os.path.join(newfilepath, newfilename))
                                 else:
                                     logger.warn("Renamed recipe %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
                             elif oldtypename == 'bbappend':
-                                results = layerappends.filter(filepath=oldfilepath).filter(filename=oldfilename)
-                                if len(results):
-                                    logger.debug("Rename bbappend %s to %s" % (results[0], os.path.join(newfilepath, newfilename)))
-                                    results[0].filepath = newfilepath
-                                    results[0].filename = newfilename
-                                    results[0].save()
+                                if layerappends.rename({'filepath': oldfilepath, 'filename': oldfilename}, filepath=newfilepath, filename=newfilename):
+                                    logger.debug("Rename bbappend %s to %s" % (oldpath, os.path.join(newfilepath, newfilename)))
                                 else:
                                     logger.warn("Renamed bbappend %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
                             elif oldtypename == 'machine':
-                                results = layermachines.filter(name=oldfilename)
-                                if len(results):
-                                    logger.debug("Rename machine %s to %s" % (results[0], newfilename))
-                                    results[0].name = newfilename
-                                    results[0].save()
+                                if layermachines.rename({'name': oldfilename}, name=newfilename):
+                                    logger.debug("Rename machine %s to %s" % (oldfilename, newfilename))
                                 else:
                                     logger.warn("Renamed machine %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
                             elif oldtypename == 'distro':
-                                results = layerdistros.filter(name=oldfilename)
-                                if len(results):
-                                    logger.debug("Rename distro %s to %s" % (results[0], newfilename))
-                                    results[0].name = newfilename
-                                    results[0].save()
+                                if layerdistros.rename({'name': oldfilename}, name=newfilename):
+                                    logger.debug("Rename distro %s to %s" % (oldfilename, newfilename))
                                 else:
                                     logger.warn("Renamed distro %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
                             elif oldtypename == 'bbclass':
-                                results = layerclasses.filter(name=oldfilename)
-                                if len(results):
-                                    logger.debug("Rename class %s to %s" % (results[0], newfilename))
-                                    results[0].name = newfilename
-                                    results[0].save()
+                                if layerclasses.rename({'name': oldfilename}, name=newfilename):
+                                    logger.debug("Rename class %s to %s" % (oldfilename, newfilename))
                                 else:
                                     logger.warn("Renamed class %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
                             elif oldtypename == 'incfile':
-                                results = layerincfiles.filter(path=os.path.join(oldfilepath, oldfilename))
-                                if len(results):
-                                    logger.debug("Rename inc file %s to %s" % (results[0], newfilename))
-                                    results[0].name = newfilename
-                                    results[0].save()
+                                if layerincfiles.rename({'path': os.path.join(oldfilepath, oldfilename)}, path=os.path.join(newfilepath, newfilename)):
+                                    logger.debug("Rename inc file %s to %s" % (oldpath, newpath))
                                 else:
                                     logger.warn("Renamed inc file %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
 
-                            deps = RecipeFileDependency.objects.filter(layerbranch=layerbranch).filter(path=oldpath)
-                            for dep in deps:
-                                dirtyrecipes.add(dep.recipe)
+                            dirtyrecipes.update(filedep_index.get(oldpath, []))
 
 
                     for diffitem in itertools.chain(diff.iter_change_type('D'), other_deletes):
@@ -559,15 +967,15 @@ def main():
                                 else:
                                     logger.warn("Deleted recipe %s could not be found" % path)
                             elif typename == 'bbappend':
-                                layerappends.filter(filepath=filepath).filter(filename=filename).delete()
+                                layerappends.delete(filepath=filepath, filename=filename)
                             elif typename == 'machine':
-                                layermachines.filter(name=filename).delete()
+                                layermachines.delete(name=filename)
                             elif typename == 'distro':
-                                layerdistros.filter(name=filename).delete()
+                                layerdistros.delete(name=filename)
                             elif typename == 'bbclass':
-                                layerclasses.filter(name=filename).delete()
+                                layerclasses.delete(name=filename)
                             elif typename == 'incfile':
-                                layerincfiles.filter(path=os.path.join(filepath, filename)).delete()
+                                layerincfiles.delete(path=os.path.join(filepath, filename))
 
                     for diffitem in itertools.chain(diff.iter_change_type('A'), other_adds):
                         path = diffitem.b_blob.path
@@ -585,33 +993,19 @@ def main():
                                 logger.debug("Mark %s for addition" % path)
                                 updatedrecipes.add(os.path.join(filepath, filename))
                             elif typename == 'bbappend':
-                                append = BBAppend()
-                                append.layerbranch = layerbranch
-                                append.filename = filename
-                                append.filepath = filepath
-                                append.save()
+                                layerappends.set(filepath=filepath, filename=filename)
                             elif typename == 'machine':
-                                machine = Machine()
-                                machine.layerbranch = layerbranch
-                                machine.name = filename
-                                update_machine_conf_file(os.path.join(repodir, path), machine)
-                                machine.save()
+                                machine = Machine(name=filename)
+                                update_machine_conf_file(os.path.join(repodir, path), machine, read_blob(diffitem.b_blob) if scancommit else None)
+                                layermachines.set(name=machine.name, description=machine.description)
                             elif typename == 'distro':
-                                distro = Distro()
-                                distro.layerbranch = layerbranch
-                                distro.name = filename
-                                update_distro_conf_file(os.path.join(repodir, path), distro, config_data_copy)
-                                distro.save()
+                                distro = Distro(name=filename)
+                                update_distro_conf_file(os.path.join(repodir, path), distro, config_data_copy, read_blob(diffitem.b_blob) if scancommit else None)
+                                layerdistros.set(name=distro.name, description=distro.description)
                             elif typename == 'bbclass':
-                                bbclass = BBClass()
-                                bbclass.layerbranch = layerbranch
-                                bbclass.name = filename
-                                bbclass.save()
+                                layerclasses.set(name=filename)
                             elif typename == 'incfile':
-                                incfile = IncFile()
-                                incfile.layerbranch = layerbranch
-                                incfile.path = os.path.join(filepath, filename)
-                                incfile.save()
+                                layerincfiles.set(path=os.path.join(filepath, filename))
 
                     for diffitem in diff.iter_change_type('M'):
                         path = diffitem.b_blob.path
@@ -629,29 +1023,27 @@ def main():
                                 results = layerrecipes.filter(filepath=filepath).filter(filename=filename)[:1]
                                 if results:
                                     recipe = results[0]
-                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
-                                    recipe.save()
+                                    recipe_updates.append((os.path.join(layerdir, filepath), recipe, True))
                                     updatedrecipes.add(recipe.full_path())
                             elif typename == 'machine':
-                                results = layermachines.filter(name=filename)
-                                if results:
-                                    machine = results[0]
-                                    update_machine_conf_file(os.path.join(repodir, path), machine)
-                                    machine.save()
+                                if layermachines.get(name=filename):
+                                    machine = Machine(name=filename)
+                                    update_machine_conf_file(os.path.join(repodir, path), machine, read_blob(diffitem.b_blob) if scancommit else None)
+                                    layermachines.set(name=machine.name, description=machine.description)
                             elif typename == 'distro':
-                                results = layerdistros.filter(name=filename)
-                                if results:
-                                    distro = results[0]
-                                    update_distro_conf_file(os.path.join(repodir, path), distro, config_data_copy)
-                                    distro.save()
-
-                            deps = RecipeFileDependency.objects.filter(layerbranch=layerbranch).filter(path=path)
-                            for dep in deps:
-                                dirtyrecipes.add(dep.recipe)
-
-                    for recipe in dirtyrecipes:
-                        if not recipe.full_path() in updatedrecipes:
-                            update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, recipe.filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                if layerdistros.get(name=filename):
+                                    distro = Distro(name=filename)
+                                    update_distro_conf_file(os.path.join(repodir, path), distro, config_data_copy, read_blob(diffitem.b_blob) if scancommit else None)
+                                    layerdistros.set(name=distro.name, description=distro.description)
+
+                            dirtyrecipes.update(filedep_index.get(path, []))
+
+                    if dirtyrecipes:
+                        logger.debug("%d recipes need updating due to changed dependencies" % len(dirtyrecipes))
+                    for recipe_ids in chunks(sorted(dirtyrecipes)):
+                        for recipe in layerrecipes.filter(id__in=recipe_ids):
+                            if not recipe.full_path() in updatedrecipes:
+                                recipe_updates.append((os.path.join(layerdir, recipe.filepath), recipe, False))
                 else:
                     # Collect recipe data from scratch
 
@@ -660,6 +1052,7 @@ def main():
                         layerrecipes.delete()
                     else:
                         # First, check which recipes still exist
+                        layer_recipe_paths = set([path for typename, _, _, path in layer_files if typename == 'recipe'])
                         layerrecipe_values = layerrecipes.values('id', 'filepath', 'filename', 'pn')
                         for v in layerrecipe_values:
                             if v['filepath'].startswith('../'):
@@ -669,70 +1062,48 @@ def main():
                             else:
                                 root = os.path.join(layerdir, v['filepath'])
                                 fullpath = os.path.join(root, v['filename'])
-                                if os.path.exists(fullpath):
-                                    preserve = True
-                                    for removedir in removedirs:
-                                        if fullpath.startswith(removedir):
-                                            preserve = False
-                                            break
-                                else:
-                                    preserve = False
+                                # (sublayers have already been excluded here)
+                                preserve = os.path.relpath(fullpath, repodir) in layer_recipe_paths
 
                             if preserve:
                                 # Recipe still exists, update it
                                 results = layerrecipes.filter(id=v['id'])[:1]
                                 recipe = results[0]
-                                update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                recipe_updates.append((root, recipe, False))
                             else:
                                 # Recipe no longer exists, mark it for later on
                                 layerrecipes_delete.append(v)
-                            layerrecipe_fns.append(fullpath)
-
-                    layermachines.delete()
-                    layerdistros.delete()
-                    layerappends.delete()
-                    layerclasses.delete()
-                    for root, dirs, files in os.walk(layerdir):
-                        if '.git' in dirs:
-                            dirs.remove('.git')
-                        for diritem in dirs[:]:
-                            fullpath = os.path.join(root, diritem) + os.sep
-                            if fullpath in removedirs:
-                                dirs.remove(diritem)
-                        for f in files:
-                            fullpath = os.path.join(root, f)
-                            (typename, _, filename) = recipeparse.detect_file_type(fullpath, layerdir_start)
-                            if typename == 'recipe':
-                                if fullpath not in layerrecipe_fns:
-                                    layerrecipes_add.append(fullpath)
-                            elif typename == 'bbappend':
-                                append = BBAppend()
-                                append.layerbranch = layerbranch
-                                append.filename = f
-                                append.filepath = os.path.relpath(root, layerdir)
-                                append.save()
-                            elif typename == 'machine':
-                                machine = Machine()
-                                machine.layerbranch = layerbranch
-                                machine.name = filename
+                            layerrecipe_fns.append(os.path.normpath(fullpath))
+
+                    for (typename, filepath, filename, path) in layer_files:
+                        fullpath = os.path.join(repodir, path)
+                        if typename == 'recipe':
+                            if os.path.normpath(fullpath) not in layerrecipe_fns:
+                                layerrecipes_add.append(fullpath)
+                        elif typename == 'bbappend':
+                            layerappends.set(filepath=os.path.relpath(os.path.dirname(fullpath), layerdir), filename=filename)
+                        elif typename == 'machine':
+                            machine = Machine(name=filename)
+                            if scancommit:
+                                update_machine_conf_file(fullpath, machine, recipeparse.read_tree_file(scancommit, path))
+                            else:
                                 update_machine_conf_file(fullpath, machine)
-                                machine.save()
-                            elif typename == 'distro':
-                                distro = Distro()
-                                distro.layerbranch = layerbranch
-                                distro.name = filename
+                            layermachines.set(name=machine.name, description=machine.description)
+                        elif typename == 'distro':
+                            distro = Distro(name=filename)
+                            if scancommit:
+                                update_distro_conf_file(fullpath, distro, config_data_copy, recipeparse.read_tree_file(scancommit, path))
+                            else:
                                 update_distro_conf_file(fullpath, distro, config_data_copy)
-                                distro.save()
-                            elif typename == 'bbclass':
-                                bbclass = BBClass()
-                                bbclass.layerbranch = layerbranch
-                                bbclass.name = filename
-                                bbclass.save()
-                            elif typename == 'incfile':
-                                incfile = IncFile()
-                                incfile.layerbranch = layerbranch
-                                incfile.path = os.path.relpath(fullpath, layerdir)
-                                incfile.save()
+                            layerdistros.set(name=distro.name, description=distro.description)
+                        elif typename == 'bbclass':
+                            layerclasses.set(name=filename)
+                        elif typename == 'incfile':
+                            layerincfiles.set(path=os.path.relpath(fullpath, layerdir))
+
+                    # Anything we didn't find this time around no longer exists
+                    for writer in [layermachines, layerdistros, layerappends, layerclasses, layerincfiles]:
+                        writer.delete_unseen()
 
                 for added in layerrecipes_add:
                     # This is good enough without actually parsing the file
@@ -756,16 +1127,34 @@ def main():
                     recipe.filename = os.path.basename(added)
                     root = os.path.dirname(added)
                     recipe.filepath = os.path.relpath(root, layerdir)
-                    update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
-                    recipe.save()
+                    recipe_updates.append((root, recipe, True))
+
+                jobs = int(getattr(settings, 'RECIPE_PARSE_JOBS', 1))
+                parsecache = None
+                if getattr(settings, 'RECIPE_PARSE_CACHE', True):
+                    core_layer = utils.get_layer(settings.CORE_LAYER_NAME)
+                    core_repodir = os.path.join(checkoutdir, core_layer.get_fetch_dir())
+                    envkey = RecipeParseCache.get_env_key(bitbakepath, core_repodir, skip_patches)
+                    parsecache = RecipeParseCache(fetchdir, layerbranch, envkey, logger=logger)
+                result.recipes_added = len(layerrecipes_add)
+                result.recipes_updated = len(recipe_updates) - len(layerrecipes_add)
+                result.recipes_deleted = len(layerrecipes_delete)
+                result.recipe_errors = update_recipe_files(tinfoil, config_data_copy, recipe_updates, branch, bitbakepath, layerdirs, layerdir_start, repodir, options, skip_patches, jobs, parsecache)
+                if parsecache:
+                    parsecache.save()
+
+                with timer.phase('db'):
+                    for writer in [layermachines, layerdistros, layerappends, layerclasses, layerincfiles]:
+                        writer.flush()
 
-                for deleted in layerrecipes_delete:
-                    logger.debug("Delete %s" % deleted)
-                    results = Recipe.objects.filter(id=deleted['id'])[:1]
-                    recipe = results[0]
-                    recipe.delete()
+                    for deleted in layerrecipes_delete:
+                        logger.debug("Delete %s" % deleted)
+                        results = Recipe.objects.filter(id=deleted['id'])[:1]
+                        recipe = results[0]
+                        recipe.delete()
 
                 # Save repo info
+                result.vcs_rev = topcommit.hexsha
                 layerbranch.vcs_last_rev = topcommit.hexsha
                 layerbranch.vcs_last_commit = datetime.fromtimestamp(topcommit.committed_date)
             else:
@@ -789,17 +1178,46 @@ def main():
         import traceback
         logger.error(traceback.format_exc().rstrip())
         sys.exit(1)
-    finally:
-        if tinfoil and (LooseVersion(bb.__version__) > LooseVersion("1.27")):
-            tinfoil.shutdown()
 
-    if tempdir:
-        if options.keep_temp:
-            logger.debug('Preserving temp directory %s' % tempdir)
-        else:
-            logger.debug('Deleting temp directory')
-            utils.rmtree_force(tempdir)
-    sys.exit(0)
+
+def run_worker(options, settings, branch, fetchdir, bitbakepath):
+    """
+    Worker mode - update layers as requested by update.py over a pair of
+    pipes, keeping the same tinfoil instance for all layers so that we only
+    pay the cost of starting up bitbake once. update.py is responsible for
+    deciding when to recycle the worker (since bitbake leaks memory when
+    used this way).
+    """
+    from multiprocessing.connection import Connection
+    from django.db import close_old_connections
+
+    (infd, outfd) = [int(fd) for fd in options.worker.split(',')]
+    reqconn = Connection(infd, writable=False)
+    respconn = Connection(outfd, readable=False)
+
+    layerparser = LayerParser(settings, branch, bitbakepath, options)
+    try:
+        while True:
+            try:
+                request = reqconn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            # The database connection may have been idle for a while
+            close_old_connections()
+            options.initial = request.get('initial', False)
+            result = run_update_layer(options, settings, branch, fetchdir, bitbakepath, request['layer'], layerparser, capture=True)
+            response = result.to_dict()
+            response['rss'] = utils.get_rss()
+            respconn.send(response)
+            if result.retcode == 254:
+                # Interrupted by user
+                break
+    finally:
+        layerparser.shutdown()
+        reqconn.close()
+        respconn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+# Persistent caches used by the layer index update script
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import os
+import json
+import hashlib
+import tempfile
+import git
+
+
+class JSONFileCache:
+    """
+    Simple persistent dict-like cache stored as a JSON file. Changes are
+    only written back when save() is called (and only if something changed).
+    """
+    def __init__(self, fn, logger=None):
+        self.fn = fn
+        self.logger = logger
+        self.data = {}
+        self.dirty = False
+        if os.path.exists(fn):
+            try:
+                with open(fn, 'r') as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                # A corrupt cache is not fatal, we just start again
+                if self.logger:
+                    self.logger.warning('Unable to read cache file %s: %s' % (fn, str(e)))
+                self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, None)
+
+    def set(self, key, value):
+        if self.data.get(key, None) != value:
+            self.data[key] = value
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        destdir = os.path.dirname(self.fn)
+        if not os.path.exists(destdir):
+            os.makedirs(destdir)
+        # Write to a temp file and rename so that an interruption can't leave
+        # a partially written cache behind
+        fd, tmpfn = tempfile.mkstemp(dir=destdir, prefix='.cache-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f)
+            os.rename(tmpfn, self.fn)
+        except:
+            os.remove(tmpfn)
+            raise
+        self.dirty = False
+
+
+class LayerConfCache(JSONFileCache):
+    """
+    Cache of the values we need from a layer's conf/layer.conf in order to
+    sort layers by dependency order, keyed by the git blob hash of the file
+    """
+    values = ['BBFILE_COLLECTIONS', 'LAYERVERSION', 'LAYERDEPENDS', 'LAYERRECOMMENDS']
+
+    def __init__(self, fetchdir, logger=None):
+        super(LayerConfCache, self).__init__(os.path.join(fetchdir, 'layerconf-cache.json'), logger)
+
+    @staticmethod
+    def get_key(commit, layerbranch):
+        """
+        Get the cache key (blob hash of conf/layer.conf) for the specified layer
+        branch at the specified commit, or None if the file cannot be found
+        """
+        path = 'conf/layer.conf'
+        if layerbranch.vcs_subdir:
+            path = layerbranch.vcs_subdir.rstrip('/') + '/' + path
+        try:
+            return (commit.tree / path).hexsha
+        except KeyError:
+            return None
+
+
+class RecipeParseCache(JSONFileCache):
+    """
+    Cache of values extracted by parsing the recipes in a layer, so that
+    recipes can be skipped if neither they nor any of the files they
+    depend upon (as listed in __depends) have changed. Files are compared
+    using their git blob hashes, computed from the current file contents.
+    The environment key is expected to change whenever anything else that
+    might affect parsing changes (e.g. the bitbake / core layer revisions).
+    """
+    def __init__(self, fetchdir, layerbranch, envkey, logger=None):
+        fn = os.path.join(fetchdir, 'recipe-parse-cache', '%s_%s.json' % (layerbranch.layer.name, layerbranch.branch.name))
+        super(RecipeParseCache, self).__init__(fn, logger)
+        self.envkey = envkey
+        self.hashes = {}
+
+    @staticmethod
+    def get_env_key(bitbakepath, core_repodir, skip_patches):
+        revs = []
+        for repodir in [bitbakepath, core_repodir]:
+            revs.append(git.Repo(repodir).head.commit.hexsha)
+        if skip_patches:
+            revs.append('nopatches')
+        return ':'.join(revs)
+
+    def file_hash(self, path):
+        if path not in self.hashes:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.hashes[path] = hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+            except (IOError, OSError):
+                self.hashes[path] = None
+        return self.hashes[path]
+
+    def get_values(self, fn):
+        """
+        Get the cached values for the specified recipe file, or None if
+        there are none or they are out of date
+        """
+        entry = self.get(fn)
+        if not entry or entry.get('env', None) != self.envkey:
+            return None
+        for path, filehash in entry['hashes'].items():
+            if self.file_hash(path) != filehash:
+                return None
+        return entry['values']
+
+    def set_values(self, fn, values):
+        hashes = {}
+        for path in [fn] + values.get('depfiles', []):
+            hashes[path] = self.file_hash(path)
+        self.set(fn, {'env': self.envkey, 'hashes': hashes, 'values': values})
+
+    def save(self):
+        # Drop entries for recipes that no longer exist
+        for fn in list(self.data.keys()):
+            if not os.path.exists(fn):
+                del self.data[fn]
+                self.dirty = True
+        super(RecipeParseCache, self).save()
@@ -0,0 +1,210 @@
+# Repository fetching for the layer index update script
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import os
+import re
+import time
+import queue
+import logging
+import subprocess
+import multiprocessing
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+import utils
+
+logger = logging.getLogger('LayerIndexUpdate')
+
+
+def get_url_host(vcs_url):
+    """
+    Get the host name from a repository URL (handling scp-style
+    user@host:path URLs as well as normal URLs)
+    """
+    if '://' in vcs_url:
+        return urlparse(vcs_url).hostname or ''
+    res = re.match(r'^(?:[^@/]+@)?([^:/]+):', vcs_url)
+    if res:
+        return res.group(1)
+    # Probably a local path
+    return ''
+
+def get_remote_heads(repodir):
+    """Get the branch heads of the origin remote as a dict of name: hash"""
+    output = utils.runcmd(['git', 'ls-remote', '--heads', 'origin'], repodir, logger=logger, printerr=False)
+    heads = {}
+    for line in output.splitlines():
+        splitline = line.split()
+        if len(splitline) == 2 and splitline[1].startswith('refs/heads/'):
+            heads[splitline[1][len('refs/heads/'):]] = splitline[0]
+    return heads
+
+def get_local_heads(repodir):
+    """Get the remote branch heads we already have as a dict of name: hash"""
+    output = utils.runcmd(['git', 'for-each-ref', '--format=%(objectname) %(refname)', 'refs/remotes/origin/'], repodir, logger=logger, printerr=False)
+    heads = {}
+    for line in output.splitlines():
+        splitline = line.split()
+        if len(splitline) == 2:
+            name = splitline[1][len('refs/remotes/origin/'):]
+            if name != 'HEAD':
+                heads[name] = splitline[0]
+    return heads
+
+def repo_up_to_date(repodir, branches=None):
+    """
+    Check if a repository needs fetching by comparing the remote's branch
+    heads with the ones we have (optionally only those in branches)
+    """
+    remote_heads = get_remote_heads(repodir)
+    local_heads = get_local_heads(repodir)
+    if branches:
+        remote_heads = {k: v for k, v in remote_heads.items() if k in branches}
+        local_heads = {k: v for k, v in local_heads.items() if k in branches}
+    return remote_heads == local_heads
+
+def fetch_repo(vcs_url, repodir, urldir, fetchdir, layer_name, branches=None, precheck=True):
+    """
+    Fetch (or clone) a repository. Returns a tuple of (repodir, error,
+    fetched, elapsed) where error is None on success and fetched is
+    False if the fetch was skipped because nothing relevant had changed.
+    """
+    starttime = time.time()
+    try:
+        if not os.path.exists(repodir):
+            logger.info("Fetching remote repository %s" % vcs_url)
+            utils.clone_repo(vcs_url, urldir, fetchdir, logger=logger, printerr=False)
+        else:
+            if precheck:
+                try:
+                    if repo_up_to_date(repodir, branches):
+                        logger.debug("Remote repository %s has not changed, skipping fetch" % vcs_url)
+                        return (repodir, None, False, time.time() - starttime)
+                except subprocess.CalledProcessError as e:
+                    # Let the fetch report the error (if any)
+                    logger.debug("Unable to check remote heads for %s: %s" % (vcs_url, e.output))
+            logger.info("Fetching remote repository %s" % vcs_url)
+            utils.runcmd(['git', 'fetch', '-p'], repodir, logger=logger, printerr=False)
+        return (repodir, None, True, time.time() - starttime)
+    except subprocess.CalledProcessError as e:
+        return (repodir, e.output, True, time.time() - starttime)
+    except Exception as e:
+        # We must always return a result, or FetchPlanner will wait forever
+        return (repodir, str(e), True, time.time() - starttime)
+
+
+class FetchPlanner:
+    """
+    Fetches a set of repositories in parallel, skipping those whose
+    relevant branches haven't moved, limiting the number of concurrent
+    fetches from any one host and retrying failed fetches with a backoff.
+    """
+    def __init__(self, jobs, host_jobs=0, retries=0, retry_delay=10, precheck=True):
+        self.jobs = jobs
+        self.host_jobs = host_jobs
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.precheck = precheck
+        self.repos = OrderedDict()
+        self.timings = {}
+
+    def add(self, vcs_url, repodir, urldir, fetchdir, name, branches=None):
+        """
+        Add a repository to be fetched. If branches is specified, only
+        changes to those branches will cause the repository to be fetched.
+        """
+        if repodir in self.repos:
+            if branches and self.repos[repodir][5]:
+                self.repos[repodir][5].update(branches)
+            else:
+                self.repos[repodir][5] = None
+        else:
+            self.repos[repodir] = [vcs_url, urldir, fetchdir, name, get_url_host(vcs_url), set(branches) if branches else None]
+
+    def run(self):
+        """
+        Fetch the repositories. Returns a dict mapping each URL to the
+        error output (or None if the fetch succeeded)
+        """
+        pending = OrderedDict()
+        for repodir, (_, _, _, _, host, _) in self.repos.items():
+            pending.setdefault(host, deque()).append(repodir)
+        delayed = []
+        attempts = {}
+        inflight = {}
+        running = 0
+        results = {}
+        skipped = []
+        failed = []
+        done = queue.Queue()
+        starttime = time.time()
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            while pending or delayed or running:
+                # Move any retries whose time has come back onto the queue
+                now = time.time()
+                for item in delayed[:]:
+                    if item[0] <= now:
+                        delayed.remove(item)
+                        pending.setdefault(self.repos[item[1]][4], deque()).append(item[1])
+                # Start as many fetches as we can, going round the hosts in turn
+                started = True
+                while started and running < self.jobs:
+                    started = False
+                    for host in list(pending.keys()):
+                        if running >= self.jobs:
+                            break
+                        if self.host_jobs and host and inflight.get(host, 0) >= self.host_jobs:
+                            continue
+                        repodir = pending[host].popleft()
+                        if not pending[host]:
+                            del pending[host]
+                        attempts[repodir] = attempts.get(repodir, 0) + 1
+                        (url, urldir, fetchdir, name, _, branches) = self.repos[repodir]
+                        pool.apply_async(fetch_repo,
+                                         (url, repodir, urldir, fetchdir, name, branches, self.precheck),
+                                         callback=done.put)
+                        inflight[host] = inflight.get(host, 0) + 1
+                        running += 1
+                        started = True
+                if not running:
+                    # Only retries waiting on their delay
+                    time.sleep(max(0, min([item[0] for item in delayed]) - time.time()))
+                    continue
+
+                if delayed:
+                    # Don't leave retries waiting longer than necessary
+                    timeout = max(0, min([item[0] for item in delayed]) - time.time())
+                else:
+                    timeout = None
+                try:
+                    (repodir, error, fetched, elapsed) = done.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                running -= 1
+                (url, _, _, name, host, _) = self.repos[repodir]
+                inflight[host] -= 1
+                self.timings[repodir] = self.timings.get(repodir, 0) + elapsed
+                if error and attempts[repodir] <= self.retries:
+                    delay = self.retry_delay * (2 ** (attempts[repodir] - 1))
+                    logger.warning("Fetch of %s failed, retrying in %d seconds" % (url, delay))
+                    delayed.append((time.time() + delay, repodir))
+                    continue
+                if error:
+                    logger.error("Fetch of layer %s failed: %s" % (name, error))
+                    failed.append(repodir)
+                elif fetched:
+                    logger.debug("Fetched %s in %.1fs" % (url, self.timings[repodir]))
+                else:
+                    skipped.append(repodir)
+                if not results.get(url, None):
+                    results[url] = error
+        finally:
+            pool.terminate()
+            pool.join()
+
+        logger.info("Fetched %d repositories in %.1fs (%d unchanged, %d failed)" % (len(self.repos) - len(skipped) - len(failed), time.time() - starttime, len(skipped), len(failed)))
+        return results
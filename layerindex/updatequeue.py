@@ -0,0 +1,134 @@
+# Distribution of layer updates to Celery workers for the layer index update script
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import time
+
+
+class BrokerLock:
+    """
+    A lock held via the message broker, so that it is effective across
+    machines (unlike the lock file in LAYER_FETCH_DIR). The lock is an
+    exclusive queue, which the broker only allows one connection to declare
+    at a time and deletes automatically when that connection goes away -
+    so the lock cannot be left held if the holder dies.
+    """
+    def __init__(self, broker_url, name, logger):
+        self.broker_url = broker_url
+        self.name = name
+        self.logger = logger
+        self.conn = None
+
+    def acquire(self, timeout=30):
+        from kombu import Connection, Queue
+        start = time.time()
+        last = start
+        while True:
+            conn = Connection(self.broker_url, heartbeat=0)
+            try:
+                Queue(self.name, exclusive=True, auto_delete=True, channel=conn.channel()).declare()
+                self.conn = conn
+                return True
+            except conn.channel_errors:
+                conn.release()
+            current = time.time()
+            if current - start > timeout:
+                return False
+            if current - last > 5:
+                last = current
+                self.logger.info('Trying to get lock %s (tried %d seconds) ...' % (self.name, current - start))
+            time.sleep(1)
+
+    def release(self):
+        if self.conn:
+            self.conn.release()
+            self.conn = None
+
+
+class LayerUpdateQueue:
+    """
+    Runs layer updates for a branch on Celery workers. A layer's update is
+    only sent out once the updates of the layers it depends upon within
+    the same batch have finished; otherwise as many updates as there are
+    workers to take them will run at once.
+    """
+    def __init__(self, queue, logger, poll_interval=2):
+        self.queue = queue
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.jobs = []
+
+    def add(self, layer, layerupdate, command, fetch_repos, deps, branch, checkout_layers):
+        """
+        Add a layer update job. fetch_repos is a list of (vcs_url, urldir)
+        for the repositories the worker needs to fetch first, deps is
+        the list of layers (added previously) that must be updated first,
+        and checkout_layers is the list of names of layers the worker
+        needs to check out on the specified branch before the update.
+        """
+        self.jobs.append({'layer': layer,
+                          'layerupdate': layerupdate,
+                          'command': command,
+                          'fetch_repos': fetch_repos,
+                          'deps': deps,
+                          'branch': branch,
+                          'checkout_layers': checkout_layers,
+                          'result': None})
+
+    def _send(self, job):
+        from layerindex.tasks import update_layer
+        self.logger.debug('Queueing update of layer %s' % job['layer'].name)
+        if job['layerupdate'].pk:
+            layerupdate_id = job['layerupdate'].pk
+        else:
+            # Dry run
+            layerupdate_id = None
+        job['result'] = update_layer.apply_async(args=(layerupdate_id, job['command'], job['fetch_repos'],
+                                                       job['branch'], job['checkout_layers']),
+                                                 queue=self.queue)
+
+    def run(self, callback):
+        """
+        Run all of the jobs, calling callback(layer, layerupdate, retcode,
+        output) as each one completes (in completion order). If callback
+        returns False, jobs not yet sent are abandoned.
+        """
+        pending = list(self.jobs)
+        running = []
+        done = set()
+        stop = False
+        try:
+            while (pending and not stop) or running:
+                if not stop:
+                    for job in pending[:]:
+                        if all([dep in done for dep in job['deps']]):
+                            pending.remove(job)
+                            self._send(job)
+                            running.append(job)
+                for job in running[:]:
+                    if not job['result'].ready():
+                        continue
+                    running.remove(job)
+                    done.add(job['layer'])
+                    try:
+                        result = job['result'].get(propagate=False)
+                    except Exception as e:
+                        result = e
+                    if isinstance(result, dict):
+                        retcode = result['retcode']
+                        output = result['output']
+                    else:
+                        retcode = 1
+                        output = 'ERROR: layer update task failed: %s\n' % str(result)
+                    if callback(job['layer'], job['layerupdate'], retcode, output) is False:
+                        stop = True
+                if running:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            for job in running:
+                job['result'].revoke(terminate=True, signal='SIGINT')
+            raise
+        finally:
+            self.jobs = []
@@ -0,0 +1,176 @@
+# Long-lived update_layer.py worker processes for the layer index update script
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import sys
+import os
+import signal
+import subprocess
+import time
+from multiprocessing.connection import Connection
+
+
+class UpdateWorker:
+    """
+    A single update_layer.py process running in worker mode for one branch.
+    We talk to it over a pair of pipes; its stdout/stderr are left alone
+    (output for each layer is captured by the worker and returned with the
+    result).
+    """
+    def __init__(self, cmd, branchname, logger):
+        self.branchname = branchname
+        self.logger = logger
+        self.layercount = 0
+        self.rss = 0
+        self.timed_out = False
+
+        (req_r, req_w) = os.pipe()
+        (resp_r, resp_w) = os.pipe()
+        cmd = '%s --worker %d,%d' % (cmd, req_r, resp_w)
+        logger.debug('Starting layer update worker: %s' % cmd)
+
+        def reenable_sigint():
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        try:
+            self.process = subprocess.Popen(cmd,
+                                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                                            shell=True,
+                                            pass_fds=(req_r, resp_w),
+                                            preexec_fn=reenable_sigint)
+        finally:
+            # The child has its own copies of these now; closing ours means
+            # we'll see EOF if it goes away unexpectedly
+            os.close(req_r)
+            os.close(resp_w)
+        self.reqconn = Connection(req_w, readable=False)
+        self.respconn = Connection(resp_r, writable=False)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run_layer(self, layername, initial=False, timeout=0):
+        """
+        Ask the worker to update a layer. Returns the result as a dict
+        (see LayerUpdateResult in update_layer.py), or None if the worker
+        died before returning a result or had to be killed because it
+        took longer than timeout seconds (if specified).
+        """
+        self.timed_out = False
+        try:
+            self.reqconn.send({'layer': layername, 'initial': initial})
+            starttime = time.monotonic()
+            while not self.respconn.poll(1):
+                if not self.is_alive():
+                    return None
+                if timeout and time.monotonic() - starttime > timeout:
+                    self.timed_out = True
+                    self.process.kill()
+                    self.process.wait()
+                    return None
+            response = self.respconn.recv()
+        except (EOFError, OSError):
+            return None
+        self.layercount += 1
+        self.rss = response.get('rss', 0)
+        return response
+
+    def shutdown(self, timeout=60):
+        if self.is_alive():
+            try:
+                self.reqconn.send(None)
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.logger.warning('Layer update worker for branch %s did not exit, killing it' % self.branchname)
+                self.process.kill()
+                self.process.wait()
+        self.reqconn.close()
+        self.respconn.close()
+
+
+class UpdateWorkerPool:
+    """
+    Manages update_layer.py worker processes. Each worker sets up tinfoil
+    once for its branch and is then reused for several layers; workers are
+    recycled after a specified number of layers, when their memory usage
+    exceeds a threshold, or after a layer fails (since bitbake's state
+    may not be trustworthy at that point).
+    NOTE: layers are processed in dependency order and the bitbake checkout
+    is shared, so only one worker (for the current branch) is kept running
+    at a time. Workers keep using the bitbake modules and core layer they
+    started with, so shutdown() must be called before bitbake or the core
+    layer is checked out again by anything other than the worker itself.
+    """
+    def __init__(self, get_command, max_layers, max_rss, logger, timeout=0):
+        self.get_command = get_command
+        self.max_layers = max_layers
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.logger = logger
+        self.workers = {}
+
+    def _get_worker(self, branch):
+        worker = self.workers.get(branch.name, None)
+        if worker and not worker.is_alive():
+            worker.shutdown()
+            worker = None
+        if not worker:
+            # Only one worker at a time - see above
+            self.shutdown()
+            worker = UpdateWorker(self.get_command(branch), branch.name, self.logger)
+            self.workers[branch.name] = worker
+        return worker
+
+    def _recycle(self, worker):
+        self.logger.debug('Recycling layer update worker for branch %s (%d layers, %d bytes RSS)' % (worker.branchname, worker.layercount, worker.rss))
+        worker.shutdown()
+        del self.workers[worker.branchname]
+
+    def run_layer(self, branch, layer, initial=False):
+        """
+        Update the specified layer using a worker (or if initial is True,
+        just read its layer.conf). Returns the result as a dict with at
+        least 'retcode' and 'output' (see LayerUpdateResult in
+        update_layer.py).
+        """
+        worker = self._get_worker(branch)
+        # Any Ctrl+C should be processed only by the worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            result = worker.run_layer(layer.name, initial, self.timeout)
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if result is None:
+            worker.shutdown()
+            del self.workers[worker.branchname]
+            if worker.timed_out:
+                ret = 1
+                msg = 'Layer update worker took longer than %d seconds updating %s, killed it' % (self.timeout, layer.name)
+            else:
+                ret = worker.process.returncode
+                if not ret:
+                    ret = 1
+                msg = 'Layer update worker exited unexpectedly while updating %s (exit code %s)' % (layer.name, worker.process.returncode)
+            self.logger.error(msg)
+            return {'retcode': ret, 'output': 'ERROR: %s\n' % msg}
+
+        ret = result['retcode']
+        sys.stdout.write(result['output'])
+        sys.stdout.flush()
+        if ret != 0:
+            self._recycle(worker)
+        elif self.max_layers and worker.layercount >= self.max_layers:
+            self._recycle(worker)
+        elif self.max_rss and worker.rss >= self.max_rss:
+            self._recycle(worker)
+        return result
+
+    def shutdown(self):
+        for worker in list(self.workers.values()):
+            worker.shutdown()
+        self.workers = {}
@@ -0,0 +1,196 @@
+# Batched database writes for the layer index update script
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+from collections import OrderedDict
+from datetime import datetime
+
+# Maximum number of rows to insert or ids to put in a single query
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RowWriter:
+    """
+    Keeps an in-memory copy of the rows of a simple model belonging to a
+    parent object (e.g. the machines of a layer branch or the patches of a
+    recipe), identified by the specified key fields. Changes are made to
+    the copy and then written back by flush() with the minimum of queries -
+    bulk inserts, set-based deletes and updates only for rows that have
+    actually changed. Rows that don't change keep their ids. Since none
+    of this goes through save(), values are truncated to fit their fields
+    here instead (see truncate_charfield_values()).
+    """
+    parentfield = None
+
+    def __init__(self, model, parent, keyfields, valuefields=()):
+        from django.db import models
+        self.model = model
+        self.parent = parent
+        self.keyfields = keyfields
+        self.valuefields = valuefields
+        self.rows = OrderedDict()
+        self.seen = set()
+        self.deleted_ids = set()
+        self.changed_ids = set()
+        self.has_updated = any([field.name == 'updated' for field in model._meta.fields])
+        self.maxlengths = dict([(field.name, field.max_length) for field in model._meta.fields if isinstance(field, models.CharField)])
+        if parent.pk:
+            for row in model.objects.filter(**{self.parentfield: parent}).order_by('id').values('id', *(keyfields + valuefields)):
+                key = self._key(row)
+                if key in self.rows:
+                    # Duplicate, drop it
+                    self.deleted_ids.add(row['id'])
+                else:
+                    self.rows[key] = row
+
+    def _key(self, values):
+        return tuple([values[field] for field in self.keyfields])
+
+    def _truncate(self, values):
+        """Truncate values to fit their fields (as save() would)"""
+        from layerindex.models import truncate_charfield_value
+        values = dict(values)
+        for field, value in values.items():
+            maxlength = self.maxlengths.get(field, None)
+            if maxlength and value and len(value) > maxlength:
+                values[field] = truncate_charfield_value(self.model, self.model._meta.get_field(field), value, self.parent)
+        return values
+
+    def get(self, **keys):
+        """Get the current values for the row with the specified key (or None)"""
+        return self.rows.get(self._key(self._truncate(keys)), None)
+
+    def set(self, **values):
+        """Add a row, or update it if one with the same key already exists"""
+        # Truncate first, so that values the database holds truncated
+        # compare equal and the row isn't rewritten every time
+        values = self._truncate(values)
+        key = self._key(values)
+        row = self.rows.get(key, None)
+        if row is None:
+            row = {'id': None}
+            row.update(values)
+            self.rows[key] = row
+        else:
+            for field, value in values.items():
+                if row.get(field, None) != value:
+                    row[field] = value
+                    if row['id']:
+                        self.changed_ids.add(row['id'])
+        self.seen.add(key)
+
+    def delete(self, **keys):
+        row = self.rows.pop(self._key(self._truncate(keys)), None)
+        if row and row['id']:
+            self.deleted_ids.add(row['id'])
+
+    def rename(self, oldkeys, **newvalues):
+        """
+        Change the key (and optionally other values) of an existing row.
+        Returns False if there is no row with the old key.
+        """
+        row = self.rows.pop(self._key(self._truncate(oldkeys)), None)
+        if row is None:
+            return False
+        newrow = dict(row)
+        newrow.update(self._truncate(newvalues))
+        newkey = self._key(newrow)
+        # If something else already has the new key, it goes
+        self.delete(**dict(zip(self.keyfields, newkey)))
+        self.rows[newkey] = newrow
+        if newrow['id'] and newrow != row:
+            self.changed_ids.add(newrow['id'])
+        self.seen.add(newkey)
+        return True
+
+    def delete_unseen(self):
+        """Delete all rows that haven't been set since this object was created"""
+        for key in list(self.rows.keys()):
+            if key not in self.seen:
+                row = self.rows.pop(key)
+                if row['id']:
+                    self.deleted_ids.add(row['id'])
+
+    def flush(self):
+        for ids in chunks(self.deleted_ids):
+            self.model.objects.filter(id__in=ids).delete()
+        self.deleted_ids = set()
+
+        fields = self.keyfields + self.valuefields
+        for row in self.rows.values():
+            if row['id'] in self.changed_ids:
+                values = self._truncate([(field, row[field]) for field in fields])
+                if self.has_updated:
+                    values['updated'] = datetime.now()
+                self.model.objects.filter(id=row['id']).update(**values)
+        self.changed_ids = set()
+
+        newrows = [row for row in self.rows.values() if not row['id']]
+        if newrows:
+            objs = []
+            for row in newrows:
+                values = self._truncate([(field, row[field]) for field in fields])
+                values[self.parentfield] = self.parent
+                objs.append(self.model(**values))
+            self.model.objects.bulk_create(objs, batch_size=CHUNK_SIZE)
+            # We don't get the ids back on all databases, so if we're
+            # going to be used again these rows need to be reloaded
+            for row in newrows:
+                del self.rows[self._key(row)]
+
+
+class LayerBranchRowWriter(RowWriter):
+    """RowWriter for items belonging to a layer branch (Machine, Distro, BBAppend etc.)"""
+    parentfield = 'layerbranch'
+
+
+class RecipeRowWriter(RowWriter):
+    """RowWriter for items belonging to a recipe (Patch, Source)"""
+    parentfield = 'recipe'
+
+
+class RecipeFileDependencyWriter:
+    """
+    Collects the file dependencies for a set of recipes and writes only
+    the differences back to the database on flush()
+    """
+    def __init__(self, layerbranch):
+        self.layerbranch = layerbranch
+        self.recipedeps = OrderedDict()
+
+    def set(self, recipe, paths):
+        from layerindex.models import RecipeFileDependency, truncate_charfield_value
+        # Truncated as save() would, so that they match what's stored
+        pathfield = RecipeFileDependency._meta.get_field('path')
+        self.recipedeps[recipe.id] = set([truncate_charfield_value(RecipeFileDependency, pathfield, path, recipe) for path in paths])
+
+    def flush(self):
+        from layerindex.models import RecipeFileDependency
+
+        deleted_ids = []
+        existing = {}
+        for recipe_ids in chunks(self.recipedeps.keys()):
+            for depid, recipe_id, path in RecipeFileDependency.objects.filter(recipe_id__in=recipe_ids).values_list('id', 'recipe_id', 'path'):
+                if (recipe_id, path) in existing or path not in self.recipedeps[recipe_id]:
+                    deleted_ids.append(depid)
+                else:
+                    existing[(recipe_id, path)] = depid
+
+        for ids in chunks(deleted_ids):
+            RecipeFileDependency.objects.filter(id__in=ids).delete()
+
+        newdeps = []
+        for recipe_id, paths in self.recipedeps.items():
+            for path in sorted(paths):
+                if (recipe_id, path) not in existing:
+                    newdeps.append(RecipeFileDependency(recipe_id=recipe_id, layerbranch=self.layerbranch, path=path))
+        RecipeFileDependency.objects.bulk_create(newdeps, batch_size=CHUNK_SIZE)
+        self.recipedeps = OrderedDict()
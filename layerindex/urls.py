@@ -13,7 +13,7 @@ from layerindex.views import LayerListView, LayerReviewListView, LayerReviewDeta
     HistoryListView, EditProfileFormView, AdvancedRecipeSearchView, BulkChangeView, BulkChangeSearchView, \
     bulk_change_edit_view, bulk_change_patch_view, BulkChangeDeleteView, RecipeDetailView, RedirectParamsView, \
     ClassicRecipeSearchView, ClassicRecipeDetailView, ClassicRecipeStatsView, LayerUpdateDetailView, UpdateListView, \
-    UpdateDetailView, StatsView, publish_view, LayerCheckListView, BBClassCheckListView, TaskStatusView, \
+    UpdateDetailView, StatsView, RecipeVersionMatrixView, publish_view, LayerCheckListView, BBClassCheckListView, TaskStatusView, \
     ComparisonRecipeSelectView, ComparisonRecipeSelectDetailView, task_log_view, task_stop_view, email_test_view
 from layerindex.models import LayerItem, Recipe, RecipeChangeset
 from rest_framework import routers
@@ -94,6 +94,10 @@ urlpatterns = [
         TemplateView.as_view(
             template_name='layerindex/privacy_notice.html'),
         name="privacy"),
+    url(r'^recipes/versions/$',
+        RecipeVersionMatrixView.as_view(
+            template_name='layerindex/recipeversions.html'),
+        name='recipe_version_matrix'),
     url(r'^stats/$',
         StatsView.as_view(
             template_name='layerindex/stats.html'),
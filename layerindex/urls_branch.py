@@ -7,7 +7,7 @@
 from django.conf.urls import *
 from django.views.defaults import page_not_found
 from django.core.urlresolvers import reverse_lazy
-from layerindex.views import LayerListView, RecipeSearchView, MachineSearchView, DistroSearchView, ClassSearchView, LayerDetailView, edit_layer_view, delete_layer_view, edit_layernote_view, delete_layernote_view, RedirectParamsView, DuplicatesView, LayerUpdateDetailView, layer_export_recipes_csv_view, comparison_update_view
+from layerindex.views import LayerListView, RecipeSearchView, MachineSearchView, DistroSearchView, ClassSearchView, LayerDetailView, edit_layer_view, delete_layer_view, edit_layernote_view, delete_layernote_view, RedirectParamsView, DuplicatesView, LayerUpdateDetailView, layer_export_recipes_csv_view, comparison_update_view, autocomplete_view
 
 urlpatterns = [
     url(r'^$', 
@@ -44,6 +44,9 @@ urlpatterns = [
         DuplicatesView.as_view(
             template_name='layerindex/duplicates.html'),
             name='duplicates'),
+    url(r'^autocomplete/(?P<itemtype>recipe|layer|machine|distro|class)/$',
+        autocomplete_view,
+        name='autocomplete'),
     url(r'^comparison_update/$',
         comparison_update_view,
         name='comparison_update'),
@@ -18,6 +18,7 @@ import shutil
 import codecs
 import re
 import math
+import contextlib
 from datetime import datetime
 from bs4 import BeautifulSoup
 
@@ -223,6 +224,7 @@ def checkout_repo(repodir, commit, logger, force=False):
     so it is only suitable for use with repos where you don't care about such
     things (which we don't for the layer repos that we use)
     """
+    ensure_worktree(repodir, logger)
     if force:
         currentref = ''
     else:
@@ -236,7 +238,16 @@ def checkout_repo(repodir, commit, logger, force=False):
         except Exception as esc:
             logger.warn(esc)
             currentref = ''
-    if currentref != commit:
+    if currentref:
+        # Resolve the revision we've been asked for (usually a remote branch
+        # name) so that we can tell if it's already checked out
+        try:
+            commit_hash = runcmd(['git', 'rev-parse', '%s^{commit}' % commit], repodir, logger=logger).strip()
+        except Exception:
+            commit_hash = commit
+    else:
+        commit_hash = commit
+    if currentref != commit_hash:
         # Reset in case there are added but uncommitted changes
         runcmd(['git', 'reset', '--hard'], repodir, logger=logger)
         # Drop any untracked files in case these cause problems (either because
@@ -250,6 +261,79 @@ def checkout_layer_branch(layerbranch, repodir, logger=None):
     branchname = layerbranch.get_checkout_branch()
     checkout_repo(repodir, 'origin/%s' % branchname, logger)
 
+WORKTREE_DIR = 'worktrees'
+
+def get_worktree_base(settings, branchname):
+    """
+    Get the directory under which repositories should be checked out when
+    working on the specified branch. If LAYER_WORKTREES is enabled, this is
+    a separate directory per branch containing git worktrees of the
+    repositories in LAYER_FETCH_DIR (so that different branches can be
+    worked on at the same time), otherwise it's just LAYER_FETCH_DIR.
+    """
+    if getattr(settings, 'LAYER_WORKTREES', False):
+        return os.path.join(settings.LAYER_FETCH_DIR, WORKTREE_DIR, branchname.replace('/', '_'))
+    return settings.LAYER_FETCH_DIR
+
+def ensure_worktree(repodir, logger=None):
+    """
+    If repodir is a worktree path (as returned by get_worktree_base()) and
+    the worktree doesn't exist yet, create it from the corresponding
+    repository in the fetch directory
+    """
+    basedir = os.path.dirname(os.path.abspath(repodir))
+    if os.path.basename(os.path.dirname(basedir)) != WORKTREE_DIR:
+        return
+    if os.path.exists(os.path.join(repodir, '.git')):
+        return
+    fetchdir = os.path.dirname(os.path.dirname(basedir))
+    mainrepodir = os.path.join(fetchdir, os.path.basename(repodir))
+    if not os.path.exists(basedir):
+        os.makedirs(basedir)
+    # Clear out any record of a worktree that has since been deleted
+    runcmd(['git', 'worktree', 'prune'], mainrepodir, logger=logger)
+    runcmd(['git', 'worktree', 'add', '--detach', repodir, 'HEAD'], mainrepodir, logger=logger)
+
+SHARED_STORE_DIR = 'shared-objects.git'
+
+def clone_repo(vcs_url, urldir, fetchdir, logger=None, printerr=True):
+    """
+    Clone a repository into the fetch directory. If LAYER_SHARED_OBJECTS is
+    enabled, objects are borrowed from (and then added to) a shared bare
+    repository in the fetch directory, so that forks and mirrors of the
+    same upstream repository don't each need a full copy of its history.
+    If LAYER_PARTIAL_CLONE is enabled, file contents are not fetched until
+    they are needed (i.e. on checkout).
+    """
+    import settings
+    shared_objects = getattr(settings, 'LAYER_SHARED_OBJECTS', False)
+    partial_clone = getattr(settings, 'LAYER_PARTIAL_CLONE', False)
+
+    cmd = ['git', 'clone']
+    if shared_objects:
+        storedir = os.path.join(fetchdir, SHARED_STORE_DIR)
+        if not os.path.exists(storedir):
+            runcmd(['git', 'init', '-q', '--bare', storedir], fetchdir, logger=logger)
+        cmd += ['--reference-if-able', storedir]
+    if partial_clone:
+        cmd += ['--filter=blob:none']
+    cmd += [vcs_url, urldir]
+    output = runcmd(cmd, fetchdir, logger=logger, printerr=printerr)
+
+    if shared_objects:
+        # Add this repository's objects to the shared store (under its own
+        # refs so that they are kept) and then drop our copies of any
+        # objects that the store already has. Neither of these is fatal.
+        repodir = os.path.join(fetchdir, urldir)
+        try:
+            runcmd(['git', '--git-dir=%s' % storedir, 'fetch', '-q', '--no-tags', repodir,
+                    '+refs/remotes/origin/*:refs/remotes/%s/*' % urldir], fetchdir, logger=logger, printerr=False)
+            runcmd(['git', 'repack', '-a', '-d', '-l', '-q'], repodir, logger=logger, printerr=False)
+        except subprocess.CalledProcessError as e:
+            if logger:
+                logger.warning('Unable to add %s to shared object store: %s' % (vcs_url, e.output))
+    return output
+
 def is_layer_valid(layerdir):
     conf_file = os.path.join(layerdir, "conf", "layer.conf")
     if not os.path.isfile(conf_file):
@@ -386,6 +470,7 @@ def lock_file(fn, timeout=30, logger=None):
                 last = current
                 logger.info('Trying to get lock on %s (tried %s seconds) ...' % (fn, (5 * counter)))
                 counter += 1
+            time.sleep(0.5)
 
 def unlock_file(lock):
     fcntl.flock(lock, fcntl.LOCK_UN)
@@ -416,6 +501,101 @@ def chain_unique(*iterables):
                 seen.add(k)
                 yield item
 
+class MergedQuerySet:
+    """
+    Read-only concatenation of a series of querysets, which must not
+    overlap. Unlike chaining the querysets together into a list, nothing
+    is fetched until it is needed: the length comes from count queries
+    and slicing only fetches the rows within the slice from each queryset,
+    so this can be handed to a paginator.
+    """
+    def __init__(self, *querysets, cache_key=None):
+        self.querysets = querysets
+        self.cache_key = cache_key
+        self._counts = None
+
+    def counts(self):
+        if self._counts is None:
+            countfunc = lambda: [qs.count() for qs in self.querysets]
+            if self.cache_key:
+                self._counts = cached_result('%s:counts' % self.cache_key, countfunc)
+            else:
+                self._counts = countfunc()
+        return self._counts
+
+    def count(self):
+        return sum(self.counts())
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return self.count() > 0
+
+    def __iter__(self):
+        for qs in self.querysets:
+            for item in qs:
+                yield item
+
+    def _slice(self, start, stop):
+        items = []
+        offset = 0
+        for qs, count in zip(self.querysets, self.counts()):
+            if count and start < offset + count and stop > offset:
+                items.extend(qs[max(start - offset, 0):min(stop - offset, count)])
+            offset += count
+            if offset >= stop:
+                break
+        return items
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return list(self)[key]
+            start, stop, _ = key.indices(self.count())
+            if self.cache_key:
+                return cached_result('%s:%d:%d' % (self.cache_key, start, stop), lambda: self._slice(start, stop))
+            return self._slice(start, stop)
+        else:
+            if key < 0:
+                key += self.count()
+            offset = 0
+            for qs, count in zip(self.querysets, self.counts()):
+                if key < offset + count:
+                    return qs[key - offset]
+                offset += count
+            raise IndexError('MergedQuerySet index out of range')
+
+def branch_cache_key(name, branches, *args):
+    """
+    Get a key for caching a result calculated from data on the specified
+    branches (a Branch queryset) and any other arguments it depends upon.
+    The key includes the generations of the branches, so it changes as soon
+    as anything on those branches does and a cached result is never stale.
+    Only pass the branches the result actually depends upon, since a
+    change to any of them discards it.
+    """
+    import hashlib
+    from django.db.models import Count, Max, Sum
+    # Generations only ever go up and ids are never reused, so this (a
+    # single row however many branches there are) changes whenever any of
+    # the branches changes or a branch is added or removed
+    state = branches.aggregate(Count('id'), Max('id'), Sum('generation'), Max('updated'))
+    return 'layerindex:%s:%s' % (name, hashlib.md5(repr((sorted(state.items()), args)).encode('utf-8')).hexdigest())
+
+def cached_result(key, func):
+    """
+    Get the value cached under key, or if there isn't one, call func() to
+    calculate it and cache that
+    """
+    import settings
+    from django.core.cache import cache
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, getattr(settings, 'QUERY_CACHE_TIMEOUT', 86400))
+    return value
+
 def setup_core_layer_sys_path(settings, branchname):
     """
     Add OE-Core's lib/oe directory to sys.path in order to allow importing
@@ -425,7 +605,7 @@ def setup_core_layer_sys_path(settings, branchname):
     core_layerbranch = core_layer.get_layerbranch(branchname)
     if core_layerbranch:
         core_urldir = core_layer.get_fetch_dir()
-        core_repodir = os.path.join(settings.LAYER_FETCH_DIR, core_urldir)
+        core_repodir = os.path.join(get_worktree_base(settings, branchname), core_urldir)
         core_layerdir = os.path.join(core_repodir, core_layerbranch.vcs_subdir)
         sys.path.insert(0, os.path.join(core_layerdir, 'lib'))
 
@@ -444,22 +624,106 @@ def run_command_interruptible(cmd):
             cmd, cwd=os.path.dirname(sys.argv[0]), shell=True, preexec_fn=reenable_sigint, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
         )
 
-        reader = codecs.getreader('utf-8')(process.stdout, errors='surrogateescape')
-        buf = ''
+        # Read whatever is available rather than a character at a time
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='surrogateescape')
+        fd = process.stdout.fileno()
+        buf = []
         while True:
-            out = reader.read(1, 1)
+            data = os.read(fd, 65536)
+            out = decoder.decode(data, final=not data)
             if out:
                 sys.stdout.write(out)
                 sys.stdout.flush()
-                buf += out
-            elif out == '' and process.poll() != None:
+                buf.append(out)
+            if not data:
                 break
-
+        process.stdout.close()
+        process.wait()
+        buf = ''.join(buf)
     finally:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
     return process.returncode, buf
 
 
+class CapturedOutput():
+    """Output captured by capture_output(), available via read() once capture has finished"""
+    def __init__(self, tmpfile):
+        self.tmpfile = tmpfile
+        self.data = ''
+
+    def finish(self):
+        self.tmpfile.seek(0)
+        self.data = self.tmpfile.read().decode('utf-8', errors='replace')
+        self.tmpfile.close()
+
+    def read(self):
+        return self.data
+
+@contextlib.contextmanager
+def capture_output():
+    """
+    Capture everything written to stdout and stderr while the context is
+    active. This is done at the file descriptor level so that output from
+    subprocesses (and anything else that doesn't go through sys.stdout /
+    sys.stderr) is captured as well.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    tmpfile = tempfile.TemporaryFile()
+    saved_fds = (os.dup(1), os.dup(2))
+    os.dup2(tmpfile.fileno(), 1)
+    os.dup2(tmpfile.fileno(), 2)
+    captured = CapturedOutput(tmpfile)
+    try:
+        yield captured
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+        captured.finish()
+
+# Prefix for the line in update_layer.py's output that reports its timings
+TIMINGS_PREFIX = 'LAYERUPDATE_TIMINGS: '
+
+def format_timings(timings):
+    """Format a dict of phase timings for reporting back to update.py"""
+    import json
+    return '%s%s' % (TIMINGS_PREFIX, json.dumps(dict([(k, round(v, 3)) for k, v in timings.items()]), sort_keys=True))
+
+def extract_timings(output):
+    """
+    Remove timings lines (see format_timings()) from command output,
+    returning a tuple of (output, timings dict). Timings for the same
+    phase reported more than once are added together.
+    """
+    import json
+    timings = {}
+    lines = []
+    for line in output.splitlines(True):
+        if line.startswith(TIMINGS_PREFIX):
+            try:
+                for phase, value in json.loads(line[len(TIMINGS_PREFIX):]).items():
+                    timings[phase] = timings.get(phase, 0) + value
+                continue
+            except ValueError:
+                pass
+        lines.append(line)
+    return (''.join(lines), timings)
+
+def get_rss():
+    """Get the current resident set size of this process (in bytes)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Not on Linux, fall back to the peak value
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def sanitise_html(html):
     soup = BeautifulSoup(html, "html.parser")
     for tag in soup.findAll(True):
@@ -576,11 +840,14 @@ class ProgressReader():
                 self.logger.warning('Failed to read progress: %s' % str(e))
         return result
 
+def split_query(querystr):
+    return [item for item in re.split(r"\s|\"(.*)?\"|'.*?'", querystr) if item]
+
 def string_to_query(querystr, fieldnames):
     # Inspired by http://julienphalip.com/post/2825034077/adding-search-to-a-django-site-in-a-snap
     # (reimplemented a bit more simply)
     from django.db.models import Q
-    keywords = [item for item in re.split(r"\s|\"(.*)?\"|'.*?'", querystr) if item]
+    keywords = split_query(querystr)
     query = None
     for keyword in keywords:
         fquery = None
@@ -596,6 +863,118 @@ def string_to_query(querystr, fieldnames):
             query = query & fquery
     return query
 
+# Recipe fields covered by the full-text index (see migration 0046)
+RECIPE_FULLTEXT_FIELDS = ['pn', 'summary', 'description']
+RECIPE_FULLTEXT_TABLE = 'layerindex_recipe_fts'
+_sqlite_fulltext = None
+_mysql_fulltext_limits = None
+
+def recipe_fulltext_available():
+    """Check whether we have a full-text index over recipes in this database"""
+    global _sqlite_fulltext
+    import settings
+    from django.db import connection
+    if not getattr(settings, 'RECIPE_FULLTEXT_SEARCH', True):
+        return False
+    if connection.vendor in ['mysql', 'postgresql']:
+        return True
+    elif connection.vendor == 'sqlite':
+        if _sqlite_fulltext is None:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=%s", [RECIPE_FULLTEXT_TABLE])
+                _sqlite_fulltext = bool(cursor.fetchone())
+        return _sqlite_fulltext
+    return False
+
+def get_mysql_fulltext_limits():
+    """
+    Get the minimum word length and the set of stopwords for MySQL's
+    full-text index on the recipe table - words that are shorter or are
+    stopwords aren't indexed, and so never match. These depend on the
+    server configuration and the storage engine, so we ask the server.
+    """
+    global _mysql_fulltext_limits
+    import settings
+    from django.db import connection
+    if _mysql_fulltext_limits is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT engine FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = 'layerindex_recipe'")
+            row = cursor.fetchone()
+            myisam = bool(row and row[0] and row[0].lower() == 'myisam')
+            if myisam:
+                cursor.execute("SHOW VARIABLES LIKE 'ft_min_word_len'")
+            else:
+                cursor.execute("SHOW VARIABLES LIKE 'innodb_ft_min_token_size'")
+            row = cursor.fetchone()
+            if row:
+                minlen = int(row[1])
+            elif myisam:
+                minlen = 4
+            else:
+                minlen = 3
+            stopwords = set()
+            if not myisam:
+                cursor.execute("SHOW VARIABLES LIKE 'innodb_ft_enable_stopword'")
+                row = cursor.fetchone()
+                if not row or row[1].upper() in ['ON', '1']:
+                    cursor.execute("SHOW VARIABLES LIKE 'innodb_ft_server_stopword_table'")
+                    row = cursor.fetchone()
+                    if row and row[1]:
+                        # Value is of the form db_name/table_name
+                        cursor.execute('SELECT value FROM %s' % '.'.join(['`%s`' % item for item in row[1].split('/')]))
+                    else:
+                        cursor.execute('SELECT value FROM information_schema.innodb_ft_default_stopword')
+                    stopwords = set([value.lower() for (value,) in cursor.fetchall()])
+        # MyISAM has a built-in stopword list that can't be read from the
+        # server, so that (or any custom one) has to be given in settings
+        stopwords.update([word.lower() for word in getattr(settings, 'RECIPE_FULLTEXT_STOPWORDS', [])])
+        _mysql_fulltext_limits = (minlen, stopwords)
+    return _mysql_fulltext_limits
+
+def recipe_fulltext_filter(qs, querystr):
+    """
+    Filter a Recipe (or ClassicRecipe) queryset to those whose name, summary
+    or description contain words starting with each of the words in the
+    query, using the database's full-text index. Note that unlike substring
+    matching, this doesn't find words in the middle of other words (e.g.
+    "ssl" doesn't match "openssl" in a description), so callers should fall
+    back to substring matching if nothing is found. Words that the index
+    can't match (those that are too short or are stopwords on MySQL) fall
+    back to substring matching on summary and description, as does the
+    whole query if there is no index.
+    """
+    from django.db import connection
+    from django.db.models.expressions import RawSQL
+    words = []
+    for keyword in split_query(querystr):
+        words.extend(re.findall(r'\w+', keyword))
+    if not (words and recipe_fulltext_available()):
+        return qs.filter(string_to_query(querystr, ['description', 'summary']))
+
+    if connection.vendor == 'mysql':
+        (minlen, stopwords) = get_mysql_fulltext_limits()
+        otherwords = [word for word in words if len(word) < minlen or word.lower() in stopwords]
+        if otherwords:
+            qs = qs.filter(string_to_query(' '.join(otherwords), ['description', 'summary']))
+            words = [word for word in words if word not in otherwords]
+            if not words:
+                return qs
+
+    # The match is done in a self-contained subquery so that it doesn't
+    # depend on table aliases, and thus still works when the queryset is
+    # itself used as a subquery
+    if connection.vendor == 'mysql':
+        sql = 'SELECT id FROM layerindex_recipe WHERE MATCH (pn, summary, description) AGAINST (%s IN BOOLEAN MODE)'
+        param = ' '.join(['+%s*' % word for word in words])
+    elif connection.vendor == 'postgresql':
+        # Must match the expression in the index
+        sql = "SELECT id FROM layerindex_recipe WHERE to_tsvector('simple', pn || ' ' || summary || ' ' || description) @@ to_tsquery('simple', %s)"
+        param = ' & '.join(['%s:*' % word for word in words])
+    else:
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (RECIPE_FULLTEXT_TABLE, RECIPE_FULLTEXT_TABLE)
+        param = ' '.join(['"%s"*' % word for word in words])
+    return qs.filter(id__in=RawSQL(sql, [param]))
+
 def validate_vcs_url(url):
     from django.core.exceptions import ValidationError
     res = re.match(r'^([a-z]+)://[^ ]+$', url)
@@ -19,20 +19,20 @@ from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import Permission, User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sites.models import Site
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import EmptyResultSet, PermissionDenied
 from django.core.urlresolvers import resolve, reverse, reverse_lazy
 from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import Count, Exists, OuterRef, Q, prefetch_related_objects
 from django.db.models.functions import Lower
 from django.db.models.query import QuerySet
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_list_or_404, get_object_or_404, render
 from django.template.loader import get_template
 from django.utils.decorators import method_decorator
 from django.utils.html import escape
-from django.views.decorators.cache import never_cache
+from django.views.decorators.cache import cache_page, never_cache
 from django.views.generic import DetailView, ListView, TemplateView
 from django.views.generic.base import RedirectView
 from django.views.generic.edit import (CreateView, DeleteView, FormView,
@@ -49,7 +49,7 @@ from layerindex.forms import (AdvancedRecipeSearchForm, BulkChangeEditFormSet,
                               LayerMaintainerFormSet, RecipeChangesetForm,
                               PatchDispositionForm, PatchDispositionFormSet)
 from layerindex.models import (BBAppend, BBClass, Branch, ClassicRecipe,
-                               Distro, DynamicBuildDep, IncFile, LayerBranch,
+                               Distro, DuplicateItem, DynamicBuildDep, IncFile, LayerBranch,
                                LayerDependency, LayerItem, LayerMaintainer,
                                LayerNote, LayerUpdate, Machine, Patch, Recipe,
                                RecipeChange, RecipeChangeset, Source, StaticBuildDep,
@@ -450,28 +450,6 @@ class LayerReviewDetailView(LayerDetailView):
         return context
 
 
-def recipes_preferred_count(qs):
-    # Add extra column so we can show "duplicate" recipes from other layers de-emphasised
-    # (it's a bit crude having to do this using SQL but I couldn't find a better way...)
-    return qs.extra(
-        select={
-            'preferred_count': """SELECT COUNT(1)
-FROM layerindex_recipe AS recipe2
-, layerindex_layerbranch as branch2
-, layerindex_layeritem as layer1
-, layerindex_layeritem as layer2
-WHERE branch2.id = recipe2.layerbranch_id
-AND layer2.id = branch2.layer_id
-AND layer2.layer_type in ('S', 'A')
-AND branch2.branch_id = layerindex_layerbranch.branch_id
-AND recipe2.pn = layerindex_recipe.pn
-AND recipe2.layerbranch_id <> layerindex_recipe.layerbranch_id
-AND layer1.id = layerindex_layerbranch.layer_id
-AND layer2.index_preference > layer1.index_preference
-"""
-        },
-    )
-
 class RecipeSearchView(ListView):
     context_object_name = 'recipe_list'
     paginate_by = 50
@@ -482,41 +460,48 @@ class RecipeSearchView(ListView):
         else:
             return super(ListView, self).render_to_response(context, **kwargs)
 
-    def search_recipe_query(self, init_qs, query_string, preferred=True):
-        """Do a prioritised search using the specified keyword (if any)"""
+    def search_recipe_query(self, init_qs, query_string, branchname):
+        """
+        Do a prioritised search using the specified keyword (if any). init_qs
+        must only return recipes on the specified branch.
+        """
         # Lower() here isn't needed for OE recipes since we don't use uppercase
         # but we use this same code for "recipes" from other distros where
         # they do
-        order_by = (Lower('pn'), 'layerbranch__layer')
+        # (id is there to make the order total, since each page is fetched
+        # separately and otherwise rows could move between pages)
+        order_by = (Lower('pn'), 'layerbranch__layer', 'id')
 
         filtered = False
         if query_string.strip():
             # First search by exact name
             qs0 = init_qs.filter(pn=query_string).order_by(*order_by)
-            if preferred:
-                qs0 = recipes_preferred_count(qs0)
 
             # Then keyword somewhere in the name
-            entry_query = utils.string_to_query(query_string, ['pn'])
-            qs1 = init_qs.filter(entry_query).order_by(*order_by)
-            if preferred:
-                qs1 = recipes_preferred_count(qs1)
-
-            # Then keyword somewhere in summary or description
-            entry_query = utils.string_to_query(query_string, ['description', 'summary'])
-            qs2 = init_qs.filter(entry_query).order_by(*order_by)
-            if preferred:
-                qs2 = recipes_preferred_count(qs2)
-
-            # Now chain the results together and drop any duplicates (e.g.
-            # if the keyword matched in the name and summary)
-            qs = list(utils.chain_unique(qs0, qs1, qs2))
+            name_query = utils.string_to_query(query_string, ['pn'])
+            qs1 = init_qs.filter(name_query).exclude(pn=query_string).order_by(*order_by)
+
+            # Then keyword somewhere in summary or description (using the
+            # full-text index if there is one)
+            qs2 = utils.recipe_fulltext_filter(init_qs, query_string).exclude(pn=query_string).exclude(name_query).order_by(*order_by)
+            if utils.recipe_fulltext_available() and not qs2.exists():
+                # The index only matches the start of words, so if that
+                # finds nothing, try substrings (e.g. "ssl" in "openssl")
+                qs2 = init_qs.filter(utils.string_to_query(query_string, ['description', 'summary'])).exclude(pn=query_string).exclude(name_query).order_by(*order_by)
+
+            # Now put the results together - the queries above don't overlap
+            # (e.g. if the keyword matched in the name and summary it's only
+            # in qs1), so the rows for a page can be fetched without fetching
+            # all of the ones before it
+            try:
+                cache_key = utils.branch_cache_key('recipesearch', Branch.objects.filter(name=branchname), [str(subqs.query) for subqs in (qs0, qs1, qs2)])
+            except EmptyResultSet:
+                cache_key = None
+            qs = utils.MergedQuerySet(qs0, qs1, qs2, cache_key=cache_key)
             filtered = True
         elif 'q' in self.request.GET:
             # User clicked search with no query string, return all records
             qs = init_qs.order_by(*order_by)
-            if preferred:
-                qs = list(recipes_preferred_count(qs))
         else:
             # It's a bit too slow to return all records by default, and most people
             # won't actually want that (if they do they can just hit the search button
@@ -529,7 +514,7 @@ class RecipeSearchView(ListView):
         query_string = self.request.GET.get('q', '')
         init_qs = Recipe.objects.filter(layerbranch__branch__name=self.kwargs['branch'])
 
-        # Support slightly crude search on inherits field
+        # Support search on inherits
         query_items = query_string.split()
         inherits = []
         query_terms = []
@@ -567,12 +552,10 @@ layer name is expected to follow the \"layer:\" prefix without any spaces.')
                                             % query_layername)
             else:
                 query_terms.append(item)
-        if inherits:
-            # FIXME This is a bit ugly, perhaps we should consider having this as a one-many relationship instead
-            for inherit in inherits:
-                init_qs = init_qs.filter(Q(inherits=inherit) | Q(inherits__startswith=inherit + ' ') | Q(inherits__endswith=' ' + inherit) | Q(inherits__contains=' %s ' % inherit))
+        for inherit in inherits:
+            init_qs = init_qs.filter(recipeinherit__name=inherit)
         query_string = ' '.join(query_terms)
-        qs, _ = self.search_recipe_query(init_qs, query_string, preferred=False)
+        qs, _ = self.search_recipe_query(init_qs, query_string, self.kwargs['branch'])
         return qs
 
     def get_context_data(self, **kwargs):
@@ -586,42 +569,100 @@ layer name is expected to follow the \"layer:\" prefix without any spaces.')
         return context
 
 class DuplicatesView(TemplateView):
-    def get_recipes(self, layer_ids):
-        init_qs = Recipe.objects.filter(layerbranch__branch__name=self.kwargs['branch'])
-        if layer_ids:
-            init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
-        dupes = init_qs.values('pn').annotate(Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1)
-        qs = init_qs.all().filter(pn__in=[item['pn'] for item in dupes]).order_by('pn', 'layerbranch__layer', '-pv')
-        return recipes_preferred_count(qs)
+    # The duplicates are precalculated for each branch by update.py (see
+    # DuplicateItem), so these only need to look at those items
+    def get_recipes(self, branch, layer_ids):
+        return Recipe.objects.filter(id__in=DuplicateItem.get_items(branch, 'R', layer_ids)).order_by('pn', 'layerbranch__layer', '-pv')
 
-    def get_classes(self, layer_ids):
-        init_qs = BBClass.objects.filter(layerbranch__branch__name=self.kwargs['branch'])
-        if layer_ids:
-            init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
-        dupes = init_qs.values('name').annotate(Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1)
-        qs = init_qs.all().filter(name__in=[item['name'] for item in dupes]).order_by('name', 'layerbranch__layer')
-        return qs
+    def get_classes(self, branch, layer_ids):
+        return BBClass.objects.filter(id__in=DuplicateItem.get_items(branch, 'C', layer_ids)).order_by('name', 'layerbranch__layer')
 
-    def get_incfiles(self, layer_ids):
-        init_qs = IncFile.objects.filter(layerbranch__branch__name=self.kwargs['branch'])
-        if layer_ids:
-            init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
-        dupes = init_qs.values('path').annotate(Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1)
-        qs = init_qs.all().filter(path__in=[item['path'] for item in dupes]).order_by('path', 'layerbranch__layer')
-        return qs
+    def get_incfiles(self, branch, layer_ids):
+        return IncFile.objects.filter(id__in=DuplicateItem.get_items(branch, 'I', layer_ids)).order_by('path', 'layerbranch__layer')
 
     def get_context_data(self, **kwargs):
         layer_ids = [int(i) for i in self.request.GET.getlist('l')]
         context = super(DuplicatesView, self).get_context_data(**kwargs)
-        context['recipes'] = self.get_recipes(layer_ids)
-        context['classes'] = self.get_classes(layer_ids)
-        context['incfiles'] = self.get_incfiles(layer_ids)
+        branch = get_object_or_404(Branch, name=self.kwargs['branch'])
+        cache_key = utils.branch_cache_key('duplicates', Branch.objects.filter(id=branch.id), sorted(layer_ids))
+        context['recipes'] = utils.cached_result('%s:recipes' % cache_key, lambda: list(self.get_recipes(branch, layer_ids).select_related('layerbranch__layer')))
+        context['classes'] = utils.cached_result('%s:classes' % cache_key, lambda: list(self.get_classes(branch, layer_ids).select_related('layerbranch__layer')))
+        context['incfiles'] = utils.cached_result('%s:incfiles' % cache_key, lambda: list(self.get_incfiles(branch, layer_ids).select_related('layerbranch__layer')))
         context['url_branch'] = self.kwargs['branch']
         context['this_url_name'] = resolve(self.request.path_info).url_name
         context['layers'] = LayerBranch.objects.filter(branch__name=self.kwargs['branch']).filter(layer__status__in=['P', 'X']).order_by( 'layer__name')
         context['showlayers'] = layer_ids
         return context
 
+class RecipeVersionMatrixView(ListView):
+    """
+    Versions of recipes across all branches at once, for recipes matching a
+    search and/or within a layer. Paginated by recipe name; the versions for
+    each page are fetched in a single query and cached until one of the
+    branches changes.
+    """
+    context_object_name = 'pn_list'
+    paginate_by = 50
+
+    def get_branches(self):
+        return Branch.objects.filter(comparison=False, hidden=False).order_by('sort_priority')
+
+    def get_layer(self):
+        layername = self.request.GET.get('layer', '')
+        if layername:
+            return get_object_or_404(LayerItem, name=layername)
+        return None
+
+    def get_queryset(self):
+        self.branchqs = self.get_branches()
+        self.branches = list(self.branchqs)
+        self.layer = self.get_layer()
+        query_string = self.request.GET.get('q', '')
+        init_qs = Recipe.objects.filter(layerbranch__branch__in=self.branches)
+        if self.layer:
+            init_qs = init_qs.filter(layerbranch__layer=self.layer)
+        elif not query_string.strip():
+            # Everything in every branch is too much for one page
+            return Recipe.objects.none().values_list('pn', flat=True)
+        if query_string.strip():
+            init_qs = init_qs.filter(utils.string_to_query(query_string, ['pn']))
+        return init_qs.order_by('pn').values_list('pn', flat=True).distinct()
+
+    def get_matrix(self, pns):
+        def get_rows():
+            qs = Recipe.objects.filter(layerbranch__branch__in=self.branches, pn__in=pns)
+            if self.layer:
+                qs = qs.filter(layerbranch__layer=self.layer)
+            versions = {}
+            for pn, branch_id, pv in qs.values_list('pn', 'layerbranch__branch_id', 'pv').distinct():
+                versions.setdefault(pn, {}).setdefault(branch_id, []).append(pv)
+            rows = []
+            for pn in pns:
+                branchversions = versions.get(pn, {})
+                rows.append((pn, [', '.join(sorted(branchversions.get(branch.id, []))) for branch in self.branches]))
+            return rows
+
+        return utils.cached_result(utils.branch_cache_key('recipeversions', self.branchqs, self.layer.id if self.layer else None, pns), get_rows)
+
+    def get_context_data(self, **kwargs):
+        context = super(RecipeVersionMatrixView, self).get_context_data(**kwargs)
+        context['search_keyword'] = self.request.GET.get('q', '')
+        context['layer'] = self.layer
+        context['branches'] = self.branches
+        context['matrix'] = self.get_matrix(list(context['pn_list']))
+        return context
+
+    def render_to_response(self, context, **kwargs):
+        if self.request.GET.get('format', '') == 'json':
+            branchnames = [branch.name for branch in self.branches]
+            page = context['page_obj']
+            data = {'branches': branchnames,
+                    'page': page.number if page else 1,
+                    'num_pages': page.paginator.num_pages if page else 1,
+                    'recipes': [{'pn': pn, 'versions': dict(zip(branchnames, pvs))} for pn, pvs in context['matrix']]}
+            return JsonResponse(data)
+        return super(RecipeVersionMatrixView, self).render_to_response(context, **kwargs)
+
 class AdvancedRecipeSearchView(ListView):
     context_object_name = 'recipe_list'
     paginate_by = 50
@@ -1020,25 +1061,78 @@ class RecipeDetailView(DetailView):
         return context
 
 
+def _pair_query(pairs, layerbranchfield, pnfield):
+    """Get a Q object matching any of the specified (layerbranch id, pn) pairs"""
+    pns = {}
+    for layerbranch_id, pn in pairs:
+        pns.setdefault(layerbranch_id, set()).add(pn)
+    query = Q(pk__in=[])
+    for layerbranch_id, pnset in pns.items():
+        query |= Q(**{layerbranchfield: layerbranch_id, '%s__in' % pnfield: pnset})
+    return query
+
+def _compare_versions(pvpairs):
+    """
+    Compare pairs of versions, parsing each distinct version only once.
+    Returns a list of -1/0/1 in the same order as pvpairs.
+    """
+    parsed = {}
+    def get_version(pv):
+        ver = parsed.get(pv, None)
+        if ver is None:
+            ver = parse_version(pv)
+            parsed[pv] = ver
+        return ver
+    results = []
+    for from_pv, to_pv in pvpairs:
+        if from_pv and to_pv:
+            from_ver = get_version(from_pv)
+            to_ver = get_version(to_pv)
+            results.append((to_ver > from_ver) - (to_ver < from_ver))
+        else:
+            results.append(0)
+    return results
+
 class LinkWrapper:
+    """
+    Wraps a queryset (or list) so that items are annotated with extra
+    information as they are fetched. Items are annotated a batch (e.g.
+    a page) at a time, so that subclasses can fetch what they need for
+    the whole batch in a fixed number of queries.
+    """
+    batch_size = 500
+
     def __init__(self, queryset):
         self.queryset = queryset
 
     def __iter__(self):
-        for obj in self.queryset:
-            self._annotate(obj)
-            yield obj
+        it = iter(self.queryset)
+        while True:
+            items = list(islice(it, self.batch_size))
+            if not items:
+                break
+            self._annotate_items(items)
+            for item in items:
+                yield item
 
     def _slice(self, start, stop, step=1):
-        for item in islice(self.queryset, start, stop, step):
+        if step in (None, 1) and hasattr(self.queryset, 'count'):
+            # Let the queryset fetch only what's needed
+            items = list(self.queryset[start:stop])
+        else:
+            items = list(islice(self.queryset, start, stop, step))
+        self._annotate_items(items)
+        return items
+
+    def _annotate_items(self, items):
+        for item in items:
             self._annotate(item)
-            yield item
 
     def __getitem__(self, key):
         if isinstance(key, slice):
             return self._slice(key.start, key.stop, key.step)
         else:
-            return next(self._slice(key, key+1))
+            return self._slice(key, key+1)[0]
 
     def __len__(self):
         if isinstance(self.queryset, QuerySet):
@@ -1049,21 +1143,25 @@ class LinkWrapper:
 class ClassicRecipeLinkWrapper(LinkWrapper):
     # This function is required by generic views, create another proxy
     def _clone(self):
-        return ClassicRecipeLinkWrapper(self.queryset._clone(), **self.kwargs)
-
-    def _annotate(self, obj):
-        recipe = None
-        vercmp = 0
-        if obj.cover_layerbranch and obj.cover_pn:
-            rq = Recipe.objects.filter(layerbranch=obj.cover_layerbranch).filter(pn=obj.cover_pn)
-            if rq:
-                recipe = rq.first()
-                if obj.pv and recipe.pv:
-                    obj_ver = parse_version(obj.pv)
-                    recipe_ver = parse_version(recipe.pv)
-                    vercmp = ((recipe_ver > obj_ver) - (recipe_ver < obj_ver))
-        setattr(obj, 'cover_recipe', recipe)
-        setattr(obj, 'cover_vercmp', vercmp)
+        return ClassicRecipeLinkWrapper(self.queryset._clone())
+
+    def _annotate_items(self, items):
+        if not items:
+            return
+        prefetch_related_objects(items, 'layerbranch__layer', 'cover_layerbranch__layer')
+        # Find the covering recipes (first one by id for each layerbranch/pn,
+        # as before) along with their patch counts
+        pairs = set([(obj.cover_layerbranch_id, obj.cover_pn) for obj in items if obj.cover_layerbranch_id and obj.cover_pn])
+        cover_recipes = {}
+        if pairs:
+            for recipe in Recipe.objects.filter(_pair_query(pairs, 'layerbranch_id', 'pn')).annotate(patch_count=Count('patch')).order_by('id'):
+                cover_recipes.setdefault((recipe.layerbranch_id, recipe.pn), recipe)
+        patch_counts = dict(Patch.objects.filter(recipe_id__in=[obj.id for obj in items]).values_list('recipe_id').annotate(Count('id')))
+        vercmps = _compare_versions([(obj.pv, getattr(cover_recipes.get((obj.cover_layerbranch_id, obj.cover_pn), None), 'pv', None)) for obj in items])
+        for obj, vercmp in zip(items, vercmps):
+            setattr(obj, 'cover_recipe', cover_recipes.get((obj.cover_layerbranch_id, obj.cover_pn), None))
+            setattr(obj, 'cover_vercmp', vercmp)
+            setattr(obj, 'patch_count', patch_counts.get(obj.id, 0))
 
 class ClassicRecipeReverseLinkWrapper(LinkWrapper):
     def __init__(self, queryset, branch, from_branch=None):
@@ -1073,24 +1171,26 @@ class ClassicRecipeReverseLinkWrapper(LinkWrapper):
 
     # This function is required by generic views, create another proxy
     def _clone(self):
-        return ClassicRecipeReverseLinkWrapper(self.queryset._clone(), **self.kwargs)
+        return ClassicRecipeReverseLinkWrapper(self.queryset._clone(), self.branch, self.from_branch)
 
-    def _annotate(self, obj):
-        recipe = None
-        vercmp = 0
+    def _annotate_items(self, items):
+        if not items:
+            return
+        prefetch_related_objects(items, 'layerbranch__layer')
         if self.from_branch:
-            from_branchobj = LayerBranch.objects.get(layer=obj.layerbranch.layer, branch__name=self.from_branch)
+            from_layerbranches = dict(LayerBranch.objects.filter(layer__in=set([obj.layerbranch.layer_id for obj in items]), branch__name=self.from_branch).values_list('layer_id', 'id'))
+            keys = [(from_layerbranches.get(obj.layerbranch.layer_id, None), obj.pn) for obj in items]
         else:
-            from_branchobj = obj.layerbranch
-        rq = ClassicRecipe.objects.filter(layerbranch__branch__name=self.branch).filter(cover_layerbranch=from_branchobj).filter(cover_pn=obj.pn)
-        if rq:
-            recipe = rq.first()
-            if obj.pv and recipe.pv:
-                obj_ver = parse_version(obj.pv)
-                recipe_ver = parse_version(recipe.pv)
-                vercmp = ((recipe_ver > obj_ver) - (recipe_ver < obj_ver))
-        setattr(obj, 'cover_recipe', recipe)
-        setattr(obj, 'cover_vercmp', vercmp)
+            keys = [(obj.layerbranch_id, obj.pn) for obj in items]
+        pairs = set([key for key in keys if key[0]])
+        cover_recipes = {}
+        if pairs:
+            for recipe in ClassicRecipe.objects.filter(layerbranch__branch__name=self.branch).filter(_pair_query(pairs, 'cover_layerbranch_id', 'cover_pn')).order_by('id'):
+                cover_recipes.setdefault((recipe.cover_layerbranch_id, recipe.cover_pn), recipe)
+        vercmps = _compare_versions([(obj.pv, getattr(cover_recipes.get(key, None), 'pv', None)) for obj, key in zip(items, keys)])
+        for obj, key, vercmp in zip(items, keys, vercmps):
+            setattr(obj, 'cover_recipe', cover_recipes.get(key, None))
+            setattr(obj, 'cover_vercmp', vercmp)
 
 
 class LayerCheckListView(ListView):
@@ -1098,7 +1198,8 @@ class LayerCheckListView(ListView):
 
     def get_queryset(self):
         _check_url_branch(self.kwargs)
-        return LayerBranch.objects.filter(branch__name=self.kwargs['branch']).filter(layer__status__in=['P', 'X']).order_by('layer__name')
+        qs = LayerBranch.objects.filter(branch__name=self.kwargs['branch']).filter(layer__status__in=['P', 'X']).order_by('layer__name').select_related('layer')
+        return utils.cached_result(utils.branch_cache_key('layerchecklist', Branch.objects.filter(name=self.kwargs['branch'])), lambda: list(qs))
 
 class BBClassCheckListView(ListView):
     context_object_name = 'classes'
@@ -1190,7 +1291,8 @@ class BBClassCheckListView(ListView):
                              'utility-tasks',
                              'utils',
                              ]
-        return BBClass.objects.filter(layerbranch__branch__name=self.kwargs['branch']).filter(layerbranch__layer__name=settings.CORE_LAYER_NAME).exclude(name__in=nonrecipe_classes).order_by('name')
+        qs = BBClass.objects.filter(layerbranch__branch__name=self.kwargs['branch']).filter(layerbranch__layer__name=settings.CORE_LAYER_NAME).exclude(name__in=nonrecipe_classes).order_by('name')
+        return utils.cached_result(utils.branch_cache_key('classchecklist', Branch.objects.filter(name=self.kwargs['branch'])), lambda: list(qs))
 
 
 class ClassicRecipeSearchView(RecipeSearchView):
@@ -1248,36 +1350,34 @@ class ClassicRecipeSearchView(RecipeSearchView):
             else:
                 init_qs = init_qs.filter(needs_attention=False)
             filtered = True
-        qs, filtered = self.search_recipe_query(init_qs, query_string, preferred=False)
+        qs, filtered = self.search_recipe_query(init_qs, query_string, self.kwargs['branch'])
         if qreversed:
             init_rqs = Recipe.objects.filter(layerbranch__branch__name='master')
             if layer_ids:
                 init_rqs = init_rqs.filter(layerbranch__layer__id__in=layer_ids)
             excludeclasses_param = self.request.GET.get('excludeclasses', '')
             if excludeclasses_param:
-                for inherit in excludeclasses_param.split(','):
-                    init_rqs = init_rqs.exclude(inherits=inherit).exclude(inherits__startswith=inherit + ' ').exclude(inherits__endswith=' ' + inherit).exclude(inherits__contains=' %s ' % inherit)
-            all_values = []
+                init_rqs = init_rqs.exclude(recipeinherit__name__in=excludeclasses_param.split(','))
+            rqs = init_rqs.select_related('layerbranch__layer').order_by(Lower('pn'), 'layerbranch__layer', 'id')
             if filtered:
-                if isinstance(qs, list):
-                    values = []
-                    for item in qs:
-                        if item.cover_layerbranch and item.cover_pn:
-                            values.append((item.cover_layerbranch.id, item.cover_pn))
+                # Select the recipes covered by any of the matching comparison
+                # recipes (and if we're looking for recipes with no cover, the
+                # ones not covered by any comparison recipe), using EXISTS
+                # subqueries rather than checking each recipe individually
+                if isinstance(qs, utils.MergedQuerySet):
+                    querysets = qs.querysets
                 else:
-                    values = qs.filter(cover_layerbranch__isnull=False).filter(cover_pn__isnull=False).values_list('cover_layerbranch__id', 'cover_pn').distinct()
+                    querysets = [qs]
+                coverq = Q(pk__in=[])
+                for i, subqs in enumerate(querysets):
+                    field = 'covered_%d' % i
+                    rqs = rqs.annotate(**{field: Exists(subqs.filter(cover_layerbranch=OuterRef('layerbranch'), cover_pn=OuterRef('pn')).order_by().values('id'))})
+                    coverq |= Q(**{field: True})
                 if cover_null:
-                    all_values = ClassicRecipe.objects.filter(layerbranch__branch__name=self.kwargs['branch']).filter(deleted=False).filter(cover_layerbranch__isnull=False).filter(cover_pn__isnull=False).values_list('cover_layerbranch__id', 'cover_pn').distinct()
-            else:
-                values = None
-            rqs = init_rqs.order_by(Lower('pn'), 'layerbranch__layer')
-            if filtered:
-                items = []
-                for item in rqs:
-                    recipe_values = (item.layerbranch.id, item.pn)
-                    if (cover_null and recipe_values not in all_values) or (recipe_values in values):
-                        items.append(item)
-                return ClassicRecipeReverseLinkWrapper(items, self.kwargs['branch'])
+                    all_qs = ClassicRecipe.objects.filter(layerbranch__branch__name=self.kwargs['branch']).filter(deleted=False)
+                    rqs = rqs.annotate(has_cover=Exists(all_qs.filter(cover_layerbranch=OuterRef('layerbranch'), cover_pn=OuterRef('pn')).order_by().values('id')))
+                    coverq |= Q(has_cover=False)
+                rqs = rqs.filter(coverq)
             return ClassicRecipeReverseLinkWrapper(rqs, self.kwargs['branch'])
         else:
             return ClassicRecipeLinkWrapper(qs)
@@ -1410,66 +1510,121 @@ class ClassicRecipeStatsView(TemplateView):
         context['branch'] = get_object_or_404(Branch, name=branchname)
         context['url_branch'] = branchname
         context['this_url_name'] = 'recipe_search'
-        # *** Cover status chart ***
-        recipes = ClassicRecipe.objects.filter(layerbranch__branch=context['branch']).filter(deleted=False)
-        statuses = []
-        status_counts = {}
-        for choice, desc in ClassicRecipe.COVER_STATUS_CHOICES:
-            count = recipes.filter(cover_status=choice).count()
-            if count > 0:
-                statuses.append(desc)
-                status_counts[desc] = count
-        statuses = sorted(statuses, key=lambda status: status_counts[status], reverse=True)
-        context['chart_status_labels'] = statuses
-        context['chart_status_values'] = [status_counts[status] for status in statuses]
-        # *** Categories chart ***
-        categories = ['obsoletedir', 'nonworkingdir']
-        uniquevals = recipes.exclude(classic_category='').values_list('classic_category', flat=True).distinct()
-        for value in uniquevals:
-            cats = value.split()
-            for cat in cats:
-                if not cat in categories:
-                    categories.append(cat)
-        categories.append('none')
-        catcounts = dict.fromkeys(categories, 0)
-        unmigrated = recipes.filter(cover_status__in=['U', 'N'])
-        catcounts['none'] = unmigrated.filter(classic_category='').count()
-        values = unmigrated.exclude(classic_category='').values_list('classic_category', flat=True)
-        # We gather data this way because an item might be in more than one category, thus
-        # the categories list must be in priority order
-        for value in values:
-            recipecats = value.split()
-            foundcat = 'none'
-            for cat in categories:
-                if cat in recipecats:
-                    foundcat = cat
-                    break
-            catcounts[foundcat] += 1
-        # Eliminate categories with zero count
-        categories = [cat for cat in categories if catcounts[cat] > 0]
-        categories = sorted(categories, key=lambda cat: catcounts[cat], reverse=True)
-        context['chart_category_labels'] = categories
-        context['chart_category_values'] = [catcounts[k] for k in categories]
+
+        def get_chart_data():
+            chart_data = {}
+            # *** Cover status chart ***
+            recipes = ClassicRecipe.objects.filter(layerbranch__branch=context['branch']).filter(deleted=False)
+            statuses = []
+            status_counts = {}
+            for choice, desc in ClassicRecipe.COVER_STATUS_CHOICES:
+                count = recipes.filter(cover_status=choice).count()
+                if count > 0:
+                    statuses.append(desc)
+                    status_counts[desc] = count
+            statuses = sorted(statuses, key=lambda status: status_counts[status], reverse=True)
+            chart_data['chart_status_labels'] = statuses
+            chart_data['chart_status_values'] = [status_counts[status] for status in statuses]
+            # *** Categories chart ***
+            categories = ['obsoletedir', 'nonworkingdir']
+            uniquevals = recipes.exclude(classic_category='').values_list('classic_category', flat=True).distinct()
+            for value in uniquevals:
+                cats = value.split()
+                for cat in cats:
+                    if not cat in categories:
+                        categories.append(cat)
+            categories.append('none')
+            catcounts = dict.fromkeys(categories, 0)
+            unmigrated = recipes.filter(cover_status__in=['U', 'N'])
+            catcounts['none'] = unmigrated.filter(classic_category='').count()
+            values = unmigrated.exclude(classic_category='').values_list('classic_category', flat=True)
+            # We gather data this way because an item might be in more than one category, thus
+            # the categories list must be in priority order
+            for value in values:
+                recipecats = value.split()
+                foundcat = 'none'
+                for cat in categories:
+                    if cat in recipecats:
+                        foundcat = cat
+                        break
+                catcounts[foundcat] += 1
+            # Eliminate categories with zero count
+            categories = [cat for cat in categories if catcounts[cat] > 0]
+            categories = sorted(categories, key=lambda cat: catcounts[cat], reverse=True)
+            chart_data['chart_category_labels'] = categories
+            chart_data['chart_category_values'] = [catcounts[k] for k in categories]
+            return chart_data
+
+        context.update(utils.cached_result(utils.branch_cache_key('classicstats', Branch.objects.filter(id=context['branch'].id)), get_chart_data))
         return context
 
 
 class StatsView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(StatsView, self).get_context_data(**kwargs)
-        context['layercount'] = LayerItem.objects.count()
-        context['recipe_count_distinct'] = Recipe.objects.values('pn').distinct().count()
-        context['class_count_distinct'] = BBClass.objects.values('name').distinct().count()
-        context['machine_count_distinct'] = Machine.objects.values('name').distinct().count()
-        context['distro_count_distinct'] = Distro.objects.values('name').distinct().count()
-        context['perbranch'] = Branch.objects.filter(hidden=False).order_by('sort_priority').annotate(
-                layer_count=Count('layerbranch', distinct=True),
-                recipe_count=Count('layerbranch__recipe', distinct=True),
-                class_count=Count('layerbranch__bbclass', distinct=True),
-                machine_count=Count('layerbranch__machine', distinct=True),
-                distro_count=Count('layerbranch__distro', distinct=True))
+
+        def get_stats():
+            stats = {}
+            stats['layercount'] = LayerItem.objects.count()
+            stats['recipe_count_distinct'] = Recipe.objects.values('pn').distinct().count()
+            stats['class_count_distinct'] = BBClass.objects.values('name').distinct().count()
+            stats['machine_count_distinct'] = Machine.objects.values('name').distinct().count()
+            stats['distro_count_distinct'] = Distro.objects.values('name').distinct().count()
+            stats['perbranch'] = list(Branch.objects.filter(hidden=False).order_by('sort_priority').annotate(
+                    layer_count=Count('layerbranch', distinct=True),
+                    recipe_count=Count('layerbranch__recipe', distinct=True),
+                    class_count=Count('layerbranch__bbclass', distinct=True),
+                    machine_count=Count('layerbranch__machine', distinct=True),
+                    distro_count=Count('layerbranch__distro', distinct=True)))
+            return stats
+
+        # These are totals across every branch, so the result does depend
+        # on all of them
+        context.update(utils.cached_result(utils.branch_cache_key('stats', Branch.objects.all()), get_stats))
         return context
 
 
+@cache_page(getattr(settings, 'AUTOCOMPLETE_CACHE_TIMEOUT', 300))
+def autocomplete_view(request, branch, itemtype):
+    """
+    Return (as JSON) up to 'limit' distinct names of the specified type of
+    item on the branch starting with the text in 'q', for suggestions in
+    search boxes
+    """
+    _check_url_branch({'branch': branch})
+    query_string = request.GET.get('q', '').strip()
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    if itemtype == 'recipe':
+        qs = Recipe.objects.filter(layerbranch__branch__name=branch).values_list('pn', flat=True)
+        field = 'pn'
+    elif itemtype == 'layer':
+        qs = LayerItem.objects.filter(layerbranch__branch__name=branch, status__in=['P', 'X']).values_list('name', flat=True)
+        field = 'name'
+    elif itemtype == 'machine':
+        qs = Machine.objects.filter(layerbranch__branch__name=branch).values_list('name', flat=True)
+        field = 'name'
+    elif itemtype == 'distro':
+        qs = Distro.objects.filter(layerbranch__branch__name=branch).values_list('name', flat=True)
+        field = 'name'
+    elif itemtype == 'class':
+        qs = BBClass.objects.filter(layerbranch__branch__name=branch).values_list('name', flat=True)
+        field = 'name'
+    else:
+        raise Http404
+    if query_string:
+        # The index on each of these columns serves a case-insensitive
+        # prefix match on MySQL (case-insensitive collation) and on
+        # PostgreSQL (the UPPER() indexes from migration 0052); on SQLite
+        # this is a scan
+        names = list(qs.filter(**{field + '__istartswith': query_string}).order_by(field).distinct()[:limit])
+    else:
+        names = []
+    return JsonResponse(names, safe=False)
+
+
 def layer_export_recipes_csv_view(request, branch, slug):
     import csv
     layer = get_object_or_404(LayerItem, name=slug)
@@ -1662,7 +1817,7 @@ class ComparisonRecipeSelectView(ClassicRecipeSearchView):
         init_qs = Recipe.objects.filter(layerbranch__branch__name='master')
         if layer_ids:
             init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
-        qs, _ = self.search_recipe_query(init_qs, query_string, preferred=False)
+        qs, _ = self.search_recipe_query(init_qs, query_string, 'master')
         return qs
 
     def post(self, request, *args, **kwargs):
@@ -1674,6 +1829,7 @@ class ComparisonRecipeSelectView(ClassicRecipeSearchView):
 
         if form.is_valid():
             form.save()
+            recipe.layerbranch.branch.bump_generation()
             messages.success(request, 'Changes to comparison recipe %s saved successfully.' % recipe.pn)
             return HttpResponseRedirect(reverse('comparison_recipe', args=(recipe.id,)))
         else:
@@ -1707,6 +1863,7 @@ class ComparisonRecipeSelectDetailView(DetailView):
 
         if form.is_valid():
             form.save()
+            recipe.layerbranch.branch.bump_generation()
             messages.success(request, 'Changes to comparison recipe %s saved successfully.' % recipe.pn)
             return HttpResponseRedirect(reverse('comparison_recipe', args=(recipe.id,)))
         else:
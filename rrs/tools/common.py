@@ -54,32 +54,28 @@ def get_pv_type(pv):
 
     return pv_type
 
-def get_recipe_files(layerdir):
+def get_recipe_files(layerdir, repodir=None, commit=None):
+    """
+    Get the full paths of all recipe files in a layer. If commit (a
+    GitPython commit object for the repository at repodir) is specified,
+    the list of files is read directly from git rather than from the
+    working tree (the files still need to be checked out to be parsed).
+    """
     from layerindex import recipeparse
 
-    sublayer_dirs = []
-    for root, dirs, files in os.walk(layerdir):
-        for d in dirs:
-            if os.path.exists(os.path.join(root, d, 'conf', 'layer.conf')):
-                sublayer_dirs.append(os.path.join(root, d) + os.sep)
+    if commit:
+        subdir = os.path.relpath(layerdir, repodir)
+        if subdir == '.':
+            subdir = ''
+    else:
+        repodir = layerdir
+        subdir = ''
+    (layer_files, _) = recipeparse.scan_layer(repodir, subdir, commit)
 
     recipe_files = []
-    for root, dirs, files in os.walk(layerdir):
-        if '.git' in dirs:
-            dirs.remove('.git')
-
-        # remove sublayer dirs
-        for d in dirs[:]:
-            fullpath = os.path.join(root, d) + os.sep
-            if fullpath in sublayer_dirs:
-                dirs.remove(d)
-
-        for f in files:
-            fullpath = os.path.join(root, f)
-            (typename, _, filename) = recipeparse.detect_file_type(fullpath,
-                    layerdir + os.sep)
-            if typename == 'recipe':
-                recipe_files.append(fullpath)
+    for (typename, _, _, path) in layer_files:
+        if typename == 'recipe':
+            recipe_files.append(os.path.join(repodir, path))
     return recipe_files
 
 def load_recipes(layerbranch, bitbakepath, fetchdir, settings, logger,
@@ -0,0 +1,30 @@
+# layerindex-web - shared test configuration
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import sys
+import os
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The update script modules are written to be run from within layerindex/
+# and import each other (and utils) directly, so make that work here too
+sys.path.insert(0, os.path.join(basepath, 'layerindex'))
+
+@pytest.fixture
+def make_layerbranch(db):
+    """Factory for layer branches (creating the layer and branch as needed)"""
+    from layerindex.models import Branch, LayerItem, LayerBranch
+    def make(layername, branchname='master', layer_type='S', index_preference=0):
+        branch, _ = Branch.objects.get_or_create(name=branchname, defaults={'bitbake_branch': branchname})
+        layer, _ = LayerItem.objects.get_or_create(name=layername,
+                                                   defaults={'layer_type': layer_type,
+                                                             'index_preference': index_preference,
+                                                             'summary': layername,
+                                                             'description': layername,
+                                                             'vcs_url': 'git://git.example.com/%s' % layername})
+        return LayerBranch.objects.create(layer=layer, branch=branch)
+    return make
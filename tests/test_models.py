@@ -0,0 +1,79 @@
+# layerindex-web - tests for model methods
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import pytest
+
+
+@pytest.fixture
+def dupe_layerbranches(make_layerbranch):
+    """Two layers on master with some items in common, and one on another branch"""
+    from layerindex.models import Recipe, BBClass, IncFile
+    layerbranches = [make_layerbranch('meta-first'), make_layerbranch('meta-second'), make_layerbranch('meta-first', 'thud')]
+    for layerbranch in layerbranches:
+        for pn in ['dup', 'unique-%s' % layerbranch.id]:
+            Recipe.objects.create(layerbranch=layerbranch, filename='%s_1.0.bb' % pn, pn=pn, pv='1.0')
+        BBClass.objects.create(layerbranch=layerbranch, name='dupclass')
+        IncFile.objects.create(layerbranch=layerbranch, path='conf/distro/include/dup.inc')
+    return layerbranches
+
+def duplicate_items(branch):
+    from layerindex.models import DuplicateItem
+    return set(DuplicateItem.objects.filter(branch=branch).values_list('item_type', 'name', 'layerbranch_id', 'object_id'))
+
+def expected_items(layerbranches):
+    from layerindex.models import Recipe, BBClass, IncFile
+    items = set()
+    for layerbranch in layerbranches:
+        items.add(('R', 'dup', layerbranch.id, Recipe.objects.get(layerbranch=layerbranch, pn='dup').id))
+        items.add(('C', 'dupclass', layerbranch.id, BBClass.objects.get(layerbranch=layerbranch).id))
+        items.add(('I', 'conf/distro/include/dup.inc', layerbranch.id, IncFile.objects.get(layerbranch=layerbranch).id))
+    return items
+
+def get_generation(branch):
+    branch.refresh_from_db()
+    return branch.generation
+
+def test_duplicates_update_branch(dupe_layerbranches):
+    from layerindex.models import DuplicateItem
+    master = dupe_layerbranches[0].branch
+    thud = dupe_layerbranches[2].branch
+    generation = get_generation(master)
+    DuplicateItem.update_branch(master)
+    assert duplicate_items(master) == expected_items(dupe_layerbranches[:2])
+    assert get_generation(master) > generation
+    # Only one layer on the other branch, so no duplicates there
+    DuplicateItem.update_branch(thud)
+    assert duplicate_items(thud) == set()
+
+def test_duplicates_update_branch_unchanged(dupe_layerbranches):
+    from layerindex.models import DuplicateItem
+    master = dupe_layerbranches[0].branch
+    DuplicateItem.update_branch(master)
+    ids = set(DuplicateItem.objects.filter(branch=master).values_list('id', flat=True))
+    generation = get_generation(master)
+    DuplicateItem.update_branch(master)
+    # Nothing changed, so nothing should have been rewritten or invalidated
+    assert set(DuplicateItem.objects.filter(branch=master).values_list('id', flat=True)) == ids
+    assert get_generation(master) == generation
+
+def test_duplicates_update_branch_changed(dupe_layerbranches):
+    from layerindex.models import DuplicateItem, Recipe
+    master = dupe_layerbranches[0].branch
+    DuplicateItem.update_branch(master)
+    classids = set(DuplicateItem.objects.filter(branch=master, item_type='C').values_list('id', flat=True))
+    expected = set([item for item in expected_items(dupe_layerbranches[:2]) if item[0] != 'R'])
+    generation = get_generation(master)
+    Recipe.objects.filter(layerbranch=dupe_layerbranches[1], pn='dup').delete()
+    recipe = Recipe.objects.get(layerbranch=dupe_layerbranches[1], pn='unique-%s' % dupe_layerbranches[1].id)
+    recipe.pn = 'unique-%s' % dupe_layerbranches[0].id
+    recipe.save()
+    DuplicateItem.update_branch(master)
+    expected.add(('R', recipe.pn, dupe_layerbranches[1].id, recipe.id))
+    expected.add(('R', recipe.pn, dupe_layerbranches[0].id, Recipe.objects.get(layerbranch=dupe_layerbranches[0], pn=recipe.pn).id))
+    assert duplicate_items(master) == expected
+    assert get_generation(master) > generation
+    # Items that didn't change are left alone
+    assert set(DuplicateItem.objects.filter(branch=master, item_type='C').values_list('id', flat=True)) == classids
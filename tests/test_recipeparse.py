@@ -0,0 +1,119 @@
+# layerindex-web - tests for recipe dependency handling
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import pytest
+
+
+@pytest.fixture
+def recipe(make_layerbranch):
+    from layerindex.models import Recipe
+    layerbranch = make_layerbranch('meta-deps')
+    return Recipe.objects.create(layerbranch=layerbranch, filename='example_0.1.bb', pn='example', pv='0.1')
+
+def static_links(recipe):
+    from layerindex.models import StaticBuildDep
+    return dict(StaticBuildDep.recipes.through.objects.filter(recipe_id=recipe.id).values_list('staticbuilddep__name', 'id'))
+
+def test_sync_links(recipe):
+    from layerindex.models import StaticBuildDep
+    from recipeparse import RecipeDependencySync
+    through = StaticBuildDep.recipes.through
+    depids = dict([(name, StaticBuildDep.objects.create(name=name).id) for name in ['dep1', 'dep2', 'dep3']])
+    depsync = RecipeDependencySync()
+
+    depsync._sync_links(through, 'recipe_id', recipe.id, 'staticbuilddep_id', set([depids['dep1'], depids['dep2']]))
+    links = static_links(recipe)
+    assert sorted(links.keys()) == ['dep1', 'dep2']
+
+    depsync._sync_links(through, 'recipe_id', recipe.id, 'staticbuilddep_id', set([depids['dep2'], depids['dep3']]))
+    newlinks = static_links(recipe)
+    assert sorted(newlinks.keys()) == ['dep2', 'dep3']
+    # Links that were already there should have been left alone
+    assert newlinks['dep2'] == links['dep2']
+
+    depsync._sync_links(through, 'recipe_id', recipe.id, 'staticbuilddep_id', set())
+    assert static_links(recipe) == {}
+
+def test_sync_links_other_recipes_untouched(recipe):
+    from layerindex.models import Recipe, StaticBuildDep
+    from recipeparse import RecipeDependencySync
+    through = StaticBuildDep.recipes.through
+    other = Recipe.objects.create(layerbranch=recipe.layerbranch, filename='other_0.1.bb', pn='other', pv='0.1')
+    depid = StaticBuildDep.objects.create(name='dep1').id
+    depsync = RecipeDependencySync()
+    depsync._sync_links(through, 'recipe_id', recipe.id, 'staticbuilddep_id', set([depid]))
+    depsync._sync_links(through, 'recipe_id', other.id, 'staticbuilddep_id', set([depid]))
+    depsync._sync_links(through, 'recipe_id', recipe.id, 'staticbuilddep_id', set())
+    assert static_links(recipe) == {}
+    assert list(static_links(other).keys()) == ['dep1']
+
+def test_get_ids_uses_oldest_duplicate(db):
+    from layerindex.models import StaticBuildDep
+    from recipeparse import RecipeDependencySync
+    first = StaticBuildDep.objects.create(name='dup')
+    StaticBuildDep.objects.create(name='dup')
+    depsync = RecipeDependencySync()
+    ids = depsync._get_ids(StaticBuildDep, depsync.static_ids, set(['dup', 'new']))
+    assert first.id in ids
+    assert len(ids) == 2
+    assert StaticBuildDep.objects.filter(name='new').count() == 1
+    # The second lookup shouldn't create anything further
+    assert depsync._get_ids(StaticBuildDep, depsync.static_ids, set(['new'])) == set([depsync.static_ids['new']])
+    assert StaticBuildDep.objects.filter(name='new').count() == 1
+
+def test_sync(recipe):
+    from layerindex.models import PackageConfig, DynamicBuildDep
+    from recipeparse import RecipeDependencySync
+    RecipeDependencySync().sync(recipe, 'zlib openssl', {'ssl': '--with-ssl,--without-ssl,openssl',
+                                                         'gtk': '--enable-gtk,--disable-gtk,gtk+3 glib-2.0',
+                                                         'doc': '--enable-doc,--disable-doc,doxygen'})
+    assert sorted(static_links(recipe).keys()) == ['openssl', 'zlib']
+    configs = dict([(pc.feature, pc) for pc in PackageConfig.objects.filter(recipe=recipe)])
+    assert sorted(configs.keys()) == ['gtk', 'ssl']
+    assert configs['ssl'].with_option == '--with-ssl'
+    assert configs['ssl'].without_option == '--without-ssl'
+    assert configs['ssl'].build_deps == 'openssl'
+    assert sorted(DynamicBuildDep.objects.filter(package_configs=configs['gtk']).values_list('name', flat=True)) == ['glib-2.0', 'gtk+3']
+    assert sorted(DynamicBuildDep.objects.filter(recipes=recipe).values_list('name', flat=True)) == ['glib-2.0', 'gtk+3', 'openssl']
+
+    # Now change things and check that only the differences are applied
+    RecipeDependencySync().sync(recipe, 'zlib', {'ssl': '--with-ssl,--without-ssl,openssl libressl'})
+    assert list(static_links(recipe).keys()) == ['zlib']
+    newconfigs = dict([(pc.feature, pc) for pc in PackageConfig.objects.filter(recipe=recipe)])
+    assert list(newconfigs.keys()) == ['ssl']
+    assert newconfigs['ssl'].id == configs['ssl'].id
+    assert newconfigs['ssl'].build_deps == 'openssl libressl'
+    assert sorted(DynamicBuildDep.objects.filter(recipes=recipe).values_list('name', flat=True)) == ['libressl', 'openssl']
+
+@pytest.fixture
+def committed_ids():
+    from recipeparse import RecipeDependencySync
+    RecipeDependencySync.committed_ids.clear()
+    yield RecipeDependencySync.committed_ids
+    RecipeDependencySync.committed_ids.clear()
+
+@pytest.mark.django_db(transaction=True)
+def test_get_ids_shared_once_committed(committed_ids, django_assert_num_queries):
+    from django.db import transaction
+    from layerindex.models import StaticBuildDep
+    from recipeparse import RecipeDependencySync
+    depsync = RecipeDependencySync()
+    ids = depsync._get_ids(StaticBuildDep, depsync.static_ids, set(['shared']))
+    # Another instance (e.g. for the next layer) shouldn't need to look it up
+    depsync = RecipeDependencySync()
+    with django_assert_num_queries(0):
+        assert depsync._get_ids(StaticBuildDep, depsync.static_ids, set(['shared'])) == ids
+
+    # Names from a transaction that is rolled back must not be shared
+    class Rollback(Exception):
+        pass
+    with pytest.raises(Rollback):
+        with transaction.atomic():
+            depsync = RecipeDependencySync()
+            depsync._get_ids(StaticBuildDep, depsync.static_ids, set(['rolledback']))
+            raise Rollback()
+    assert 'rolledback' not in committed_ids['StaticBuildDep']
+    assert not StaticBuildDep.objects.filter(name='rolledback').exists()
@@ -0,0 +1,100 @@
+# layerindex-web - tests for update script caches
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import os
+import pytest
+
+
+@pytest.fixture
+def parsecache(tmpdir):
+    from layerindex.models import Branch, LayerItem, LayerBranch
+    from updatecache import RecipeParseCache
+    layerbranch = LayerBranch(layer=LayerItem(name='meta-test'), branch=Branch(name='master'))
+    def make_cache(envkey='env1'):
+        return RecipeParseCache(str(tmpdir.join('fetch')), layerbranch, envkey)
+    return make_cache
+
+@pytest.fixture
+def recipefiles(tmpdir):
+    recipedir = tmpdir.mkdir('recipes')
+    recipefn = recipedir.join('example_0.1.bb')
+    recipefn.write('SUMMARY = "Example"\n')
+    incfn = recipedir.join('example.inc')
+    incfn.write('LICENSE = "MIT"\n')
+    return (str(recipefn), str(incfn))
+
+def test_parse_cache_hit(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache()
+    values = {'pn': 'example', 'depfiles': [incfn]}
+    assert cache.get_values(recipefn) is None
+    cache.set_values(recipefn, values)
+    cache.save()
+    # A new instance should read back what was saved
+    cache = parsecache()
+    assert cache.get_values(recipefn) == values
+
+def test_parse_cache_env_changed(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache('env1')
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn]})
+    cache.save()
+    cache = parsecache('env2')
+    assert cache.get_values(recipefn) is None
+
+def test_parse_cache_recipe_changed(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache()
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn]})
+    cache.save()
+    with open(recipefn, 'a') as f:
+        f.write('DESCRIPTION = "Changed"\n')
+    cache = parsecache()
+    assert cache.get_values(recipefn) is None
+
+def test_parse_cache_dependency_changed(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache()
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn]})
+    cache.save()
+    with open(incfn, 'w') as f:
+        f.write('LICENSE = "GPLv2"\n')
+    cache = parsecache()
+    assert cache.get_values(recipefn) is None
+
+def test_parse_cache_dependency_deleted(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache()
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn]})
+    cache.save()
+    os.remove(incfn)
+    cache = parsecache()
+    assert cache.get_values(recipefn) is None
+
+def test_parse_cache_dependency_added(parsecache, recipefiles, tmpdir):
+    # A dependency that didn't exist when the recipe was parsed (e.g. a
+    # bbappend that was looked for) should invalidate the entry once it exists
+    recipefn, incfn = recipefiles
+    newfn = str(tmpdir.join('recipes', 'example_%.bbappend'))
+    cache = parsecache()
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn, newfn]})
+    cache.save()
+    cache = parsecache()
+    assert cache.get_values(recipefn) is not None
+    with open(newfn, 'w') as f:
+        f.write('PR = "r1"\n')
+    cache = parsecache()
+    assert cache.get_values(recipefn) is None
+
+def test_parse_cache_drops_deleted_recipes(parsecache, recipefiles):
+    recipefn, incfn = recipefiles
+    cache = parsecache()
+    cache.set_values(recipefn, {'pn': 'example', 'depfiles': [incfn]})
+    cache.save()
+    os.remove(recipefn)
+    cache = parsecache()
+    cache.save()
+    assert recipefn not in parsecache().data
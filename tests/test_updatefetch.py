@@ -0,0 +1,111 @@
+# layerindex-web - tests for update script repository fetching
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import os
+import subprocess
+import pytest
+
+
+def git(args, cwd):
+    subprocess.check_output(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + args, cwd=cwd, stderr=subprocess.STDOUT)
+
+def commit_file(repodir, fn, contents, branch=None):
+    if branch:
+        git(['checkout', '-q', branch], repodir)
+    with open(os.path.join(repodir, fn), 'w') as f:
+        f.write(contents)
+    git(['add', fn], repodir)
+    git(['commit', '-q', '-m', 'Update %s' % fn], repodir)
+
+@pytest.fixture
+def upstream(tmpdir):
+    """An upstream repository with master and other branches"""
+    repodir = str(tmpdir.mkdir('upstream'))
+    git(['init', '-q'], repodir)
+    git(['symbolic-ref', 'HEAD', 'refs/heads/master'], repodir)
+    commit_file(repodir, 'README', 'Initial\n')
+    git(['branch', 'other'], repodir)
+    return repodir
+
+@pytest.fixture
+def fetchdir(tmpdir):
+    return str(tmpdir.mkdir('fetch'))
+
+def test_get_url_host():
+    from updatefetch import get_url_host
+    assert get_url_host('git://git.openembedded.org/openembedded-core') == 'git.openembedded.org'
+    assert get_url_host('https://github.com/example/meta-example.git') == 'github.com'
+    assert get_url_host('ssh://git@git.example.com:2222/meta-example') == 'git.example.com'
+    assert get_url_host('git@github.com:example/meta-example.git') == 'github.com'
+    assert get_url_host('/srv/git/meta-example') == ''
+
+def test_planner_add_merges_branches():
+    from updatefetch import FetchPlanner
+    planner = FetchPlanner(jobs=1)
+    planner.add('git://example.com/repo', '/fetch/repo', 'repo', '/fetch', 'layer1', branches=['master'])
+    planner.add('git://example.com/repo', '/fetch/repo', 'repo', '/fetch', 'layer2', branches=['thud'])
+    assert len(planner.repos) == 1
+    assert planner.repos['/fetch/repo'][5] == set(['master', 'thud'])
+    # A layer that needs all branches means the whole repo must be checked...
+    planner.add('git://example.com/repo', '/fetch/repo', 'repo', '/fetch', 'layer3')
+    assert planner.repos['/fetch/repo'][5] is None
+    # ... regardless of what comes after
+    planner.add('git://example.com/repo', '/fetch/repo', 'repo', '/fetch', 'layer4', branches=['master'])
+    assert planner.repos['/fetch/repo'][5] is None
+
+def test_fetch_repo_skips_unchanged(upstream, fetchdir):
+    from updatefetch import fetch_repo
+    repodir = os.path.join(fetchdir, 'upstream')
+    (_, error, fetched, _) = fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test')
+    assert error is None
+    assert fetched
+    assert os.path.exists(repodir)
+    # Nothing has changed upstream
+    (_, error, fetched, _) = fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test')
+    assert error is None
+    assert not fetched
+    # Without the check, we always fetch
+    (_, error, fetched, _) = fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test', precheck=False)
+    assert error is None
+    assert fetched
+
+def test_fetch_repo_only_relevant_branches(upstream, fetchdir):
+    from updatefetch import fetch_repo
+    repodir = os.path.join(fetchdir, 'upstream')
+    fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test')
+    commit_file(upstream, 'README', 'Changed\n', branch='other')
+    (_, error, fetched, _) = fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test', branches=set(['master']))
+    assert error is None
+    assert not fetched
+    (_, error, fetched, _) = fetch_repo(upstream, repodir, 'upstream', fetchdir, 'test', branches=set(['master', 'other']))
+    assert error is None
+    assert fetched
+
+def test_planner_run(upstream, fetchdir, tmpdir):
+    from updatefetch import FetchPlanner
+    urls = []
+    planner = FetchPlanner(jobs=2, host_jobs=1)
+    for i in range(3):
+        url = str(tmpdir.join('mirror%d' % i))
+        git(['clone', '-q', '--mirror', upstream, url], str(tmpdir))
+        urldir = 'mirror%d' % i
+        planner.add(url, os.path.join(fetchdir, urldir), urldir, fetchdir, 'layer%d' % i)
+        urls.append(url)
+    results = planner.run()
+    assert results == dict([(url, None) for url in urls])
+    for i in range(3):
+        assert os.path.exists(os.path.join(fetchdir, 'mirror%d' % i, 'README'))
+    assert len(planner.timings) == 3
+
+def test_planner_run_failure(fetchdir, tmpdir):
+    from updatefetch import FetchPlanner
+    url = str(tmpdir.join('nonexistent'))
+    urldir = 'nonexistent'
+    planner = FetchPlanner(jobs=1, retries=1, retry_delay=0)
+    planner.add(url, os.path.join(fetchdir, urldir), urldir, fetchdir, 'layer')
+    results = planner.run()
+    assert list(results.keys()) == [url]
+    assert results[url]
@@ -0,0 +1,178 @@
+# layerindex-web - tests for update script batched database writes
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+def machines(layerbranch):
+    from layerindex.models import Machine
+    return dict(Machine.objects.filter(layerbranch=layerbranch).values_list('name', 'description'))
+
+def machine_writer(layerbranch):
+    from layerindex.models import Machine
+    from updatewriter import LayerBranchRowWriter
+    return LayerBranchRowWriter(Machine, layerbranch, ('name',), ('description',))
+
+def test_chunks():
+    from updatewriter import chunks
+    assert [len(chunk) for chunk in chunks(range(1201), 500)] == [500, 500, 201]
+    assert list(chunks([], 500)) == []
+    assert list(chunks(set([1]), 500)) == [[1]]
+
+def test_row_writer_insert(make_layerbranch):
+    layerbranch = make_layerbranch('meta-writer')
+    writer = machine_writer(layerbranch)
+    writer.set(name='qemux86', description='x86')
+    writer.set(name='qemuarm', description='ARM')
+    assert machines(layerbranch) == {}, 'Nothing should be written before flush()'
+    writer.flush()
+    assert machines(layerbranch) == {'qemux86': 'x86', 'qemuarm': 'ARM'}
+    # Flushing again must not insert the rows a second time
+    writer.flush()
+    assert machines(layerbranch) == {'qemux86': 'x86', 'qemuarm': 'ARM'}
+
+def test_row_writer_update_delete(make_layerbranch):
+    from layerindex.models import Machine
+    layerbranch = make_layerbranch('meta-writer')
+    writer = machine_writer(layerbranch)
+    for name in ['qemux86', 'qemuarm', 'qemumips']:
+        writer.set(name=name, description=name)
+    writer.flush()
+    ids = dict(Machine.objects.filter(layerbranch=layerbranch).values_list('name', 'id'))
+
+    writer = machine_writer(layerbranch)
+    assert writer.get(name='qemux86') == {'id': ids['qemux86'], 'name': 'qemux86', 'description': 'qemux86'}
+    writer.set(name='qemux86', description='qemux86')
+    writer.set(name='qemuarm', description='Changed')
+    writer.set(name='qemuppc', description='qemuppc')
+    writer.delete_unseen()
+    assert writer.get(name='qemumips') is None
+    writer.flush()
+    assert machines(layerbranch) == {'qemux86': 'qemux86', 'qemuarm': 'Changed', 'qemuppc': 'qemuppc'}
+    newids = dict(Machine.objects.filter(layerbranch=layerbranch).values_list('name', 'id'))
+    # Existing rows keep their ids, whether changed or not
+    assert newids['qemux86'] == ids['qemux86']
+    assert newids['qemuarm'] == ids['qemuarm']
+
+def test_row_writer_rename(make_layerbranch):
+    from layerindex.models import Machine
+    layerbranch = make_layerbranch('meta-writer')
+    writer = machine_writer(layerbranch)
+    writer.set(name='oldname', description='Machine')
+    writer.set(name='other', description='Other')
+    writer.flush()
+    oldid = Machine.objects.get(layerbranch=layerbranch, name='oldname').id
+
+    writer = machine_writer(layerbranch)
+    assert writer.rename({'name': 'oldname'}, name='newname')
+    assert not writer.rename({'name': 'missing'}, name='something')
+    # Renaming onto an existing key replaces it
+    assert writer.rename({'name': 'newname'}, name='other')
+    writer.flush()
+    assert machines(layerbranch) == {'other': 'Machine'}
+    assert Machine.objects.get(layerbranch=layerbranch, name='other').id == oldid
+
+def test_row_writer_drops_duplicates(make_layerbranch):
+    from layerindex.models import Machine
+    layerbranch = make_layerbranch('meta-writer')
+    Machine.objects.create(layerbranch=layerbranch, name='qemux86', description='first')
+    Machine.objects.create(layerbranch=layerbranch, name='qemux86', description='second')
+    writer = machine_writer(layerbranch)
+    assert writer.get(name='qemux86')['description'] == 'first'
+    writer.flush()
+    assert list(Machine.objects.filter(layerbranch=layerbranch).values_list('description', flat=True)) == ['first']
+
+def test_row_writer_chunked_flush(make_layerbranch):
+    # More rows than fit in a single query, in both directions
+    from updatewriter import CHUNK_SIZE
+    layerbranch = make_layerbranch('meta-writer')
+    count = CHUNK_SIZE * 2 + 1
+    writer = machine_writer(layerbranch)
+    for i in range(count):
+        writer.set(name='machine%d' % i, description='Machine %d' % i)
+    writer.flush()
+    assert len(machines(layerbranch)) == count
+
+    writer = machine_writer(layerbranch)
+    writer.delete_unseen()
+    writer.flush()
+    assert machines(layerbranch) == {}
+
+def test_row_writer_other_parents_untouched(make_layerbranch):
+    layerbranch1 = make_layerbranch('meta-writer1')
+    layerbranch2 = make_layerbranch('meta-writer2')
+    writer = machine_writer(layerbranch2)
+    writer.set(name='qemux86', description='x86')
+    writer.flush()
+    writer = machine_writer(layerbranch1)
+    writer.set(name='qemux86', description='Other x86')
+    writer.delete_unseen()
+    writer.flush()
+    assert machines(layerbranch1) == {'qemux86': 'Other x86'}
+    assert machines(layerbranch2) == {'qemux86': 'x86'}
+
+def test_row_writer_truncates(make_layerbranch):
+    from layerindex.models import Machine
+    layerbranch = make_layerbranch('meta-writer')
+    maxlength = Machine._meta.get_field('description').max_length
+    longname = 'm' * (Machine._meta.get_field('name').max_length + 10)
+    writer = machine_writer(layerbranch)
+    writer.set(name=longname, description='x' * (maxlength + 10))
+    writer.flush()
+    machine = Machine.objects.get(layerbranch=layerbranch)
+    assert machine.name == longname[:len(machine.name)]
+    assert machine.description == 'x' * maxlength
+
+    # Setting the same over-long values again must not count as a change
+    writer = machine_writer(layerbranch)
+    writer.set(name=longname, description='x' * (maxlength + 10))
+    assert not writer.changed_ids
+    assert writer.get(name=longname)['id'] == machine.id
+    writer.delete_unseen()
+    writer.flush()
+    assert Machine.objects.get(layerbranch=layerbranch).updated == machine.updated
+
+    writer = machine_writer(layerbranch)
+    writer.set(name=longname, description='y' * (maxlength + 10))
+    writer.flush()
+    assert Machine.objects.get(layerbranch=layerbranch).description == 'y' * maxlength
+
+def test_file_dependency_writer_truncates(make_layerbranch):
+    from layerindex.models import Recipe, RecipeFileDependency
+    from updatewriter import RecipeFileDependencyWriter
+    layerbranch = make_layerbranch('meta-writer')
+    recipe = Recipe.objects.create(layerbranch=layerbranch, filename='example_0.1.bb', pn='example', pv='0.1')
+    maxlength = RecipeFileDependency._meta.get_field('path').max_length
+    longpath = 'recipes-example/example/' + 'f' * maxlength
+    for _ in range(2):
+        writer = RecipeFileDependencyWriter(layerbranch)
+        writer.set(recipe, [longpath, 'recipes-example/example/example.inc'])
+        writer.flush()
+    paths = sorted(RecipeFileDependency.objects.filter(recipe=recipe).values_list('path', flat=True))
+    assert paths == [longpath[:maxlength], 'recipes-example/example/example.inc']
+
+def test_recipe_row_writer_truncates(make_layerbranch):
+    from layerindex.models import Recipe, Patch, Source
+    from updatewriter import RecipeRowWriter
+    layerbranch = make_layerbranch('meta-writer')
+    recipe = Recipe.objects.create(layerbranch=layerbranch, filename='example_0.1.bb', pn='example', pv='0.1')
+    longurl = 'https://downloads.example.com/' + 'a' * 300 + '.tar.gz'
+    longpath = 'recipes-example/example/files/' + 'p' * 300 + '.patch'
+    for i in range(2):
+        sourcewriter = RecipeRowWriter(Source, recipe, ('url',), ('sha256sum',))
+        sourcewriter.set(url=longurl, sha256sum='')
+        sourcewriter.delete_unseen()
+        sourcewriter.flush()
+        patchwriter = RecipeRowWriter(Patch, recipe, ('path',), ('src_path', 'apply_order', 'status', 'status_extra', 'sha256sum'))
+        patchwriter.set(path=longpath, src_path=longpath[24:], apply_order=0, status='P', status_extra='x' * 300, sha256sum='')
+        if i:
+            # Same values the second time round, so nothing to rewrite
+            assert patchwriter.get(path=longpath)['id']
+            assert not patchwriter.changed_ids
+        patchwriter.delete_unseen()
+        patchwriter.flush()
+    assert list(Source.objects.filter(recipe=recipe).values_list('url', flat=True)) == [longurl[:255]]
+    patch = Patch.objects.get(recipe=recipe)
+    assert patch.path == longpath[:255]
+    assert patch.src_path == longpath[24:][:255]
+    assert patch.status_extra == 'x' * 255
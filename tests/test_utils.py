@@ -0,0 +1,92 @@
+# layerindex-web - tests for utility functions
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import pytest
+
+
+def test_timings_round_trip():
+    from layerindex import utils
+    line = utils.format_timings({'parse': 1.23456, 'fetch': 2})
+    assert line.startswith(utils.TIMINGS_PREFIX)
+    assert '\n' not in line
+    output, timings = utils.extract_timings(line + '\n')
+    assert output == ''
+    assert timings == {'parse': 1.235, 'fetch': 2}
+
+def test_extract_timings():
+    from layerindex import utils
+    output = ''.join(['INFO: Starting\n',
+                      utils.format_timings({'parse': 1.5, 'write': 0.5}) + '\n',
+                      'NOTE: something in between\n',
+                      utils.format_timings({'parse': 2.0}) + '\n',
+                      'INFO: Done'])
+    output, timings = utils.extract_timings(output)
+    # Other lines are preserved exactly as they were
+    assert output == 'INFO: Starting\nNOTE: something in between\nINFO: Done'
+    # Repeated phases are added together
+    assert timings == {'parse': 3.5, 'write': 0.5}
+
+def test_extract_timings_malformed():
+    from layerindex import utils
+    output = '%snot json\nother\n' % utils.TIMINGS_PREFIX
+    assert utils.extract_timings(output) == (output, {})
+    assert utils.extract_timings('') == ('', {})
+
+@pytest.fixture
+def merged_recipes(make_layerbranch):
+    """A MergedQuerySet over three recipe querysets, the middle one empty"""
+    from layerindex.models import Recipe
+    from layerindex import utils
+    querysets = []
+    for layername, names in [('meta-first', ['a', 'b', 'c']), ('meta-empty', []), ('meta-second', ['d', 'e', 'f', 'g'])]:
+        layerbranch = make_layerbranch(layername)
+        for pn in names:
+            Recipe.objects.create(layerbranch=layerbranch, filename='%s_1.0.bb' % pn, pn=pn, pv='1.0')
+        querysets.append(Recipe.objects.filter(layerbranch=layerbranch).order_by('pn'))
+    return utils.MergedQuerySet(*querysets)
+
+def pns(recipes):
+    return [recipe.pn for recipe in recipes]
+
+def test_merged_queryset_count(merged_recipes):
+    from layerindex.models import Recipe
+    from layerindex import utils
+    assert merged_recipes.count() == 7
+    assert len(merged_recipes) == 7
+    assert merged_recipes
+    assert merged_recipes.counts() == [3, 0, 4]
+    assert not utils.MergedQuerySet(Recipe.objects.none(), Recipe.objects.none())
+
+def test_merged_queryset_iterate(merged_recipes):
+    assert pns(merged_recipes) == ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+
+def test_merged_queryset_slice(merged_recipes):
+    assert pns(merged_recipes[0:7]) == ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+    assert pns(merged_recipes[:2]) == ['a', 'b']
+    assert pns(merged_recipes[2:5]) == ['c', 'd', 'e']
+    assert pns(merged_recipes[3:4]) == ['d']
+    assert pns(merged_recipes[5:100]) == ['f', 'g']
+    assert pns(merged_recipes[-2:]) == ['f', 'g']
+    assert pns(merged_recipes[10:20]) == []
+    assert pns(merged_recipes[::3]) == ['a', 'd', 'g']
+
+def test_merged_queryset_index(merged_recipes):
+    assert merged_recipes[0].pn == 'a'
+    assert merged_recipes[3].pn == 'd'
+    assert merged_recipes[-1].pn == 'g'
+    with pytest.raises(IndexError):
+        merged_recipes[7]
+
+def test_merged_queryset_slice_queries(merged_recipes, django_assert_num_queries):
+    # Once the counts are known, only the querysets that overlap the slice
+    # should be queried
+    merged_recipes.count()
+    with django_assert_num_queries(1):
+        assert pns(merged_recipes[0:2]) == ['a', 'b']
+    with django_assert_num_queries(1):
+        assert pns(merged_recipes[5:7]) == ['f', 'g']
+    with django_assert_num_queries(2):
+        assert pns(merged_recipes[2:5]) == ['c', 'd', 'e']
@@ -0,0 +1,61 @@
+# layerindex-web - tests for view helpers
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+
+def test_compare_versions():
+    from layerindex.views import _compare_versions
+    pairs = [('1.0', '1.1'),
+             ('2.0', '1.9'),
+             ('1.0', '1.0'),
+             ('1.9', '1.10'),
+             ('', '1.0'),
+             ('1.0', None),
+             ('1.1', '1.0')]
+    assert _compare_versions(pairs) == [1, -1, 0, 1, 0, 0, -1]
+    assert _compare_versions([]) == []
+
+def test_pair_query(make_layerbranch):
+    from layerindex.models import Recipe
+    from layerindex.views import _pair_query
+    layerbranch1 = make_layerbranch('meta-first')
+    layerbranch2 = make_layerbranch('meta-second')
+    recipes = {}
+    for layerbranch in [layerbranch1, layerbranch2]:
+        for pn in ['a', 'b', 'c']:
+            recipes[(layerbranch.id, pn)] = Recipe.objects.create(layerbranch=layerbranch, filename='%s_1.0.bb' % pn, pn=pn, pv='1.0').id
+    pairs = set([(layerbranch1.id, 'a'), (layerbranch1.id, 'c'), (layerbranch2.id, 'b')])
+    matched = Recipe.objects.filter(_pair_query(pairs, 'layerbranch_id', 'pn')).values_list('id', flat=True)
+    assert sorted(matched) == sorted([recipes[pair] for pair in pairs])
+    # No pairs should match nothing (rather than everything)
+    assert not Recipe.objects.filter(_pair_query(set(), 'layerbranch_id', 'pn')).exists()
+
+def test_link_wrapper_clone(db):
+    from layerindex.models import Recipe, ClassicRecipe
+    from layerindex.views import ClassicRecipeLinkWrapper, ClassicRecipeReverseLinkWrapper
+    wrapper = ClassicRecipeLinkWrapper(ClassicRecipe.objects.all())
+    assert isinstance(wrapper._clone(), ClassicRecipeLinkWrapper)
+    wrapper = ClassicRecipeReverseLinkWrapper(Recipe.objects.all(), 'master', 'thud')
+    clone = wrapper._clone()
+    assert isinstance(clone, ClassicRecipeReverseLinkWrapper)
+    assert clone.branch == 'master'
+    assert clone.from_branch == 'thud'
+
+def test_layer_checklist_publish(make_layerbranch, client):
+    from django.core.cache import cache
+    from django.core.urlresolvers import reverse
+    cache.clear()
+    layerbranch = make_layerbranch('meta-unpublished')
+    url = reverse('layer_checklist', args=(layerbranch.branch.name,))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert layerbranch not in response.context['layerbranches']
+    # Publishing the layer only saves the LayerItem, but the cached list
+    # must still be invalidated
+    layer = layerbranch.layer
+    layer.status = 'P'
+    layer.save()
+    response = client.get(url)
+    assert layerbranch in response.context['layerbranches']